@@ -11,17 +11,46 @@
 #    limitations under the License.
 
 import argparse
-import os
+import asyncio
+import queue
+import shlex
+import shutil
 import subprocess
-import tarfile
+import tempfile
 from getpass import getpass
 from pathlib import Path
-from threading import Thread, Lock
+from threading import Thread
 
+from carrier_archive import DEFAULT_FORMAT, FORMATS
+from carrier_cache import (
+    SSH_CACHE_DIR,
+    install_cmd,
+    list_cmd,
+    missing,
+    part_path,
+    publish_cmd,
+)
+from carrier_compress import COMPRESSIONS, DEFAULT_COMPRESSION, archive_name, tar_cmd
+from carrier_impact import LOW_IMPACT_NODE_BANDWIDTH, low_impact_cmd
+from carrier_live import DEFAULT_LIVE_DIR, DEFAULT_LIVE_INTERVAL, LiveFiles
+from carrier_remote import bootstrap_cmd, remote_timeout, timed_out_remotely
+from carrier_runner import Runner, RunnerParser, work_path
+from carrier_sched import (
+    DEFAULT_PARALLELISM,
+    DEFAULT_TRANSFER_PARALLELISM,
+    PhaseTimeout,
+    RelayTree,
+    parse_phase_timeouts,
+)
+from carrier_sync import CLOCK_PROBE, ClockProbe
+from carrier_trace import file_size
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(
-        description="Run a script on multiple hosts and collect output."
+SSH_OPTIONS = ["-o", "StrictHostKeyChecking no", "-o", "UserKnownHostsFile /dev/null"]
+
+
+def parse_arguments(argv=None, out=None, err=None):
+    parser = RunnerParser(
+        out, err, description="Run a script on multiple hosts and collect output."
     )
     parser.add_argument("script", help="Path to the script file to run on hosts.")
     parser.add_argument(
@@ -42,15 +71,127 @@ def parse_arguments():
         choices=["bash", "zsh", "sh"],
         help="Shell to use for running the script (default: bash).",
     )
+    parser.add_argument(
+        "--multiplex",
+        action="store_true",
+        help="Open one persistent SSH connection per host and reuse it for every step (default: False).",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the collected files over ssh straight into the final archive instead of staging a tar.gz on the host and locally (default: False).",
+    )
+    parser.add_argument(
+        "--single-session",
+        action="store_true",
+        help="Send the script over stdin and create the work dir, run, collect and clean up in one ssh session (default: False).",
+    )
+    parser.add_argument(
+        "--compression",
+        default=DEFAULT_COMPRESSION,
+        choices=COMPRESSIONS,
+        help="How the files are compressed on the hosts, pigz and zstd use every core and the host archives are stored in the final archive without compressing them again (default: gzip).",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Level passed to the compressor, e.g. 1 for fast gzip or 19 for small zstd (default: the compressor's own).",
+    )
+    parser.add_argument(
+        "--format",
+        default=DEFAULT_FORMAT,
+        choices=FORMATS,
+        help="Format of the final archive, zip unpacks the files of every host into a flat archive with an index so single files can be listed and extracted with carrier_bundle.py (default: tar).",
+    )
+    parser.add_argument(
+        "--attach",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="File to put next to the script on every host, e.g. a jar the script runs. Files are cached on the host by their sha256 so they are only copied once, can be repeated.",
+    )
+    parser.add_argument(
+        "--relay",
+        type=int,
+        metavar="FANOUT",
+        help="Copy the script and attached files from host to host in a tree with FANOUT children per host instead of from here to every host, needs --use-key and hosts reaching each other by the names given (default: off).",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the hosts the last run in this directory collected (as listed in carrier-run.json) and only run the hosts that failed, timed out or are new (default: False).",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="Copy new and growing files back while the script runs instead of all at once when it exits, into --live-dir where they can be watched. Runs every host in a single session (default: False).",
+    )
+    parser.add_argument(
+        "--live-dir",
+        default=DEFAULT_LIVE_DIR,
+        help=f"Directory the files of every host are copied to as <host>/<path> with --live (default: {DEFAULT_LIVE_DIR}).",
+    )
+    parser.add_argument(
+        "--live-interval",
+        type=float,
+        default=DEFAULT_LIVE_INTERVAL,
+        help=f"Seconds between two copies of what changed with --live (default: {DEFAULT_LIVE_INTERVAL:g}).",
+    )
+    parser.add_argument(
+        "--sync-start",
+        type=float,
+        metavar="LEAD",
+        help="Copy the script to every host first, then start it everywhere at the same time LEAD seconds after the last host is ready, corrected by the clock offset measured on every host. Every host runs at once, --parallelism does not apply (default: off).",
+    )
+    parser.add_argument(
+        "--low-impact",
+        action="store_true",
+        help=f"Run every command on the hosts at the lowest CPU and IO priority (nice 19, idle IO class), copy the files of every host back at --node-bandwidth ({LOW_IMPACT_NODE_BANDWIDTH} Mbit/s unless given) and report the CPU and disk IO the collection used on every host (default: False).",
+    )
+    parser.add_argument(
+        "--node-bandwidth",
+        type=float,
+        metavar="MBIT",
+        help="Mbit/s the files of a single host may come back at (default: no limit).",
+    )
+    parser.add_argument(
+        "--total-bandwidth",
+        type=float,
+        metavar="MBIT",
+        help="Mbit/s the files of all hosts together may come back at, scp copies without --stream each get their share of it split by --transfer-parallelism (default: no limit).",
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        default=DEFAULT_PARALLELISM,
+        help=f"Number of hosts running the script at the same time (default: {DEFAULT_PARALLELISM}).",
+    )
+    parser.add_argument(
+        "--transfer-parallelism",
+        type=int,
+        default=DEFAULT_TRANSFER_PARALLELISM,
+        help=f"Number of hosts copying files back at the same time (default: {DEFAULT_TRANSFER_PARALLELISM}).",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        help="Directory to write per phase timings (carrier-timings.json) and a Chrome trace (carrier-trace.json) to.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds the whole run may take, stragglers are stopped and whatever they wrote so far is collected (default: no limit).",
+    )
+    parser.add_argument(
+        "--phase-timeout",
+        action="append",
+        metavar="PHASE=SECONDS",
+        help="Seconds a single phase (connect, prepare, upload, execute, archive, download, session) may take on each host, can be repeated.",
+    )
     parser.add_argument(
         "--script-args", nargs=argparse.REMAINDER, help="Arguments for the script"
     )
 
-    args = parser.parse_args()
-    args.password = None
-    if not args.use_key:
-        args.password = getpass.getpass("Enter password: ")
-    return args
+    return parser.parse_args(argv)
 
 
 def load_hosts_from_file(hosts_file):
@@ -58,117 +199,598 @@ def load_hosts_from_file(hosts_file):
         return [line.strip() for line in f.readlines()]
 
 
-class Carrier:
+class Carrier(Runner):
+    NODES = "hosts"
+
     def __init__(
-        self, script, hosts, username, password, use_key, shell, script_args=[]
+        self,
+        script,
+        hosts,
+        username,
+        password,
+        use_key,
+        shell,
+        script_args=[],
+        multiplex=False,
+        stream=False,
+        single_session=False,
+        parallelism=DEFAULT_PARALLELISM,
+        transfer_parallelism=DEFAULT_TRANSFER_PARALLELISM,
+        trace_dir=None,
+        timeout=None,
+        phase_timeouts=None,
+        compression=DEFAULT_COMPRESSION,
+        compression_level=None,
+        format=DEFAULT_FORMAT,
+        attachments=None,
+        relay=None,
+        resume=False,
+        live=False,
+        live_dir=DEFAULT_LIVE_DIR,
+        live_interval=DEFAULT_LIVE_INTERVAL,
+        sync_start=None,
+        low_impact=False,
+        node_bandwidth=None,
+        total_bandwidth=None,
+        warm=None,
+        work_dir=None,
+        out=None,
+        err=None,
     ):
-        self.script = script
+        # a daemon keeps the ssh masters open between runs
+        if warm is not None:
+            multiplex = True
+        if relay is not None and not use_key:
+            raise ValueError(
+                "--relay needs --use-key, hosts copy with the forwarded agent"
+            )
+        super().__init__(
+            script,
+            shell,
+            script_args,
+            stream=stream,
+            single_session=single_session,
+            parallelism=parallelism,
+            transfer_parallelism=transfer_parallelism,
+            trace_dir=trace_dir,
+            timeout=timeout,
+            phase_timeouts=phase_timeouts,
+            compression=compression,
+            compression_level=compression_level,
+            format=format,
+            attachments=attachments,
+            resume=resume,
+            live=live,
+            live_dir=live_dir,
+            live_interval=live_interval,
+            sync_start=sync_start,
+            low_impact=low_impact,
+            node_bandwidth=node_bandwidth,
+            total_bandwidth=total_bandwidth,
+            warm=warm,
+            work_dir=work_dir,
+            out=out,
+            err=err,
+        )
         self.hosts = hosts
         self.username = username
         self.password = password
         self.use_key = use_key
-        self.shell = shell
-        self.script_args = script_args
-        self.output_archive = "output.tar.gz"
-        self.log_file = "debug.log"
-        self.log_lock = Lock()
-
-    def run_cmd(self, cmd):
-        with self.log_lock:
-            with open(self.log_file, "a") as log:
-                subprocess.run(
-                    cmd, shell=True, check=True, stdout=log, stderr=subprocess.STDOUT
-                )
+        self.relay = None if relay is None else RelayTree(hosts, relay)
+        self.log_file = work_path(work_dir, "debug.log")
+        self.log_queue = None
+        self.log_writer = None
+        self.multiplex = multiplex
+        self.control_dir = None
+        self.connected_hosts = []
 
-    def ssh_cmd(self, host, cmd):
-        base_cmd = f"ssh -o 'StrictHostKeyChecking no' -o 'UserKnownHostsFile /dev/null' -q {self.username}@{host} "
-        if self.use_key:
-            base_cmd += cmd
+    def log(self, line):
+        # the loop only queues the line so hundreds of chatty hosts never wait on the disk, one writer thread
+        # keeps the lines in order
+        if self.log_writer is None:
+            self.log_queue = queue.SimpleQueue()
+            self.log_writer = Thread(target=self.write_log, daemon=True)
+            self.log_writer.start()
+        self.log_queue.put(line)
+
+    def write_log(self):
+        with open(self.log_file, "a") as f:
+            while True:
+                lines = [self.log_queue.get()]
+                # whatever queued up while the last batch was written goes out in one write
+                while True:
+                    try:
+                        lines.append(self.log_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                f.write("".join(line for line in lines if line is not None))
+                f.flush()
+                if lines[-1] is None:
+                    return
+
+    def close_log(self):
+        """waits until everything logged is in debug.log"""
+        if self.log_writer is not None:
+            self.log_queue.put(None)
+            self.log_writer.join()
+            self.log_writer = None
+
+    def log_lines(self, host):
+        # every line of output is prefixed with the host so the merged debug.log stays readable
+        prefix = f"[{host}] " if host else ""
+        return lambda text: self.log(
+            "".join(prefix + line for line in text.splitlines(keepends=True))
+        )
+
+    def command_log(self, host, phase):
+        # with --low-impact every remote command ends by reporting what it used, which is picked out of its output
+        log = self.log_lines(host)
+        if not self.low_impact:
+            return log
+        return self.usage.watch(host, phase, log)
+
+    async def run_cmd(self, argv, host=None, phase=None):
+        timeout = None if phase is None else self.deadline.check(phase)
+        await self.engine.run(
+            argv, self.command_log(host, phase), timeout=timeout, phase=phase
+        )
+
+    async def read_cmd(self, argv, host, phase=None):
+        """runs argv and returns its output as text, for short listings read by the loop itself"""
+        timeout = None if phase is None else self.deadline.check(phase)
+        output = await self.engine.output(
+            argv, self.command_log(host, phase), timeout, phase
+        )
+        return output.decode("utf-8", errors="replace")
+
+    async def run_stream_cmd(self, argv, host, consume, stdin=None, phase=None):
+        timeout = None if phase is None else self.deadline.check(phase)
+        # stdout carries the data so only stderr ends up in the log, and it is read no faster than the bandwidth limits
+        return await self.engine.stream(
+            argv,
+            self.command_log(host, phase),
+            self.throttle.consume(consume),
+            stdin,
+            timeout,
+            phase,
+        )
+
+    def ssh_options(self):
+        options = list(SSH_OPTIONS)
+        if self.relay is not None:
+            # hosts copy files to each other with the key of the local agent
+            options += ["-o", "ForwardAgent yes"]
+        if self.warm is not None:
+            options += self.warm.connections.options()
+        elif self.multiplex:
+            # %C is a hash of the connection details which keeps the socket path short
+            options += ["-o", f"ControlPath {self.control_dir}/%C"]
+        return options
+
+    async def open_connection(self, host):
+        destination = f"{self.username}@{host}"
+        persist = "yes"
+        if self.warm is not None:
+            persist = self.warm.connections.persist
+            if destination in self.warm.connections.open:
+                # the master of an earlier run is reused as long as it is still up
+                check_cmd = ["ssh", *self.ssh_options(), "-q", "-O", "check"]
+                try:
+                    with self.trace.phase(host, "connect", warm=True):
+                        await self.run_cmd(check_cmd + [destination], host, "connect")
+                    return
+                except subprocess.CalledProcessError:
+                    self.warm.connections.open.discard(destination)
+        elif self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="carrier-")
+        # the master goes to the background once authenticated and every later ssh and scp to this host reuses it
+        open_cmd = [
+            "ssh",
+            *self.ssh_options(),
+            "-o",
+            "ControlMaster yes",
+            "-o",
+            f"ControlPersist {persist}",
+            "-q",
+            "-N",
+            "-f",
+            destination,
+        ]
+        with self.trace.phase(host, "connect"):
+            await self.run_cmd(open_cmd, host, "connect")
+        if self.warm is not None:
+            self.warm.connections.open.add(destination)
         else:
-            base_cmd += f' -t "echo {self.password} | sudo -S {cmd}"'
-        return base_cmd
+            self.connected_hosts.append(host)
+
+    async def close_connections(self):
+        hosts = self.connected_hosts
+        self.connected_hosts = []
+        slots = asyncio.Semaphore(self.parallelism)
+
+        async def close(host):
+            close_cmd = ["ssh", *self.ssh_options(), "-q", "-O", "exit"]
+            async with slots:
+                try:
+                    await self.run_cmd(close_cmd + [f"{self.username}@{host}"], host)
+                except subprocess.CalledProcessError as e:
+                    self.log(f"[{host}] closing connection failed due to error {e}\n")
+
+        await asyncio.gather(*(close(host) for host in hosts))
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def ssh_cmd(self, host, cmd, tty=True):
+        """the argv running the shell command cmd on host, ssh hands it to the shell of the host as it is"""
+        argv = ["ssh", *self.ssh_options(), "-q", f"{self.username}@{host}"]
+        if not self.use_key:
+            # a tty would mangle binary output so streaming commands ask for none
+            argv.append("-t" if tty else "-T")
+            cmd = f"echo {self.password} | sudo -S {cmd}"
+        if self.low_impact:
+            cmd = low_impact_cmd(cmd)
+        return argv + [cmd]
 
     def scp_write_cmd(self, src, dest):
-        return f"scp -q -o 'StrictHostKeyChecking no' -o 'UserKnownHostsFile /dev/null' {src} {self.username}@{dest}"
+        return ["scp", "-q", *self.ssh_options(), src, f"{self.username}@{dest}"]
 
     def scp_read_cmd(self, src, dest):
-        return f"scp -q -o 'StrictHostKeyChecking no' -o 'UserKnownHostsFile /dev/null' {self.username}@{src} {dest}"
+        limit = []
+        if self.throttle:
+            # scp can only be capped up front, in Kbit/s
+            limit = [
+                "-l",
+                str(self.throttle.kbit_per_transfer(self.transfer_parallelism)),
+            ]
+        return [
+            "scp",
+            "-q",
+            *limit,
+            *self.ssh_options(),
+            f"{self.username}@{src}",
+            dest,
+        ]
 
-    def run_script_on_host(self, host):
-        host_tmp_dir = f"{host}_tmp"
-        create_tmp_dir_cmd = self.ssh_cmd(host, f"mkdir -p {host_tmp_dir}")
-        self.run_cmd(create_tmp_dir_cmd)
+    def save_node_archive(self, host, phase):
+        def save(stdout):
+            with open(self.local_archive(host), "wb") as f:
+                shutil.copyfileobj(stdout, f)
+            phase["bytes"] = file_size(self.local_archive(host))
 
-        copy_script_cmd = self.scp_write_cmd(
-            self.script, f"{host}:{host_tmp_dir}/{Path(self.script).name}"
-        )
-        self.run_cmd(copy_script_cmd)
+        return save
+
+    async def upload_artifacts(self, host, artifacts, *dirs):
+        """copies only the artifacts missing from the cache of the host, returns the command linking them into dirs[0]"""
+        with self.trace.phase(host, "prepare"):
+            listing = await self.read_cmd(
+                self.ssh_cmd(host, list_cmd(SSH_CACHE_DIR, *dirs), tty=False),
+                host,
+                phase="prepare",
+            )
+        uploads = missing(artifacts, listing)
+        relayed = await self.relay_artifacts(host, uploads)
+        local = [a for a in uploads if a not in relayed]
+        with self.trace.phase(
+            host,
+            "upload",
+            bytes=sum(a.size for a in local),
+            cached=len(artifacts) - len(uploads),
+        ):
+            for artifact in local:
+                copy_cmd = self.scp_write_cmd(
+                    artifact.path, f"{host}:{part_path(SSH_CACHE_DIR, artifact, host)}"
+                )
+                await self.run_cmd(copy_cmd, host, "upload")
+            if self.relay is not None and uploads:
+                # other hosts copy from this cache, so the files go into it right away instead of right before the script runs
+                publish = self.ssh_cmd(host, publish_cmd(SSH_CACHE_DIR, uploads, host))
+                await self.run_cmd(publish, host, "upload")
+        if self.relay is None:
+            return install_cmd(dirs[0], SSH_CACHE_DIR, artifacts, uploads, host)
+        self.relay.ready(host)
+        return install_cmd(dirs[0], SSH_CACHE_DIR, artifacts, [], host)
 
+    async def relay_artifacts(self, host, uploads):
+        """copies the uploads from the cache of the closest ancestor holding them, returns what it copied"""
+        if self.relay is None or not uploads:
+            return []
+        source = await self.relay.source(host, self.deadline.limit("upload"))
+        if source is None:
+            return []
+        with self.trace.phase(
+            host, "relay", bytes=sum(a.size for a in uploads), source=source
+        ):
+            try:
+                for artifact in uploads:
+                    # runs on the source host which reaches this one with the forwarded agent
+                    copy_cmd = self.ssh_cmd(
+                        source,
+                        f"scp -q {shlex.join(SSH_OPTIONS)} {SSH_CACHE_DIR}/{artifact.digest} {self.username}@{host}:{part_path(SSH_CACHE_DIR, artifact, host)}",
+                    )
+                    await self.run_cmd(copy_cmd, host, "upload")
+            except (PhaseTimeout, subprocess.CalledProcessError) as e:
+                self.log(
+                    f"[{host}] copying from {source} failed due to error {e}, copying from here instead\n"
+                )
+                return []
+        return uploads
+
+    async def run_single_session_on_host(self, host):
+        with open(self.script, "rb") as f:
+            script = f.read()
         # Check args has some content to avoid error
         # "TypeError: can only join an iterable"
         if self.script_args:
             script_args_str = " ".join(self.script_args)
         else:
             script_args_str = ""
-        run_script_cmd = self.ssh_cmd(
-            host,
-            f'"cd {host_tmp_dir} ; {self.shell} {Path(self.script).name} {script_args_str}"',
+        install = None
+        if self.attachments:
+            # the script comes on stdin, the attached files go through the cache before the session starts
+            artifacts = self.load_artifacts(*self.attachments)
+            install = await self.upload_artifacts(host, artifacts, f"{host}_tmp")
+        timeout = self.deadline.check("execute")
+        remote_cmd = bootstrap_cmd(
+            f"{host}_tmp",
+            Path(self.script).name,
+            self.shell,
+            script_args_str,
+            len(script),
+            timeout,
+            self.compression,
+            self.compression_level,
+            install,
+            [Path(a).name for a in self.attachments],
+            self.live_interval if self.live else None,
         )
-        self.run_cmd(run_script_cmd)
+        if self.use_key:
+            stdin = script
+        else:
+            # sudo reads the password up to the first newline and leaves the script on stdin for the bootstrap
+            remote_cmd = f"sudo -S -p '' {remote_cmd}"
+            stdin = f"{self.password}\n".encode("utf-8") + script
+        if self.low_impact:
+            remote_cmd = low_impact_cmd(remote_cmd)
+        session_cmd = [
+            "ssh",
+            *self.ssh_options(),
+            "-q",
+            "-T",
+            f"{self.username}@{host}",
+            remote_cmd,
+        ]
+        # upload, execute, archive and download all happen inside the one session
+        with self.trace.phase(host, "session", upload_bytes=len(script)) as phase:
+            if self.live:
+                live = LiveFiles(self.live_dir, host)
+                consume = live.consume
+            elif self.stream:
+                consume = self.stream_into_bundle(host, phase)
+            else:
+                consume = self.save_node_archive(host, phase)
+            try:
+                await self.run_stream_cmd(
+                    session_cmd, host, consume, stdin, phase="session"
+                )
+            except subprocess.CalledProcessError as e:
+                if timeout is None or not timed_out_remotely(e):
+                    raise
+                # the bootstrap stopped the script and still sent back what it wrote
+                self.script_timed_out(host, timeout, phase)
+            finally:
+                if self.live:
+                    phase["bytes"] = live.bytes
+                    phase["changes"] = live.changes
+        if self.live:
+            await self.add_live_files(host, live)
 
-        collect_files_cmd = self.ssh_cmd(
-            host,
-            f"tar -czf {host_tmp_dir}/{host}.tar.gz --exclude={host}.tar.gz --exclude={Path(self.script).name} -C {host_tmp_dir}/ .",
-        )
-        self.run_cmd(collect_files_cmd)
+    async def execute_on_host(self, host):
+        try:
+            # hosts still waiting for a slot when the deadline passes are not started at all
+            self.deadline.check("queue")
+            if self.multiplex:
+                await self.open_connection(host)
+            if self.single_session:
+                await self.run_single_session_on_host(host)
+                return
+            host_tmp_dir = f"{host}_tmp"
+            # the script writes into a data directory so the tar.gz of its files is never written to the directory being archived
+            host_data_dir = f"{host_tmp_dir}/data"
+            # the script goes through the cache like every attached file
+            artifacts = self.load_artifacts(self.script, *self.attachments)
+            install = await self.upload_artifacts(host, artifacts, host_data_dir)
 
-        copy_back_cmd = self.scp_read_cmd(
-            f"{host}:{host_tmp_dir}/{host}.tar.gz", f"{host}.tar.gz"
-        )
-        self.run_cmd(copy_back_cmd)
+            # Check args has some content to avoid error
+            # "TypeError: can only join an iterable"
+            if self.script_args:
+                script_args_str = " ".join(self.script_args)
+            else:
+                script_args_str = ""
+            start_at = ""
+            until_start = 0
+            if self.start_barrier is not None:
+                start_at, until_start = await self.wait_for_start(
+                    host, await self.measure_clock(host)
+                )
+            # the script is stopped on the host itself, killing ssh alone could leave it running
+            timeout = self.deadline.check("execute")
+            remote = remote_timeout(None if timeout is None else timeout - until_start)
+            run_script_cmd = self.ssh_cmd(
+                host,
+                f"{install} && cd {host_data_dir} && {start_at}{remote}{self.shell} {Path(self.script).name} {script_args_str}",
+            )
+            with self.trace.phase(host, "execute") as phase:
+                try:
+                    await self.run_cmd(run_script_cmd, host, "execute")
+                except (PhaseTimeout, subprocess.CalledProcessError) as e:
+                    if not isinstance(e, PhaseTimeout) and not (
+                        timeout is not None and timed_out_remotely(e)
+                    ):
+                        raise
+                    # keep going so whatever the script wrote so far is still collected
+                    self.script_timed_out(host, timeout, phase)
+
+            if not self.stream:
+                # the login shell of the host may be any shell and sudo takes a single command
+                collect_files_cmd = self.ssh_cmd(
+                    host,
+                    "sh -c "
+                    + shlex.quote(
+                        tar_cmd(
+                            self.compression,
+                            self.compression_level,
+                            f"{host_tmp_dir}/{archive_name(host, self.compression)}",
+                            f"{host_data_dir}/",
+                            self.excluded_names(),
+                        )
+                    ),
+                )
+                with self.trace.phase(host, "archive"):
+                    await self.run_cmd(collect_files_cmd, host, "archive")
+        finally:
+            # hosts waiting on this one for their files move on even when it failed
+            if self.relay is not None:
+                self.relay.release(host)
+            if self.start_barrier is not None:
+                self.start_barrier.leave(host)
+
+    async def measure_clock(self, host):
+        # the probe needs no sudo and its output is read as it arrives, so it gets its own plain ssh
+        probe_cmd = [
+            "ssh",
+            *self.ssh_options(),
+            "-q",
+            "-T",
+            f"{self.username}@{host}",
+            CLOCK_PROBE,
+        ]
+        probe = ClockProbe()
+        with self.trace.phase(host, "clock") as phase:
+            timeout = self.deadline.check("prepare")
+            # the loop reads the lines itself so every sample is timed the moment it arrives
+            await self.engine.lines(
+                probe_cmd, self.log_lines(host), probe.receive, timeout, "prepare"
+            )
+            phase["offset"] = probe.offset()
+        return probe.offset()
 
-    def run(self):
-        threads = []
-        for host in self.hosts:
-            self.feedback(f"working with {host}")
-            t = Thread(target=self.run_script_on_host, args=(host,))
-            t.start()
-            threads.append(t)
+    async def collect_from_host(self, host, executed=None):
+        if self.single_session:
+            # the single session already brought the files back
+            return
+        host_tmp_dir = f"{host}_tmp"
+        if self.stream:
+            # tar writes to stdout and the members go straight into the final archive
+            stream_files_cmd = self.ssh_cmd(
+                host,
+                "sh -c "
+                + shlex.quote(
+                    tar_cmd(
+                        self.compression,
+                        self.compression_level,
+                        "-",
+                        f"{host_tmp_dir}/data/",
+                        self.excluded_names(),
+                    )
+                ),
+                tty=False,
+            )
+            # archiving on the host and downloading are one phase when streaming
+            with self.trace.phase(host, "download") as phase:
+                await self.run_stream_cmd(
+                    stream_files_cmd,
+                    host,
+                    self.stream_into_bundle(host, phase),
+                    phase="download",
+                )
+        else:
+            copy_back_cmd = self.scp_read_cmd(
+                f"{host}:{host_tmp_dir}/{archive_name(host, self.compression)}",
+                self.local_archive(host),
+            )
+            with self.trace.phase(host, "download") as phase:
+                await self.run_cmd(copy_back_cmd, host, "download")
+                phase["bytes"] = file_size(self.local_archive(host))
+
+    async def run_script_on_host(self, host):
+        await self.execute_on_host(host)
+        await self.collect_from_host(host)
 
-        for t in threads:
-            t.join()
+    async def get_nodes(self):
+        return self.hosts
 
-        with tarfile.open(self.output_archive, "w:gz") as big_archive:
-            for host in self.hosts:
-                big_archive.add(f"{host}.tar.gz", arcname=f"{host}.tar.gz")
-                os.remove(f"{host}.tar.gz")
+    def steps(self):
+        return self.execute_on_host, self.collect_from_host
 
-        return f"All done! The final archive is {self.output_archive}"
+    def failure(self, host, task):
+        try:
+            task.result()
+        except Exception as e:
+            self.manifest.failed(host, e)
+            return f"{host} failed due to error {e}"
+        return None
+
+    async def close_sessions(self):
+        await self.close_connections()
+        # the lines still queued are written before the run ends, without holding up the loop
+        await self.engine.call(self.close_log)
 
     def feedback(self, fb_string):
         fb_output = f"progress: {fb_string}"
-        print(fb_output)
+        print(fb_output, file=self.out)
 
 
-def main():
-    args = parse_arguments()
-
+def runner_from_args(args, password=None, warm=None, work_dir=None, out=None, err=None):
     if args.hosts:
         hosts = args.hosts.split(",")
     elif args.hosts_file:
-        hosts = load_hosts_from_file(args.hosts_file)
+        hosts = load_hosts_from_file(work_path(work_dir, args.hosts_file))
     else:
         raise ValueError("Either --hosts or --hosts-file must be provided.")
 
-    runner = Carrier(
+    return Carrier(
         args.script,
         hosts,
         args.username,
-        args.password,
+        password,
         args.use_key,
         args.shell,
         args.script_args,
+        args.multiplex,
+        args.stream,
+        args.single_session,
+        args.parallelism,
+        args.transfer_parallelism,
+        args.trace_dir,
+        args.timeout,
+        parse_phase_timeouts(args.phase_timeout),
+        args.compression,
+        args.compression_level,
+        args.format,
+        args.attach,
+        args.relay,
+        args.resume,
+        args.live,
+        args.live_dir,
+        args.live_interval,
+        args.sync_start,
+        args.low_impact,
+        args.node_bandwidth,
+        args.total_bandwidth,
+        warm,
+        work_dir,
+        out,
+        err,
     )
+
+
+def main():
+    args = parse_arguments()
+    password = None
+    if not args.use_key:
+        password = getpass("Enter password: ")
+    runner = runner_from_args(args, password)
     result = runner.run()
     print(result)
 
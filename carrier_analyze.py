@@ -0,0 +1,402 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import concurrent.futures
+import csv
+import fnmatch
+import os
+import re
+
+DEFAULT_ANALYSIS_DIR = "analysis"
+# the names scripts/collect-metrics.sh gives the jstack and sjk ttop logs
+DEFAULT_THREAD_DUMPS = "*thread-dump*"
+DEFAULT_TTOP = "*ttop*"
+DEFAULT_DEPTH = 10
+# files are cut into pieces of about this size between two dumps, a few GB of logs keep every worker busy
+PIECE_SIZE = 8 * 1024 * 1024
+# how many pieces wait for a worker at most, each one is held in memory until it is parsed
+PENDING_PER_WORKER = 2
+
+HOT_STACKS_FILE = "hot-stacks.csv"
+THREAD_SERIES_FILE = "thread-series.csv"
+LOCK_CHAINS_FILE = "lock-chains.csv"
+HOT_STACKS_COLUMNS = ["samples", "nodes", "state", "example_thread", "stack"]
+THREAD_SERIES_COLUMNS = [
+    "node",
+    "file",
+    "time",
+    "tid",
+    "thread",
+    "user_cpu",
+    "sys_cpu",
+    "alloc_bytes_per_second",
+]
+LOCK_CHAINS_COLUMNS = [
+    "node",
+    "file",
+    "dump",
+    "time",
+    "lock",
+    "lock_class",
+    "waiters",
+    "waiting_threads",
+    "owner",
+    "owner_state",
+    "owner_frame",
+    "chain",
+    "deadlock",
+]
+
+# jstack prints the time of the dump on the line before it
+DUMP_TIME = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+DUMP_START = b"Full thread dump"
+DUMP_TIME_LINE = re.compile(rb"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\r?")
+LOCK = re.compile(r"<(0x[0-9a-f]+)> \(a ([^)]+)\)")
+# a lock the thread can not go on without, `waiting on` is Object.wait() which gave its monitor up
+WAITS = ("- waiting to lock ", "- waiting to re-lock ", "- parking to wait for ")
+
+TTOP_START = b" Process summary"
+TTOP_SUMMARY = re.compile(r"(\S+) Process summary")
+TTOP_THREAD = re.compile(
+    r"\[(\d+)\] user=\s*(-?[\d.]+)% sys=\s*(-?[\d.]+)% alloc=\s*([\d.]+)([kmgt]?b)/s - (.*)"
+)
+UNITS = {"b": 1, "kb": 2**10, "mb": 2**20, "gb": 2**30, "tb": 2**40}
+
+
+def split_records(reader, start, lead=None, size=PIECE_SIZE):
+    """yields (piece, records) of about size bytes read from reader, every piece ends where a record starts
+
+    a record starts with the line holding the bytes start, lead matches a line before it that belongs to the
+    record too (e.g. the time of a thread dump). records is how many records start in the piece, so they can be
+    numbered across pieces
+    """
+    buffer = b""
+    starts = []
+    while True:
+        data = reader.read(size)
+        # a start cut in two by the last read is found again, the starts seen already are skipped
+        scan_from = max(len(buffer) - len(start), 0)
+        buffer += data
+        # searched for as plain bytes, a regex anchored to every line is several times slower on GBs of dumps
+        found = buffer.find(start, scan_from)
+        while found >= 0:
+            line = buffer.rfind(b"\n", 0, found) + 1
+            if not starts or line > starts[-1]:
+                starts.append(line)
+            found = buffer.find(start, found + len(start))
+        if not data:
+            if buffer:
+                yield buffer, len(starts)
+            return
+        # a piece holds at least one whole record, whatever comes before the first one goes with it
+        if len(buffer) < size or len(starts) < 2:
+            continue
+        cut = starts[-1]
+        if lead is not None:
+            previous = buffer.rfind(b"\n", 0, cut - 1) + 1
+            if lead.fullmatch(buffer, previous, cut - 1):
+                cut = previous
+        if cut == 0:
+            continue
+        yield buffer[:cut], len(starts) - 1
+        buffer = buffer[cut:]
+        starts = [starts[-1] - cut]
+
+
+class Thread:
+    def __init__(self, name):
+        self.name = name
+        self.state = None
+        self.frames = []
+        self.waiting = None
+        self.waiting_on = set()
+        self.held = {}
+
+
+def parse_dumps(text):
+    """yields (time, threads) of every `jstack -l` dump in text"""
+    time = ""
+    threads = None
+    thread = None
+    synchronizers = False
+    for line in text.splitlines():
+        # most lines are frames, they are taken before anything else is looked at
+        if line.startswith("\tat "):
+            if thread is not None:
+                thread.frames.append(line[4:])
+            continue
+        if line[:1].isdigit() and DUMP_TIME.fullmatch(line.rstrip()):
+            time = line.rstrip()
+            continue
+        if line.startswith("Full thread dump"):
+            if threads is not None:
+                yield dump_time, threads
+            threads = []
+            dump_time = time
+            thread = None
+            continue
+        if threads is None:
+            continue
+        if line.startswith('"'):
+            thread = Thread(line[1 : line.rfind('"')])
+            threads.append(thread)
+            synchronizers = False
+            continue
+        if thread is None:
+            continue
+        line = line.strip()
+        if line.startswith("at "):
+            thread.frames.append(line[3:])
+        elif line.startswith("java.lang.Thread.State: "):
+            thread.state = line.split()[1]
+        elif line.startswith("- locked ") or (synchronizers and line.startswith("- <")):
+            lock = LOCK.search(line)
+            if lock is not None:
+                thread.held[lock.group(1)] = lock.group(2)
+        elif line.startswith("- waiting on "):
+            lock = LOCK.search(line)
+            if lock is not None:
+                thread.waiting_on.add(lock.group(1))
+        elif line.startswith(WAITS):
+            lock = LOCK.search(line)
+            if lock is not None and thread.waiting is None:
+                thread.waiting = (lock.group(1), lock.group(2))
+        elif line == "Locked ownable synchronizers:":
+            synchronizers = True
+    if threads is not None:
+        yield dump_time, threads
+
+
+def lock_chains(threads):
+    """one row for every lock a thread waits for while another one holds it, following the owner to what it waits for"""
+    owners = {}
+    for thread in threads:
+        # a thread in Object.wait() still lists the monitor it gave up as locked
+        for lock in thread.held:
+            if lock not in thread.waiting_on:
+                owners[lock] = thread
+    waiters = {}
+    for thread in threads:
+        if thread.waiting is not None and thread.waiting[0] in owners:
+            waiters.setdefault(thread.waiting, []).append(thread)
+    rows = []
+    for (lock, lock_class), waiting in waiters.items():
+        owner = owners[lock]
+        chain = [owner]
+        deadlock = False
+        while chain[-1].waiting is not None and chain[-1].waiting[0] in owners:
+            next_owner = owners[chain[-1].waiting[0]]
+            if next_owner in chain:
+                deadlock = True
+                chain.append(next_owner)
+                break
+            chain.append(next_owner)
+        rows.append(
+            {
+                "lock": lock,
+                "lock_class": lock_class,
+                "waiters": len(waiting),
+                "waiting_threads": ";".join(t.name for t in waiting[:3]),
+                "owner": owner.name,
+                "owner_state": owner.state or "",
+                "owner_frame": owner.frames[0] if owner.frames else "",
+                "chain": " -> ".join(t.name for t in chain),
+                "deadlock": deadlock,
+            }
+        )
+    return rows
+
+
+def analyze_dumps(node, file, text, first, depth):
+    """the stacks and lock chains of the dumps in text, numbered from first"""
+    stacks = {}
+    locks = []
+    dumps = 0
+    for index, (time, threads) in enumerate(parse_dumps(text), first):
+        dumps += 1
+        for thread in threads:
+            # GC and compiler threads have no Java frames
+            if not thread.frames:
+                continue
+            key = (thread.state or "", ";".join(thread.frames[:depth]))
+            if key in stacks:
+                stacks[key][0] += 1
+            else:
+                stacks[key] = [1, thread.name]
+        for row in lock_chains(threads):
+            locks.append(
+                {"node": node, "file": file, "dump": index, "time": time, **row}
+            )
+    return {"stacks": stacks, "locks": locks, "dumps": dumps}
+
+
+def analyze_ttop(node, file, text):
+    """the rows of every thread in every sample of an sjk ttop log"""
+    time = ""
+    series = []
+    for line in text.splitlines():
+        thread = TTOP_THREAD.match(line)
+        if thread is None:
+            summary = TTOP_SUMMARY.match(line)
+            if summary is not None:
+                time = summary.group(1)
+            continue
+        tid, user, system, alloc, unit, name = thread.groups()
+        series.append(
+            [
+                node,
+                file,
+                time,
+                int(tid),
+                name,
+                float(user),
+                float(system),
+                round(float(alloc) * UNITS[unit]),
+            ]
+        )
+    return {"series": series}
+
+
+def analyze_piece(kind, node, file, piece, first, depth):
+    """runs in a worker process, only the small summary of the piece goes back"""
+    text = piece.decode("utf-8", errors="replace")
+    if kind == "dumps":
+        return analyze_dumps(node, file, text, first, depth)
+    return analyze_ttop(node, file, text)
+
+
+class Summary:
+    """the results of every piece merged as they come back, the rows are written to the CSV files right away"""
+
+    def __init__(self, out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.stacks = {}
+        self.files = set()
+        self.nodes = set()
+        self.dumps = 0
+        self.samples = 0
+        self.chains = 0
+        self.deadlocks = 0
+        self.handles = []
+        self.series = self.writer(THREAD_SERIES_FILE, THREAD_SERIES_COLUMNS)
+        self.locks = csv.DictWriter(
+            self.open(LOCK_CHAINS_FILE), fieldnames=LOCK_CHAINS_COLUMNS
+        )
+        self.locks.writeheader()
+
+    def open(self, name):
+        handle = open(os.path.join(self.out_dir, name), "w", newline="")
+        self.handles.append(handle)
+        return handle
+
+    def writer(self, name, columns):
+        writer = csv.writer(self.open(name))
+        writer.writerow(columns)
+        return writer
+
+    def add(self, node, result):
+        self.nodes.add(node)
+        for key, (samples, example) in result.get("stacks", {}).items():
+            if key in self.stacks:
+                merged = self.stacks[key]
+                merged[0] += samples
+                merged[1].add(node)
+            else:
+                self.stacks[key] = [samples, {node}, example]
+        self.dumps += result.get("dumps", 0)
+        for row in result.get("locks", []):
+            self.chains += 1
+            self.deadlocks += row["deadlock"]
+            self.locks.writerow(row)
+        self.samples += len(result.get("series", []))
+        self.series.writerows(result.get("series", []))
+
+    def hot_stacks(self):
+        """(samples, nodes, state, example thread, stack) from the most samples down"""
+        rows = [
+            (samples, len(nodes), state, example, stack)
+            for (state, stack), (samples, nodes, example) in self.stacks.items()
+        ]
+        rows.sort(key=lambda row: (-row[0], -row[1], row[4]))
+        return rows
+
+    def close(self):
+        writer = self.writer(HOT_STACKS_FILE, HOT_STACKS_COLUMNS)
+        writer.writerows(self.hot_stacks())
+        for handle in self.handles:
+            handle.close()
+
+
+def kind_of(path, thread_dumps, ttop):
+    name = os.path.basename(path)
+    if fnmatch.fnmatch(name, thread_dumps):
+        return "dumps"
+    if fnmatch.fnmatch(name, ttop):
+        return "ttop"
+    return None
+
+
+def analyze(
+    files,
+    out_dir=DEFAULT_ANALYSIS_DIR,
+    workers=None,
+    depth=DEFAULT_DEPTH,
+    thread_dumps=DEFAULT_THREAD_DUMPS,
+    ttop=DEFAULT_TTOP,
+):
+    """summarizes the thread dumps and ttop logs among files, (entry, reader) pairs as read out of a final archive
+
+    every file is read once as it streams past and cut into pieces between two dumps or samples, which are
+    parsed by a pool of worker processes while the next ones are read. Returns the Summary, its CSV files are in out_dir
+    """
+    summary = Summary(out_dir)
+    workers = workers or os.cpu_count() or 1
+    pending = {}
+
+    def collect(wait):
+        done, _ = concurrent.futures.wait(pending, return_when=wait)
+        for future in done:
+            summary.add(pending.pop(future), future.result())
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for entry, reader in files:
+                kind = kind_of(entry["path"], thread_dumps, ttop)
+                if kind is None:
+                    continue
+                summary.files.add((entry["node"], entry["path"]))
+                start, lead = (
+                    (DUMP_START, DUMP_TIME_LINE)
+                    if kind == "dumps"
+                    else (TTOP_START, None)
+                )
+                first = 0
+                for piece, records in split_records(reader, start, lead):
+                    if len(pending) >= workers * PENDING_PER_WORKER:
+                        collect(concurrent.futures.FIRST_COMPLETED)
+                    future = pool.submit(
+                        analyze_piece,
+                        kind,
+                        entry["node"],
+                        entry["path"],
+                        piece,
+                        first,
+                        depth,
+                    )
+                    pending[future] = entry["node"]
+                    first += records
+            if pending:
+                collect(concurrent.futures.ALL_COMPLETED)
+    finally:
+        summary.close()
+    return summary
@@ -0,0 +1,415 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+import zipfile
+from threading import Lock
+
+from carrier_compress import (
+    DEFAULT_COMPRESSION,
+    EXTENSIONS,
+    archive_name,
+    bundle_options,
+    check_compressor,
+    decompressed,
+    output_name,
+)
+
+DEFAULT_FORMAT = "tar"
+# tar is one compressed stream of nested node archives, zip is flat and every file can be read on its own
+FORMATS = ("tar", "zip")
+INDEX_NAME = "carrier-index.json"
+# node names can hold slashes (cluster/namespace/pod), their tar members carry the node in this pax header
+NODE_HEADER = "CARRIER.node"
+ZIP_CHUNK_SIZE = 1024 * 1024
+# zip can not store times before 1980
+ZIP_MIN_MTIME = 315619200
+# members up to this size are read into memory before taking the lock so small files
+# (thread dumps, logs) from one node never wait on a large file streaming in from another
+BUFFERED_MEMBER_SIZE = 1024 * 1024
+# compressing these again only costs time, they are stored as they are in a zip bundle
+COMPRESSED_SUFFIXES = (".gz", ".tgz", ".zst", ".zip", ".jar", ".bz2", ".xz", ".lz4")
+
+
+def member_name(prefix, name):
+    name = name[2:] if name.startswith("./") else name.lstrip("/")
+    if name in ("", "."):
+        return prefix
+    return f"{prefix}/{name}"
+
+
+def walk_files(path):
+    """(path, path relative to the directory) of every file under a directory, in a stable order"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            yield full, os.path.relpath(full, path)
+
+
+# what reading a final archive that was never closed ends with
+CUT_SHORT_ERRORS = (EOFError, OSError, tarfile.TarError, subprocess.CalledProcessError)
+
+
+def node_archive(name, nodes=None):
+    """(node, compression) of a nested node archive such as host1.tar.gz, None for any other member
+
+    without the nodes of the run only top level archives count, a slash could just as well be a file of a node
+    """
+    for compression, extension in EXTENSIONS.items():
+        if name.endswith(extension):
+            node = name[: -len(extension)]
+            if node in nodes if nodes is not None else "/" not in node:
+                return node, compression
+    return None
+
+
+def member_node(name, is_dir=False, nodes=None):
+    """the node a member of a final archive belongs to, None for the files of the run itself
+
+    with the nodes of the run the longest one the member sits under wins, so nodes can hold slashes
+    """
+    nested = node_archive(name, nodes)
+    if nested is not None:
+        return nested[0]
+    name = name.rstrip("/")
+    if nodes is None:
+        if "/" in name or is_dir:
+            return name.split("/")[0]
+        return None
+    parts = name.split("/")
+    for end in range(len(parts) if is_dir else len(parts) - 1, 0, -1):
+        node = "/".join(parts[:end])
+        if node in nodes:
+            return node
+    return None
+
+
+def open_previous(path):
+    """the members of a tar final archive as they stream past, zstd included"""
+    compression = "zstd" if path.endswith(EXTENSIONS["zstd"]) else "gzip"
+    f = open(path, "rb")
+    try:
+        with decompressed(f, compression) as stream:
+            with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                yield from ((member, tar) for member in tar)
+    finally:
+        f.close()
+
+
+def count_members(path, nodes=None):
+    """how many members of every node made it into a final archive that may have been cut short
+
+    a member only counts once the next header is read, so its data is known to be complete
+    """
+    counts = {}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                node = member_node(info.filename, nodes=nodes)
+                if node is not None:
+                    counts[node] = counts.get(node, 0) + 1
+        return counts
+    pending = None
+    try:
+        for member, _ in open_previous(path):
+            if pending is not None:
+                counts[pending] = counts.get(pending, 0) + 1
+            pending = member_node(member.name, member.isdir(), nodes)
+        if pending is not None:
+            counts[pending] = counts.get(pending, 0) + 1
+    except CUT_SHORT_ERRORS:
+        pass
+    return counts
+
+
+class PaddedReader:
+    """reads exactly size bytes from a member, padding with zeros if the stream ends early
+
+    the member header is already in the bundle by then, so a short member would corrupt everything after it
+    """
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+        self.truncated = False
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b""
+        if not self.truncated:
+            try:
+                data = self.stream.read(size)
+            except (EOFError, OSError, tarfile.TarError):
+                data = b""
+            if len(data) < size:
+                self.truncated = True
+        self.remaining -= size
+        return data + bytes(size - len(data))
+
+
+class Bundle:
+    """The final archive, members can be added from several node threads at the same time."""
+
+    def __init__(self, path, mode="w:gz", compress=None):
+        self.path = path
+        self.compressor = None
+        if compress is None:
+            self.archive = tarfile.open(path, mode)
+        else:
+            # an external compressor (pigz, zstd) uses the other cores while tarfile only writes the stream
+            check_compressor(compress)
+            with open(path, "wb") as f:
+                self.compressor = subprocess.Popen(
+                    compress, shell=True, stdin=subprocess.PIPE, stdout=f
+                )
+            self.archive = tarfile.open(fileobj=self.compressor.stdin, mode="w|")
+        self.lock = Lock()
+
+    def add_file(self, path, arcname, node=None):
+        if node is None or "/" not in node:
+            with self.lock:
+                self.archive.add(path, arcname=arcname)
+            return
+        member = self.archive.gettarinfo(path, arcname)
+        member.pax_headers = {NODE_HEADER: node}
+        with open(path, "rb") as f, self.lock:
+            self.archive.addfile(member, f)
+
+    def add_stream(self, stream, prefix):
+        """copies every member of a tar stream (e.g. the stdout of a remote `tar -czf -`) into the bundle under prefix"""
+        count = 0
+        with tarfile.open(fileobj=stream, mode="r|*") as source:
+            for member in source:
+                member.name = member_name(prefix, member.name)
+                if "/" in prefix:
+                    member.pax_headers = {**member.pax_headers, NODE_HEADER: prefix}
+                data = None
+                if member.isfile():
+                    data = source.extractfile(member)
+                    if member.size <= BUFFERED_MEMBER_SIZE:
+                        data = io.BytesIO(data.read())
+                    else:
+                        data = PaddedReader(data, member.size)
+                with self.lock:
+                    self.archive.addfile(member, data)
+                count += 1
+                if isinstance(data, PaddedReader) and data.truncated:
+                    raise tarfile.ReadError(
+                        f"{member.name} was cut short and padded with zeros"
+                    )
+        return count
+
+    def add_node_archive(self, path, node):
+        """adds the archive of a node as <node> plus its extension, returns the number of members it takes up"""
+        _, compression = node_archive(os.path.basename(path))
+        self.add_file(path, archive_name(node, compression), node)
+        return 1
+
+    def add_directory(self, path, node):
+        """adds every file under path as node/<relative path>, returns how many"""
+        count = 0
+        for full, relative in walk_files(path):
+            self.add_file(full, member_name(node, relative), node)
+            count += 1
+        return count
+
+    def copy_from(self, path, nodes):
+        """copies every member of nodes from an earlier final archive, which may have been cut short after them"""
+        try:
+            for member, source in open_previous(path):
+                if member_node(member.name, member.isdir(), nodes) in nodes:
+                    data = source.extractfile(member) if member.isfile() else None
+                    with self.lock:
+                        self.archive.addfile(member, data)
+        except CUT_SHORT_ERRORS:
+            # count_members only kept nodes whose members all came before the cut
+            pass
+
+    def add_data(self, arcname, data):
+        member = tarfile.TarInfo(arcname)
+        member.size = len(data)
+        member.mtime = time.time()
+        with self.lock:
+            self.archive.addfile(member, io.BytesIO(data))
+
+    def close(self):
+        with self.lock:
+            self.archive.close()
+            if self.compressor is not None:
+                self.compressor.stdin.close()
+                if self.compressor.wait() != 0:
+                    raise subprocess.CalledProcessError(
+                        self.compressor.returncode, self.compressor.args
+                    )
+
+
+class ZipBundle:
+    """A flat zip final archive, the files of every node are unpacked under <node>/ and listed in carrier-index.json
+
+    zip keeps a directory of every member at its end, so a single file can be read without touching the rest
+    """
+
+    def __init__(self, path, compression=DEFAULT_COMPRESSION, level=None):
+        self.path = path
+        self.compression = compression
+        self.compress_type = zipfile.ZIP_DEFLATED
+        self.compress_level = None
+        if compression == "none":
+            self.compress_type = zipfile.ZIP_STORED
+        elif compression in ("gzip", "pigz"):
+            self.compress_level = level
+        self.archive = zipfile.ZipFile(path, "w", allowZip64=True)
+        self.index = []
+        self.lock = Lock()
+
+    def zip_info(self, arcname, mtime):
+        info = zipfile.ZipInfo(arcname, time.localtime(max(mtime, ZIP_MIN_MTIME))[:6])
+        info.external_attr = 0o644 << 16
+        info.compress_type = self.compress_type
+        if arcname.endswith(COMPRESSED_SUFFIXES):
+            info.compress_type = zipfile.ZIP_STORED
+        # ZipFile.open only takes the level from the ZipInfo it is given
+        info._compresslevel = self.compress_level
+        return info
+
+    def write(self, arcname, mtime, data, size=None):
+        """copies size bytes (everything when None) of data into the bundle, returns what the index records"""
+        digest = hashlib.sha256()
+        written = 0
+        info = self.zip_info(arcname, mtime)
+        large = size is not None and size >= zipfile.ZIP64_LIMIT
+        with self.archive.open(info, "w", force_zip64=large) as member:
+            while size is None or written < size:
+                chunk_size = ZIP_CHUNK_SIZE
+                if size is not None:
+                    chunk_size = min(chunk_size, size - written)
+                try:
+                    chunk = data.read(chunk_size)
+                except (EOFError, OSError, tarfile.TarError):
+                    chunk = b""
+                if not chunk:
+                    break
+                digest.update(chunk)
+                member.write(chunk)
+                written += len(chunk)
+        return {"size": written, "mtime": mtime, "sha256": digest.hexdigest()}
+
+    def add_entry(self, node, path, mtime, data, size):
+        arcname = member_name(node, path)
+        with self.lock:
+            entry = self.write(arcname, mtime, data, size)
+            entry = {"node": node, "path": arcname[len(node) + 1 :], **entry}
+            if entry["size"] < size:
+                entry["truncated"] = True
+            self.index.append(entry)
+        return entry
+
+    def add_file(self, path, arcname):
+        with open(path, "rb") as f, self.lock:
+            self.write(arcname, os.path.getmtime(path), f, os.path.getsize(path))
+
+    def add_stream(self, stream, prefix):
+        """unpacks every file of a tar stream into the bundle under prefix, other members have no place in a zip"""
+        count = 0
+        with tarfile.open(fileobj=stream, mode="r|*") as source:
+            for member in source:
+                if not member.isfile():
+                    continue
+                data = source.extractfile(member)
+                if member.size <= BUFFERED_MEMBER_SIZE:
+                    data = io.BytesIO(data.read())
+                entry = self.add_entry(
+                    prefix, member.name, member.mtime, data, member.size
+                )
+                count += 1
+                if entry.get("truncated"):
+                    raise tarfile.ReadError(
+                        f"{prefix}/{entry['path']} was cut short after {entry['size']} bytes"
+                    )
+        return count
+
+    def add_node_archive(self, path, node):
+        """unpacks the archive of a node, returns the number of members it takes up"""
+        compression = self.compression
+        if path.endswith(".tar"):
+            compression = "none"
+        with open(path, "rb") as f, decompressed(f, compression) as members:
+            return self.add_stream(members, node)
+
+    def add_directory(self, path, node):
+        """adds every file under path as node/<relative path>, returns how many"""
+        count = 0
+        for full, relative in walk_files(path):
+            with open(full, "rb") as f:
+                self.add_entry(
+                    node, relative, os.path.getmtime(full), f, os.path.getsize(full)
+                )
+            count += 1
+        return count
+
+    def copy_from(self, path, nodes):
+        """copies every file of nodes from an earlier final archive, hashing them again on the way"""
+        with zipfile.ZipFile(path) as archive:
+            # the index has the exact mtimes, zip only keeps them to two seconds
+            mtimes = {}
+            if INDEX_NAME in archive.NameToInfo:
+                for entry in json.loads(archive.read(INDEX_NAME))["files"]:
+                    mtimes[f"{entry['node']}/{entry['path']}"] = entry["mtime"]
+            for info in archive.infolist():
+                node = member_node(info.filename, nodes=nodes)
+                if node in nodes:
+                    mtime = mtimes.get(
+                        info.filename, time.mktime(info.date_time + (0, 0, -1))
+                    )
+                    with archive.open(info) as data:
+                        self.add_entry(
+                            node,
+                            info.filename[len(node) + 1 :],
+                            mtime,
+                            data,
+                            info.file_size,
+                        )
+
+    def add_data(self, arcname, data):
+        with self.lock:
+            self.write(arcname, time.time(), io.BytesIO(data), len(data))
+
+    def close(self):
+        with self.lock:
+            index = {"files": self.index}
+            self.write(
+                INDEX_NAME,
+                time.time(),
+                io.BytesIO(json.dumps(index, indent=2).encode("utf-8")),
+            )
+            self.archive.close()
+
+
+def bundle_name(name, fmt, compression, stream):
+    if fmt == "zip":
+        return name + ".zip"
+    return output_name(name, compression, stream)
+
+
+def open_bundle(path, fmt, compression, level, stream):
+    if fmt == "zip":
+        return ZipBundle(path, compression, level)
+    return Bundle(path, *bundle_options(compression, level, stream))
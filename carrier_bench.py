@@ -0,0 +1,439 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from carrier_archive import DEFAULT_FORMAT, FORMATS
+from carrier_compress import COMPRESSIONS, DEFAULT_COMPRESSION
+from carrier_sched import DEFAULT_PARALLELISM, DEFAULT_TRANSFER_PARALLELISM
+from carrier_shim import (
+    FAILURE_RATE_ENV,
+    LATENCY_ENV,
+    NODES_ENV,
+    ROOT_ENV,
+    SEED_ENV,
+    TOOLS,
+    is_failing,
+    node_name,
+)
+from carrier_trace import file_size
+
+DEFAULT_NODES = "1,10,100,500,1000,2000"
+# how much faster than in the baseline the wall time of a run may grow with the node count, as a fraction
+DEFAULT_TOLERANCE = 1.0
+SAMPLE_INTERVAL = 0.05
+# short enough for the few seconds a benchmark script runs
+LIVE_INTERVAL = 1.0
+
+# what every simulated node runs, the output file is random so compression cannot hide its size
+SCRIPT = """echo "bench run in $(pwd)" > carrier.log
+head -c {size} /dev/urandom > output.bin
+sleep {seconds}
+"""
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Measure how carrier scales against simulated nodes backed by local directories."
+    )
+    parser.add_argument(
+        "--runners",
+        default="ssh,k8s",
+        help="Comma-separated runners to measure, ssh (carrier.py) and k8s (carrier_k8s.py) (default: ssh,k8s).",
+    )
+    parser.add_argument(
+        "--nodes",
+        default=DEFAULT_NODES,
+        help=f"Comma-separated node counts to measure (default: {DEFAULT_NODES}).",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds every simulated ssh, scp and kubectl call waits before it runs (default: 0).",
+    )
+    parser.add_argument(
+        "--output-size",
+        type=int,
+        default=64 * 1024,
+        help="Bytes of output the script writes on every node (default: 65536).",
+    )
+    parser.add_argument(
+        "--script-seconds",
+        type=float,
+        default=0.0,
+        help="Seconds the script sleeps on every node (default: 0).",
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of nodes that refuse connections (default: 0).",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed picking the failing nodes."
+    )
+    parser.add_argument("--stream", action="store_true", help="Run with --stream.")
+    parser.add_argument(
+        "--single-session", action="store_true", help="Run with --single-session."
+    )
+    parser.add_argument(
+        "--multiplex", action="store_true", help="Run with --multiplex (ssh only)."
+    )
+    parser.add_argument(
+        "--compression",
+        default=DEFAULT_COMPRESSION,
+        choices=COMPRESSIONS,
+        help="Run with --compression (default: gzip).",
+    )
+    parser.add_argument(
+        "--compression-level", type=int, help="Run with --compression-level."
+    )
+    parser.add_argument(
+        "--format",
+        default=DEFAULT_FORMAT,
+        choices=FORMATS,
+        help="Run with --format (default: tar).",
+    )
+    parser.add_argument(
+        "--attach-size",
+        type=int,
+        default=0,
+        help="Bytes of a file attached with --attach to every run (default: none).",
+    )
+    parser.add_argument(
+        "--relay",
+        type=int,
+        metavar="FANOUT",
+        help="Run with --relay (ssh only).",
+    )
+    parser.add_argument(
+        "--live", action="store_true", help="Run with --live (one second interval)."
+    )
+    parser.add_argument(
+        "--sync-start", type=float, metavar="LEAD", help="Run with --sync-start."
+    )
+    parser.add_argument(
+        "--low-impact", action="store_true", help="Run with --low-impact."
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        default=DEFAULT_PARALLELISM,
+        help=f"Number of nodes running the script at the same time (default: {DEFAULT_PARALLELISM}).",
+    )
+    parser.add_argument(
+        "--transfer-parallelism",
+        type=int,
+        default=DEFAULT_TRANSFER_PARALLELISM,
+        help=f"Number of nodes copying files back at the same time (default: {DEFAULT_TRANSFER_PARALLELISM}).",
+    )
+    parser.add_argument("--json", help="File to write the results to as JSON.")
+    parser.add_argument(
+        "--baseline",
+        help="JSON results of an earlier run (see --json), exits non zero when the wall time of a runner grows with the node count faster than it did there, the smallest node count of both is the reference so the speed of the machine cancels out.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"How much faster than in the baseline the wall time may grow, as a fraction of the growth in the baseline (default: {DEFAULT_TOLERANCE:g}, twice as fast).",
+    )
+    return parser.parse_args()
+
+
+def install_shims(bin_dir):
+    shim = os.path.join(os.path.dirname(os.path.abspath(__file__)), "carrier_shim.py")
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" -S "{shim}" {tool} "$@"\n')
+        os.chmod(path, 0o755)
+
+
+def fd_count():
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            pass
+    return None
+
+
+def dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat().st_size
+        except OSError:
+            # node archives come and go while the run is sampled
+            pass
+    return total
+
+
+def peak_rss(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Sampler:
+    """keeps the highest number of open files, threads and local disk usage seen while a run is going"""
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.peak_fds = 0
+        self.peak_threads = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while True:
+            self.peak_fds = max(self.peak_fds, fd_count() or 0)
+            # the sampler itself is left out
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            self.peak_disk = max(self.peak_disk, dir_size(self.work_dir))
+            if self.stopped.wait(SAMPLE_INTERVAL):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def make_runner(runner, script, attachments, nodes, args):
+    if runner == "ssh":
+        from carrier import Carrier
+
+        return Carrier(
+            script,
+            nodes,
+            "bench",
+            None,
+            True,
+            "sh",
+            [],
+            multiplex=args.multiplex,
+            stream=args.stream,
+            single_session=args.single_session,
+            parallelism=args.parallelism,
+            transfer_parallelism=args.transfer_parallelism,
+            compression=args.compression,
+            compression_level=args.compression_level,
+            format=args.format,
+            attachments=attachments,
+            relay=args.relay,
+            live=args.live,
+            live_interval=LIVE_INTERVAL,
+            sync_start=args.sync_start,
+            low_impact=args.low_impact,
+        )
+    from carrier_k8s import CarrierK8s
+
+    return CarrierK8s(
+        script,
+        "default",
+        "app=bench",
+        "sh",
+        [],
+        stream=args.stream,
+        single_session=args.single_session,
+        parallelism=args.parallelism,
+        transfer_parallelism=args.transfer_parallelism,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        format=args.format,
+        attachments=attachments,
+        live=args.live,
+        live_interval=LIVE_INTERVAL,
+        sync_start=args.sync_start,
+        low_impact=args.low_impact,
+    )
+
+
+def run_scenario(runner, count, args):
+    """runs one benchmark, meant for a fresh process so peak RSS only covers this run"""
+    root = tempfile.mkdtemp(prefix="carrier-bench-")
+    try:
+        bin_dir = os.path.join(root, "bin")
+        nodes_dir = os.path.join(root, "nodes")
+        work_dir = os.path.join(root, "work")
+        for path in (bin_dir, nodes_dir, work_dir):
+            os.makedirs(path)
+        install_shims(bin_dir)
+        nodes = [node_name(i) for i in range(count)]
+        for node in nodes:
+            os.makedirs(os.path.join(nodes_dir, node, "tmp"))
+        script = os.path.join(root, "bench.sh")
+        with open(script, "w") as f:
+            f.write(SCRIPT.format(size=args.output_size, seconds=args.script_seconds))
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        os.environ[ROOT_ENV] = nodes_dir
+        os.environ[NODES_ENV] = str(count)
+        os.environ[LATENCY_ENV] = str(args.latency)
+        os.environ[FAILURE_RATE_ENV] = str(args.failure_rate)
+        os.environ[SEED_ENV] = str(args.seed)
+        attachments = []
+        if args.attach_size:
+            attachments.append(os.path.join(root, "attached.bin"))
+            with open(attachments[0], "wb") as f:
+                f.write(os.urandom(args.attach_size))
+        os.chdir(work_dir)
+        carrier = make_runner(runner, script, attachments, nodes, args)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            with Sampler(work_dir) as sampler:
+                start = time.perf_counter()
+                carrier.run()
+                wall = time.perf_counter() - start
+        archive_bytes = file_size(carrier.output_archive)
+        run = carrier.manifest.to_dict()
+        return {
+            "runner": runner,
+            "nodes": count,
+            "done": run["summary"].get("done", 0),
+            "errors": {
+                node: fields["error"]
+                for node, fields in run["nodes"].items()
+                if "error" in fields
+            },
+            "wall": wall,
+            "peak_rss": peak_rss(resource.RUSAGE_SELF),
+            "peak_fds": sampler.peak_fds,
+            "peak_threads": sampler.peak_threads,
+            "peak_disk": sampler.peak_disk,
+            "archive_bytes": archive_bytes,
+            "upload_bytes": upload_bytes(carrier.trace),
+            "throughput": archive_bytes / wall,
+            # only reported with --low-impact
+            "node_cpu": sum(
+                fields["usage"]["total"]["cpu"]
+                for fields in run["nodes"].values()
+                if "usage" in fields
+            ),
+        }
+    finally:
+        os.chdir("/")
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def upload_bytes(trace):
+    # what left the local machine, copies between nodes are not counted
+    total = 0
+    for event in trace.events:
+        if event["phase"] == "upload":
+            total += event["args"].get("bytes", 0)
+        elif event["phase"] == "session":
+            total += event["args"].get("upload_bytes", 0)
+    return total
+
+
+def benchmark(runner, count, args):
+    # every run gets its own process, PATH and working directory
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(run_scenario, runner, count, args).result()
+
+
+def expected_done(count, args):
+    return sum(
+        1
+        for i in range(count)
+        if not is_failing(node_name(i), args.failure_rate, args.seed)
+    )
+
+
+def regressions(results, baseline, tolerance):
+    """the runs whose wall time grew with the node count faster than the same runner in baseline allows
+
+    every run is compared as a multiple of the smallest node count run by both, which cancels out how fast
+    the machine is, so a baseline recorded on one machine holds on another
+    """
+    walls = {(r["runner"], r["nodes"]): r["wall"] for r in baseline}
+    runs = {}
+    for result in results:
+        if (result["runner"], result["nodes"]) in walls:
+            runs.setdefault(result["runner"], []).append(result)
+    slow = []
+    for runner, compared in runs.items():
+        reference, *larger = sorted(compared, key=lambda r: r["nodes"])
+        for result in larger:
+            growth = result["wall"] / reference["wall"]
+            expected = (
+                walls[(runner, result["nodes"])] / walls[(runner, reference["nodes"])]
+            )
+            limit = expected * (1 + tolerance)
+            if growth > limit:
+                slow.append(
+                    f"{runner} with {result['nodes']} nodes took {growth:.1f} times as long as with {reference['nodes']}, "
+                    f"the baseline took {expected:.1f} times as long and allows {limit:.1f}"
+                )
+    return slow
+
+
+def format_result(result):
+    mb = 1024 * 1024
+    return (
+        f"{result['runner']:<6}{result['nodes']:>7}{result['done']:>7}"
+        f"{result['wall']:>10.2f}{result['peak_rss'] / mb:>10.1f}{result['peak_fds']:>7}{result['peak_threads']:>6}"
+        f"{result['peak_disk'] / mb:>11.1f}{result['archive_bytes'] / mb:>11.1f}"
+        f"{result['throughput'] / mb:>9.1f}{result['upload_bytes'] / mb:>10.1f}"
+    )
+
+
+def main():
+    args = parse_arguments()
+    results = []
+    mismatches = []
+    print(
+        f"{'runner':<6}{'nodes':>7}{'done':>7}{'wall s':>10}{'rss MiB':>10}{'fds':>7}{'thr':>6}"
+        f"{'disk MiB':>11}{'out MiB':>11}{'MiB/s':>9}{'up MiB':>10}"
+    )
+    for runner in args.runners.split(","):
+        for count in [int(n) for n in args.nodes.split(",")]:
+            result = benchmark(runner, count, args)
+            results.append(result)
+            print(format_result(result), flush=True)
+            if result["done"] != expected_done(count, args):
+                mismatches.append(
+                    f"{runner} with {count} nodes collected {result['done']} nodes, expected {expected_done(count, args)}, errors: {result['errors']}"
+                )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            mismatches += regressions(results, json.load(f), args.tolerance)
+    for mismatch in mismatches:
+        print(mismatch)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+import zipfile
+
+from carrier_analyze import (
+    DEFAULT_ANALYSIS_DIR,
+    DEFAULT_DEPTH,
+    DEFAULT_THREAD_DUMPS,
+    DEFAULT_TTOP,
+    HOT_STACKS_FILE,
+    LOCK_CHAINS_FILE,
+    THREAD_SERIES_FILE,
+    analyze,
+)
+from carrier_archive import INDEX_NAME, NODE_HEADER, node_archive
+from carrier_compress import EXTENSIONS, decompressed
+from carrier_manifest import MANIFEST_NAME
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="List, extract and analyze the files collected by carrier.py and carrier_k8s.py."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    ls = commands.add_parser("ls", help="List the files in a final archive.")
+    extract = commands.add_parser(
+        "extract", help="Extract matching files from a final archive."
+    )
+    summarize = commands.add_parser(
+        "analyze",
+        help="Summarize the thread dumps and ttop logs in a final archive without extracting it.",
+    )
+    for command in (ls, extract, summarize):
+        command.add_argument(
+            "bundle", help="The final archive, e.g. output.zip or output.tar.gz."
+        )
+        command.add_argument(
+            "node",
+            nargs="?",
+            default="*",
+            help="Glob matched against the host or pod the files came from (default: *).",
+        )
+        if command is summarize:
+            continue
+        command.add_argument(
+            "pattern",
+            nargs="?",
+            default="*",
+            help="Glob matched against the path of every file and its name, e.g. 'jstack*' (default: *).",
+        )
+    ls.add_argument(
+        "--json", action="store_true", help="Print the index entries as JSON lines."
+    )
+    extract.add_argument(
+        "--dest",
+        default=".",
+        help="Directory the files are extracted to as <node>/<path> (default: .).",
+    )
+    extract.add_argument(
+        "--stdout",
+        action="store_true",
+        help="Write the contents of the files to stdout instead (default: False).",
+    )
+    summarize.add_argument(
+        "--out",
+        default=DEFAULT_ANALYSIS_DIR,
+        help=f"Directory the {HOT_STACKS_FILE}, {THREAD_SERIES_FILE} and {LOCK_CHAINS_FILE} summaries are written to (default: {DEFAULT_ANALYSIS_DIR}).",
+    )
+    summarize.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes parsing the files (default: one per CPU).",
+    )
+    summarize.add_argument(
+        "--depth",
+        type=int,
+        default=DEFAULT_DEPTH,
+        help=f"Frames from the top of every stack that make up a hot stack (default: {DEFAULT_DEPTH}).",
+    )
+    summarize.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="Hot stacks of running threads printed once done (default: 10).",
+    )
+    summarize.add_argument(
+        "--thread-dumps",
+        default=DEFAULT_THREAD_DUMPS,
+        help=f"Glob matched against the names of the jstack logs (default: {DEFAULT_THREAD_DUMPS}).",
+    )
+    summarize.add_argument(
+        "--ttop",
+        default=DEFAULT_TTOP,
+        help=f"Glob matched against the names of the sjk ttop logs (default: {DEFAULT_TTOP}).",
+    )
+    return parser.parse_args()
+
+
+def matches(entry, node, pattern):
+    if not fnmatch.fnmatch(entry["node"], node):
+        return False
+    return fnmatch.fnmatch(entry["path"], pattern) or fnmatch.fnmatch(
+        os.path.basename(entry["path"]), pattern
+    )
+
+
+def split_name(name, node=None):
+    """the node and the path of a member stored as <node>/<path>, None for the files of the run itself
+
+    the node is only known up front when its name holds slashes, otherwise it ends at the first one
+    """
+    if node is not None:
+        return {"node": node, "path": name[len(node) + 1 :]}
+    node, sep, path = name.partition("/")
+    if not sep or not path or name.endswith("/"):
+        return None
+    return {"node": node, "path": path}
+
+
+def zip_index(archive):
+    """the index written by the zip bundle, zips written without one are indexed from their directory"""
+    if INDEX_NAME in archive.NameToInfo:
+        return json.loads(archive.read(INDEX_NAME))["files"]
+    index = []
+    for info in archive.infolist():
+        entry = split_name(info.filename)
+        if entry is not None:
+            entry["size"] = info.file_size
+            entry["mtime"] = time.mktime(info.date_time + (0, 0, -1))
+            index.append(entry)
+    return index
+
+
+def scan_tar(path):
+    """yields (entry, reader) for every file of a tar bundle, nested node archives are read as they stream past
+
+    a tar bundle has no index so everything before a file has to be decompressed to reach it, the reader is
+    only valid until the next file is yielded
+    """
+    compression = "zstd" if path.endswith(EXTENSIONS["zstd"]) else "gzip"
+    with open(path, "rb") as f, decompressed(f, compression) as stream:
+        with tarfile.open(fileobj=stream, mode="r|*") as bundle:
+            for member in bundle:
+                if not member.isfile() or member.name == MANIFEST_NAME:
+                    continue
+                node = member.pax_headers.get(NODE_HEADER)
+                nested = node_archive(member.name, None if node is None else {node})
+                if nested is None:
+                    entry = split_name(member.name, node)
+                    if entry is not None:
+                        entry.update(size=member.size, mtime=member.mtime)
+                        yield entry, bundle.extractfile(member)
+                    continue
+                node, compression = nested
+                with decompressed(
+                    bundle.extractfile(member), compression
+                ) as members, tarfile.open(fileobj=members, mode="r|*") as files:
+                    for file in files:
+                        if file.isfile():
+                            path = (
+                                file.name[2:]
+                                if file.name.startswith("./")
+                                else file.name
+                            )
+                            entry = {
+                                "node": node,
+                                "path": path.lstrip("/"),
+                                "size": file.size,
+                                "mtime": file.mtime,
+                            }
+                            yield entry, files.extractfile(file)
+
+
+def list_files(path, node="*", pattern="*"):
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return [e for e in zip_index(archive) if matches(e, node, pattern)]
+    return [e for e, _ in scan_tar(path) if matches(e, node, pattern)]
+
+
+def safe_path(dest, entry):
+    path = os.path.normpath(os.path.join(entry["node"], entry["path"]))
+    if os.path.isabs(path) or path.split(os.sep)[0] == "..":
+        raise ValueError(f"refusing to extract {path} outside of {dest}")
+    return os.path.join(dest, path)
+
+
+def copy_out(entry, reader, dest, stdout):
+    if stdout:
+        shutil.copyfileobj(reader, sys.stdout.buffer)
+        return "-"
+    target = safe_path(dest, entry)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as f:
+        shutil.copyfileobj(reader, f)
+    return target
+
+
+def read_files(path, node="*", pattern="*"):
+    """yields (entry, reader) for the matching files of a bundle, the reader is only valid until the next one"""
+    if zipfile.is_zipfile(path):
+        # only the matching members are read, everything else in the bundle is skipped through its directory
+        with zipfile.ZipFile(path) as archive:
+            for entry in zip_index(archive):
+                if matches(entry, node, pattern):
+                    with archive.open(f"{entry['node']}/{entry['path']}") as reader:
+                        yield entry, reader
+        return
+    for entry, reader in scan_tar(path):
+        if matches(entry, node, pattern):
+            yield entry, reader
+
+
+def extract_files(path, node="*", pattern="*", dest=".", stdout=False):
+    """extracts the matching files and returns where they were written to"""
+    return [
+        copy_out(entry, reader, dest, stdout)
+        for entry, reader in read_files(path, node, pattern)
+    ]
+
+
+def format_entry(entry):
+    mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["mtime"]))
+    return f"{entry['size']:>12} {mtime} {entry['node']}/{entry['path']}"
+
+
+def print_analysis(summary, bundle, node, top):
+    if not summary.files:
+        sys.stderr.write(f"no thread dumps or ttop logs of {node} in {bundle}\n")
+        sys.exit(1)
+    print(
+        f"{len(summary.files)} files of {len(summary.nodes)} nodes: {summary.dumps} thread dumps,"
+        f" {summary.samples} ttop samples, {summary.chains} blocked locks ({summary.deadlocks} in a deadlock)"
+    )
+    running = [row for row in summary.hot_stacks() if row[2] == "RUNNABLE"][:top]
+    for samples, nodes, _, example, stack in running:
+        # the top frames tell the stacks apart, the whole of them is in the CSV file
+        frames = " < ".join(stack.split(";")[:3])
+        print(f"{samples:>8} {nodes:>4} nodes  {frames}  ({example})")
+    print(f"summaries written to {summary.out_dir}")
+
+
+def main():
+    args = parse_arguments()
+    if args.command == "ls":
+        for entry in list_files(args.bundle, args.node, args.pattern):
+            print(json.dumps(entry) if args.json else format_entry(entry))
+        return
+    if args.command == "analyze":
+        summary = analyze(
+            read_files(args.bundle, args.node),
+            out_dir=args.out,
+            workers=args.workers,
+            depth=args.depth,
+            thread_dumps=args.thread_dumps,
+            ttop=args.ttop,
+        )
+        print_analysis(summary, args.bundle, args.node, args.top)
+        return
+    written = extract_files(
+        args.bundle, args.node, args.pattern, args.dest, args.stdout
+    )
+    if not written:
+        sys.stderr.write(
+            f"no files of {args.node} in {args.bundle} match {args.pattern}\n"
+        )
+        sys.exit(1)
+    if not args.stdout:
+        for path in written:
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+from pathlib import Path
+
+# kept between runs on every node, files are named by the sha256 of their content so a changed file is a new entry
+SSH_CACHE_DIR = ".carrier-cache"
+K8S_CACHE_DIR = "/tmp/.carrier-cache"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Artifact:
+    """a local file that is put next to the script on every node"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = Path(path).name
+        stat = Path(path).stat()
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.digest = file_digest(path)
+
+    def changed(self):
+        """whether the file was written since it was hashed, only a long-lived daemon hashes a path twice"""
+        stat = Path(self.path).stat()
+        return (stat.st_size, stat.st_mtime_ns) != (self.size, self.mtime)
+
+
+def check_names(paths):
+    """the files all land in the same directory so their names have to be unique"""
+    names = [Path(path).name for path in paths]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError(f"more than one file named {name} is attached")
+
+
+def list_cmd(cache_dir, *dirs):
+    """creates the cache (and any other directory given) and lists what the cache already holds"""
+    return f"mkdir -p {' '.join(dirs + (cache_dir,))} && ls -1 {cache_dir}"
+
+
+def missing(artifacts, listing):
+    """the artifacts whose content is not in the cache yet, each content only once"""
+    cached = set(listing.split())
+    result = []
+    for artifact in artifacts:
+        if artifact.digest not in cached:
+            cached.add(artifact.digest)
+            result.append(artifact)
+    return result
+
+
+def part_path(cache_dir, artifact, node):
+    # nodes can share a cache (e.g. a home directory on NFS), so every node uploads under its own name first
+    return f"{cache_dir}/{artifact.digest}.{node}.part"
+
+
+def publish_cmd(cache_dir, uploaded, node):
+    """moves the finished uploads into the cache"""
+    return " && ".join(
+        f"mv -f {part_path(cache_dir, a, node)} {cache_dir}/{a.digest}"
+        for a in uploaded
+    )
+
+
+def install_cmd(data_dir, cache_dir, artifacts, uploaded, node):
+    """moves the finished uploads into the cache and links every artifact into the work dir
+
+    a hard link costs no space, cp covers a work dir on another file system
+    """
+    steps = [publish_cmd(cache_dir, uploaded, node)] if uploaded else []
+    for a in artifacts:
+        cached = f"{cache_dir}/{a.digest}"
+        steps.append(
+            f"(ln -f {cached} {data_dir}/{a.name} 2>/dev/null || cp {cached} {data_dir}/{a.name})"
+        )
+    return " && ".join(steps)
@@ -0,0 +1,102 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# the thin client of carrier_daemon.py, it only uses the standard library so it starts in a few milliseconds
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+from getpass import getpass
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"carrier-{os.getuid()}.sock")
+RUNNERS = {"ssh": "carrier.py", "k8s": "carrier_k8s.py"}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Run carrier.py and carrier_k8s.py collections on a running carrier_daemon.py."
+    )
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help=f"Unix socket the daemon listens on (default: {DEFAULT_SOCKET}).",
+    )
+    parser.add_argument(
+        "command",
+        choices=[*RUNNERS, "status", "stop"],
+        help="ssh runs carrier.py, k8s runs carrier_k8s.py, status shows what the daemon keeps and stop shuts it down.",
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="The arguments of carrier.py or carrier_k8s.py, relative paths are taken from the current directory.",
+    )
+    return parser.parse_args()
+
+
+def send(stream, message):
+    stream.write(json.dumps(message) + "\n")
+    stream.flush()
+
+
+def request(socket_path, message, stdout=None, stderr=None, ask=getpass):
+    """sends message to the daemon and relays what comes back until it exits, returns the exit code
+
+    the output of the run arrives as it is printed, the password is asked for here when the daemon has none
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        stream = sock.makefile("rw", encoding="utf-8")
+        send(stream, message)
+        for line in stream:
+            reply = json.loads(line)
+            if "stdout" in reply:
+                stdout.write(reply["stdout"])
+                stdout.flush()
+            elif "stderr" in reply:
+                stderr.write(reply["stderr"])
+                stderr.flush()
+            elif "password" in reply:
+                send(stream, {"password": ask(reply["password"])})
+            elif "status" in reply:
+                stdout.write(json.dumps(reply["status"], indent=2) + "\n")
+            elif "exit" in reply:
+                return reply["exit"]
+    # the daemon went away in the middle of the run
+    return 1
+
+
+def main():
+    args = parse_arguments()
+    message = {"command": args.command}
+    if args.command in RUNNERS:
+        message.update(command="run", runner=args.command, argv=args.args)
+        message["cwd"] = os.getcwd()
+    try:
+        code = request(args.socket, message)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.stderr.write(
+            f"no carrier daemon is listening on {args.socket}, start one with python carrier_daemon.py\n"
+        )
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # the daemon stops the run once the socket is closed
+        sys.exit(130)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
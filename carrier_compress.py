@@ -0,0 +1,122 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import shutil
+import subprocess
+from contextlib import contextmanager
+from threading import Thread
+
+DEFAULT_COMPRESSION = "gzip"
+# gzip keeps the original behaviour on the node, tar gzips the files there
+COMPRESSIONS = ("gzip", "pigz", "zstd", "none")
+EXTENSIONS = {"gzip": ".tar.gz", "pigz": ".tar.gz", "zstd": ".tar.zst", "none": ".tar"}
+
+
+def compress_cmd(compression, level=None):
+    """the command compressing stdin to stdout, None for none"""
+    if compression == "none":
+        return None
+    cmd = {"gzip": "gzip", "pigz": "pigz", "zstd": "zstd -T0 -q"}[compression]
+    if level is not None:
+        cmd += f" -{level}"
+    return cmd
+
+
+def tar_cmd(compression, level, dest, src_dir, excludes):
+    """the sh command writing a tar of everything in src_dir to dest (- for stdout), compressed on the node
+
+    pigz and zstd run in a pipeline instead of tar -I so the command needs no nested quoting, a pipeline exits
+    with the status of the compressor and sh has no pipefail everywhere, so tar removes a marker file once it
+    succeeded and the command fails when the marker is still there
+    """
+    exclude = "".join(f" --exclude={name}" for name in excludes)
+    if compression == "gzip" and level is None:
+        return f"tar -czf {dest}{exclude} -C {src_dir} ."
+    if compression == "none":
+        return f"tar -cf {dest}{exclude} -C {src_dir} ."
+    output = "" if dest == "-" else f" > {dest}"
+    return (
+        f'{{ t=$(mktemp) && {{ tar -cf -{exclude} -C {src_dir} . && rm "$t"; }}'
+        f' | {compress_cmd(compression, level)}{output} && [ ! -e "$t" ]; }} || {{ rm -f "$t"; false; }}'
+    )
+
+
+def archive_name(name, compression):
+    return name + EXTENSIONS[compression]
+
+
+def bundle_options(compression, level, stream):
+    """(tarfile mode, compress command) of the final archive
+
+    node archives are already compressed so they are stored as they are and only streamed members get
+    compressed, gzip by tarfile in process and pigz or zstd piped behind it
+    """
+    if compression == "none" or not stream:
+        return "w", None
+    if compression == "gzip":
+        return "w:gz", None
+    return "w|", compress_cmd(compression, level)
+
+
+def check_compressor(compress):
+    """fails before the final archive is opened when its compressor is not installed locally"""
+    tool = compress.split()[0]
+    if shutil.which(tool) is None:
+        raise ValueError(
+            f"{tool} is not installed locally, it compresses the final archive"
+        )
+
+
+def output_name(name, compression, stream):
+    mode, compress = bundle_options(compression, None, stream)
+    return name + (".tar" if mode == "w" else EXTENSIONS[compression])
+
+
+def read_into(source, sink):
+    try:
+        shutil.copyfileobj(source, sink)
+    except BrokenPipeError:
+        # the decompressor failed, its exit code tells us why
+        pass
+    finally:
+        try:
+            sink.close()
+        except BrokenPipeError:
+            pass
+
+
+@contextmanager
+def decompressed(stream, compression):
+    """yields stream decompressed, tarfile reads gzip on its own but zstd goes through a local zstd"""
+    if compression != "zstd":
+        yield stream
+        return
+    p = subprocess.Popen(
+        ["zstd", "-d", "-c", "-q"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    # daemon so a stream that never ends can not hold up an exception, the caller kills its source
+    feeder = Thread(target=read_into, args=(stream, p.stdin), daemon=True)
+    feeder.start()
+    try:
+        yield p.stdout
+        # drain what tar left unread (e.g. its padding) so the feeder can finish
+        while p.stdout.read(65536):
+            pass
+        feeder.join()
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, "zstd -d")
@@ -0,0 +1,308 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import socket
+import traceback
+
+import carrier
+import carrier_k8s
+from carrier_client import DEFAULT_SOCKET
+from carrier_engine import run_coroutine
+from carrier_warm import DEFAULT_PERSIST_MINUTES, WarmState
+
+RUNNERS = {"ssh": carrier, "k8s": carrier_k8s}
+# a client that stops reading is dropped once this many bytes of the run wait for it, which stops the run
+CLIENT_BUFFER_LIMIT = 16 * 1024 * 1024
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Keep ssh connections, pod listings and hashed scripts between collections submitted with carrier_client.py. "
+        "Collections run one at a time, one submitted while another runs waits for it to finish."
+    )
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help=f"Unix socket to listen on, only the user running the daemon can connect (default: {DEFAULT_SOCKET}).",
+    )
+    parser.add_argument(
+        "--persist",
+        type=int,
+        default=DEFAULT_PERSIST_MINUTES,
+        help=f"Minutes an unused ssh connection stays open (default: {DEFAULT_PERSIST_MINUTES}).",
+    )
+    return parser.parse_args()
+
+
+def message(kind, value):
+    return (json.dumps({kind: value}) + "\n").encode("utf-8")
+
+
+class ClientWriter:
+    """sends the output of a run to the client in order, waiting for the client to take every message
+
+    the run writes from the loop without waiting, what the client has not taken yet is queued up to limit bytes
+    """
+
+    def __init__(self, writer, limit=CLIENT_BUFFER_LIMIT):
+        self.writer = writer
+        self.limit = limit
+        self.queue = asyncio.Queue()
+        # queued or written but not drained yet
+        self.pending = 0
+        self.task = asyncio.ensure_future(self.send())
+
+    def put(self, data):
+        if self.writer.is_closing():
+            return
+        self.pending += len(data)
+        if self.pending > self.limit:
+            # the client stopped reading, dropping it stops the run like an interrupt does
+            self.writer.transport.abort()
+            return
+        self.queue.put_nowait(data)
+
+    async def send(self):
+        while True:
+            data = await self.queue.get()
+            if data is None:
+                return
+            try:
+                self.writer.write(data)
+                await self.writer.drain()
+            except ConnectionError:
+                # the client went away, the run notices it on its own
+                pass
+            self.pending -= len(data)
+
+    async def close(self):
+        """waits until everything queued reached the client"""
+        self.queue.put_nowait(None)
+        await self.task
+
+
+class ClientStream:
+    """a text file whose writes go to the client, the runner writes its progress and errors to it"""
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.client.put(message(self.kind, text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def check_request(request):
+    """raises ValueError saying what is wrong with a request that carrier_client.py would not have sent"""
+    if not isinstance(request, dict):
+        raise ValueError("a request is a JSON object")
+    command = request.get("command")
+    if command in ("status", "stop"):
+        return
+    if command != "run":
+        raise ValueError(f"unknown command {command!r}, one of run, status and stop")
+    if request.get("runner") not in RUNNERS:
+        raise ValueError(
+            f"unknown runner {request.get('runner')!r}, one of {', '.join(RUNNERS)}"
+        )
+    argv = request.get("argv")
+    if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+        raise ValueError("the argv of a run is a list of strings")
+    cwd = request.get("cwd")
+    if not isinstance(cwd, str) or not os.path.isabs(cwd) or not os.path.isdir(cwd):
+        raise ValueError(
+            f"the cwd of a run is an existing absolute directory, not {cwd!r}"
+        )
+
+
+def remove_stale_socket(path):
+    """removes a socket left behind by a daemon that is gone, refuses to take over one that is still listening"""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise ValueError(f"a carrier daemon is already listening on {path}")
+
+
+class Daemon:
+    """runs the collections submitted by carrier_client.py on its own event loop
+
+    collections run one at a time, a client submitting one while another runs waits for it. The runner gets
+    the directory of the client and writes to the client itself, the working directory and stdout of the
+    daemon never change. A run skips starting Python, the ssh handshake of every host, listing the pods and hashing the script as
+    long as an earlier run did them already. The password is asked for once per user
+    """
+
+    def __init__(
+        self, socket_path=DEFAULT_SOCKET, persist_minutes=DEFAULT_PERSIST_MINUTES
+    ):
+        self.socket_path = socket_path
+        self.warm = WarmState(persist_minutes)
+        self.passwords = {}
+        self.runs = 0
+        self.lock = None
+        self.stopped = None
+
+    async def serve(self):
+        # created on the loop of the daemon, before 3.10 they bind to the loop current when created
+        self.lock = asyncio.Lock()
+        self.stopped = asyncio.Event()
+        remove_stale_socket(self.socket_path)
+        # it holds the password and open connections of the user, nobody else may use it
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopped.set)
+        print(f"listening on {self.socket_path}", flush=True)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            await self.warm.close(carrier.SSH_OPTIONS)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+
+    def status(self):
+        return {
+            "runs": self.runs,
+            "passwords": len(self.passwords),
+            **self.warm.status(),
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                check_request(request)
+                code = await self.answer(request, reader, writer)
+            except ValueError as e:
+                # something that is not a request, or not a reply to the password prompt, is refused
+                writer.write(
+                    message("stderr", f"the daemon refused the request: {e}\n")
+                )
+                code = 2
+            writer.write(message("exit", code))
+            await writer.drain()
+        except ConnectionError:
+            # the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, request, reader, writer):
+        command = request["command"]
+        if command == "status":
+            writer.write(message("status", self.status()))
+            return 0
+        if command == "stop":
+            self.stopped.set()
+            return 0
+        return await self.run(request, reader, writer)
+
+    async def ask_password(self, reader, writer, username):
+        if username not in self.passwords:
+            writer.write(message("password", f"Enter password of {username}: "))
+            reply = await reader.readline()
+            if not reply:
+                raise ConnectionResetError("the client went away")
+            password = json.loads(reply)
+            if not isinstance(password, dict) or not isinstance(
+                password.get("password"), str
+            ):
+                raise ValueError("the reply to the password prompt holds no password")
+            self.passwords[username] = password["password"]
+        return self.passwords[username]
+
+    async def run(self, request, reader, writer):
+        module = RUNNERS[request["runner"]]
+        client = ClientWriter(writer)
+        try:
+            # runs share the ssh connections, the pod listings and the bandwidth of the host, so they take turns
+            async with self.lock:
+                self.runs += 1
+                return await self.collect(
+                    module, request["argv"], request["cwd"], reader, writer, client
+                )
+        finally:
+            # the exit code goes out after the rest of the output, a slow client does not hold up the next run
+            await client.close()
+
+    async def collect(self, module, argv, work_dir, reader, writer, client):
+        out = ClientStream(client, "stdout")
+        err = ClientStream(client, "stderr")
+        try:
+            args = module.parse_arguments(argv, out, err)
+        except SystemExit as e:
+            # --help or a wrong argument, argparse printed why
+            return e.code if isinstance(e.code, int) else 2
+        options = {}
+        if module is carrier:
+            options["password"] = None
+            if not args.use_key:
+                options["password"] = await self.ask_password(
+                    reader, writer, args.username
+                )
+        options.update(work_dir=work_dir, out=out, err=err)
+        run = asyncio.ensure_future(self.collect_with(module, args, options))
+        # the client closes the socket when it is interrupted, which stops the run
+        gone = asyncio.ensure_future(reader.read())
+        try:
+            await asyncio.wait({run, gone}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            gone.cancel()
+            if not run.done():
+                run.cancel()
+                await asyncio.gather(run, return_exceptions=True)
+        return 130 if run.cancelled() else run.result()
+
+    async def collect_with(self, module, args, options):
+        try:
+            runner = module.runner_from_args(args, warm=self.warm, **options)
+            print(await runner.run_async(), file=options["out"])
+        except Exception:
+            traceback.print_exc(file=options["err"])
+            return 1
+        if options.get("password") is not None:
+            summary = runner.manifest.to_dict()["summary"]
+            if not summary.get("done"):
+                # a wrong password gets no host through, it is asked for again next time
+                self.passwords.pop(args.username, None)
+        return 0
+
+
+def main():
+    args = parse_arguments()
+    daemon = Daemon(args.socket, args.persist)
+    run_coroutine(daemon.serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import codecs
+import concurrent.futures
+import functools
+import os
+import resource
+import subprocess
+import sys
+
+import carrier_sched
+from carrier_sched import PhaseTimeout, kill_process_group
+
+CHUNK_SIZE = 64 * 1024
+# plenty for thousands of nodes with a few pipes each, without asking for an unlimited number
+MAX_OPEN_FILES = 1024 * 1024
+
+
+def raise_open_files_limit():
+    """lifts the soft limit of open files up to the hard one, every running command holds a few pipes"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def watch_children():
+    # before Python 3.12 asyncio waits for every child process on a thread of its own, a pidfd is polled by the loop instead
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(asyncio.get_running_loop())
+    asyncio.get_event_loop_policy().set_child_watcher(watcher)
+
+
+def run_coroutine(main):
+    """runs the coroutine main on a new event loop, the blocking entry point of the runners"""
+
+    async def watched():
+        watch_children()
+        return await main
+
+    raise_open_files_limit()
+    return asyncio.run(watched())
+
+
+async def log_lines(stream, log):
+    # output goes to log a few whole lines at a time as it arrives so a chatty command is never held in memory
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        pending += decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            break
+        end = pending.rfind("\n") + 1
+        # a line longer than a chunk is logged in pieces rather than buffered
+        if end == 0 and len(pending) >= CHUNK_SIZE:
+            end = len(pending)
+        if end:
+            log(pending[:end])
+            pending = pending[end:]
+    if pending:
+        log(pending)
+
+
+async def write_stdin(stdin, data):
+    try:
+        stdin.write(data)
+        await stdin.drain()
+        stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        # the command gave up early, its exit code tells us why
+        pass
+
+
+class Watch:
+    """kills the process group of a command once the timeout (plus some slack) expires, a timer of the loop and no thread
+
+    stop is what ends the command, anything else that runs on the loop (e.g. an exec session of the API) passes its own
+    """
+
+    def __init__(self, process, timeout, stop=kill_process_group):
+        self.process = process
+        self.stop = stop
+        self.fired = False
+        self.handle = None
+        if timeout is not None:
+            self.handle = asyncio.get_running_loop().call_later(
+                max(timeout, 0) + carrier_sched.WATCHDOG_SLACK, self.fire
+            )
+
+    def fire(self):
+        self.fired = True
+        self.stop(self.process)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+
+
+class Engine:
+    """runs the commands of every node on one event loop
+
+    commands are argv lists started without a shell, their pipes are read by the loop and their timeouts are
+    timers of the loop, so a node waiting on a command costs no thread. Only what has to block, a reader
+    unpacking a stream into the final archive or a call of the API backend, goes to a pool of threads that
+    grows with the streams in flight, never with the nodes
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+
+    async def call(self, func, *args, **kwargs):
+        """runs the blocking func on the thread pool"""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="carrier-io"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def shutdown(self):
+        """close from the loop, the threads are waited for on another thread so the other runs of a daemon go on"""
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    async def start(self, argv, stdin, stdout, stderr):
+        # every command gets its own process group so a timeout kills whatever it started too
+        return await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=stderr,
+            start_new_session=True,
+        )
+
+    async def run(self, argv, log, stdin=None, timeout=None, phase=None):
+        """runs argv with stdout and stderr going to log, raises PhaseTimeout or CalledProcessError"""
+        process = await self.start(argv, stdin, subprocess.PIPE, subprocess.STDOUT)
+        watch = Watch(process, timeout)
+        try:
+            reading = [log_lines(process.stdout, log)]
+            if stdin is not None:
+                # written while the output is read so neither pipe fills up waiting on the other
+                reading.append(write_stdin(process.stdin, stdin))
+            await asyncio.gather(*reading)
+            returncode = await process.wait()
+        except BaseException:
+            kill_process_group(process)
+            await process.wait()
+            raise
+        finally:
+            watch.cancel()
+        if watch.fired:
+            raise PhaseTimeout(phase, timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv)
+
+    async def read(self, argv, log, read, timeout=None, phase=None):
+        """runs argv with its stdout handed to the coroutine function read, stderr goes to log
+
+        returns what read returned, read gets the asyncio reader of stdout and runs on the loop
+        """
+        process = await self.start(argv, None, subprocess.PIPE, subprocess.PIPE)
+        watch = Watch(process, timeout)
+        try:
+            result, _ = await asyncio.gather(
+                read(process.stdout), log_lines(process.stderr, log)
+            )
+            returncode = await process.wait()
+        except BaseException:
+            kill_process_group(process)
+            await process.wait()
+            raise
+        finally:
+            watch.cancel()
+        if watch.fired:
+            raise PhaseTimeout(phase, timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv)
+        return result
+
+    async def output(self, argv, log, timeout=None, phase=None):
+        """runs argv and returns what it wrote to stdout, stderr goes to log"""
+
+        async def read(stdout):
+            chunks = []
+            while True:
+                chunk = await stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+
+        return await self.read(argv, log, read, timeout, phase)
+
+    async def lines(self, argv, log, receive, timeout=None, phase=None):
+        """runs argv and hands every line it writes to stdout to receive the moment it arrives, stderr goes to log"""
+
+        async def read(stdout):
+            async for line in stdout:
+                receive(line)
+
+        await self.read(argv, log, read, timeout, phase)
+
+    async def stream(self, argv, log, consume, stdin=None, timeout=None, phase=None):
+        """runs argv with its stdout handed to consume on the thread pool as a file, stderr goes to log
+
+        returns what consume returned, consume is a blocking reader (e.g. tarfile) which is why it gets a thread
+        """
+        read_fd, write_fd = os.pipe()
+        try:
+            process = await self.start(argv, stdin, write_fd, subprocess.PIPE)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        stdout = os.fdopen(read_fd, "rb")
+
+        def read():
+            try:
+                result = consume(stdout)
+                # drain whatever trails the data (e.g. tar padding) so the command exits cleanly
+                while stdout.read(CHUNK_SIZE):
+                    pass
+                return result
+            finally:
+                stdout.close()
+
+        watch = Watch(process, timeout)
+        side = [asyncio.ensure_future(log_lines(process.stderr, log))]
+        if stdin is not None:
+            side.append(asyncio.ensure_future(write_stdin(process.stdin, stdin)))
+        try:
+            try:
+                result = await self.call(read)
+            except BaseException:
+                kill_process_group(process)
+                # a cut off stream is only the symptom of the timeout
+                if not watch.fired:
+                    raise
+            finally:
+                await asyncio.gather(*side, return_exceptions=True)
+                returncode = await process.wait()
+        finally:
+            watch.cancel()
+        if watch.fired:
+            raise PhaseTimeout(phase, timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv)
+        return result
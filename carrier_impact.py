@@ -0,0 +1,214 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import time
+from threading import Lock
+
+# Mbit/s the files of a single node come back at with --low-impact, a tenth of a 1 Gbit NIC
+LOW_IMPACT_NODE_BANDWIDTH = 100
+# a reader owing less than this keeps reading, the debt is paid with the next sleep
+MIN_SLEEP = 0.01
+
+# the shell running the command drops to the lowest CPU priority and the idle IO class, everything it starts inherits them.
+# A node without renice or ionice (e.g. a slim container) runs the command as it is
+LOW_PRIORITY = "renice -n 19 -p $$ >/dev/null 2>&1; ionice -c 3 -p $$ >/dev/null 2>&1; "
+USAGE_MARKER = "carrier-usage"
+# the CPU ticks and disk bytes of every command the shell waited for are added to the shell's own in /proc,
+# printed to stderr as `carrier-usage <ticks a second> <user ticks> <system ticks> <read bytes> <write bytes>`
+USAGE_REPORT = (
+    f"printf '{USAGE_MARKER} %s %s %s\\n' "
+    '"$(getconf CLK_TCK 2>/dev/null || echo 100)" '
+    "\"$(sed 's/.*) //' /proc/$$/stat 2>/dev/null | cut -d' ' -f14,15)\" "
+    '"$(awk \'/^(read|write)_bytes/ {printf "%s ", $2}\' /proc/$$/io 2>/dev/null)" >&2'
+)
+USAGE_FIELDS = ("cpu", "read_bytes", "write_bytes")
+
+
+def low_impact_cmd(cmd):
+    """the shell command cmd run at the lowest CPU and IO priority, reporting on stderr what it used once it is done"""
+    # a subshell so an exit in cmd still gets reported, the shell waits for it like for any other command
+    return f"{LOW_PRIORITY}({cmd}); carrier_rc=$?; {USAGE_REPORT}; exit $carrier_rc"
+
+
+def parse_usage(line):
+    """the CPU seconds and disk bytes of a USAGE_REPORT line, None for any other line"""
+    fields = line.split()
+    if len(fields) < 4 or fields[0] != USAGE_MARKER:
+        return None
+    try:
+        ticks, user, system = (int(field) for field in fields[1:4])
+        io = [int(field) for field in fields[4:6]]
+    except ValueError:
+        return None
+    # a node without /proc/<pid>/io still reports its CPU
+    io += [0] * (2 - len(io))
+    return {
+        "cpu": (user + system) / ticks,
+        "read_bytes": io[0],
+        "write_bytes": io[1],
+    }
+
+
+def add_usage(total, usage):
+    for field in USAGE_FIELDS:
+        total[field] = total.get(field, 0) + usage.get(field, 0)
+    return total
+
+
+class NodeUsage:
+    """the CPU seconds and disk bytes the commands of the collection used on every node, by phase"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.lock = Lock()
+
+    def add(self, node, phase, usage):
+        with self.lock:
+            phases = self.nodes.setdefault(node, {})
+            add_usage(phases.setdefault(phase or "other", {}), usage)
+
+    def of(self, node):
+        """usage of node by phase plus the total, rounded for the manifest"""
+        with self.lock:
+            phases = {
+                phase: dict(usage) for phase, usage in self.nodes.get(node, {}).items()
+            }
+        phases["total"] = {}
+        for phase in list(phases):
+            if phase != "total":
+                add_usage(phases["total"], phases[phase])
+        return {
+            phase: {**usage, "cpu": round(usage.get("cpu", 0), 2)}
+            for phase, usage in phases.items()
+        }
+
+    def watch(self, node, phase, log):
+        return UsageWatch(self, node, phase, log)
+
+    def report(self, noun):
+        """one line on what the collection cost the nodes, the node it cost the most included"""
+        with self.lock:
+            nodes = list(self.nodes)
+        if not nodes:
+            return f"no usage was reported by the {noun}"
+        totals = {node: self.of(node)["total"] for node in nodes}
+        total = {}
+        for usage in totals.values():
+            add_usage(total, usage)
+        busiest = max(nodes, key=lambda node: totals[node]["cpu"])
+        return (
+            f"the collection used {total['cpu']:.1f} CPU seconds, read {total['read_bytes'] / 2**20:.1f} MiB"
+            f" and wrote {total['write_bytes'] / 2**20:.1f} MiB on {len(nodes)} {noun},"
+            f" the most on {busiest} with {totals[busiest]['cpu']:.1f} CPU seconds"
+        )
+
+
+class UsageWatch:
+    """passes the output of a command on to log and adds up the usage lines in it
+
+    it is appended to like the pod log so it can stand in for it
+    """
+
+    def __init__(self, usage, node, phase, log):
+        self.usage = usage
+        self.node = node
+        self.phase = phase
+        self.log = log
+        self.partial = ""
+
+    def append(self, text):
+        self.log(text)
+        lines = (self.partial + text).split("\n")
+        # only a line that could still become a usage line is kept, the rest of the output is not held
+        self.partial = lines.pop()
+        if not self.partial.startswith(USAGE_MARKER[: len(self.partial)]):
+            self.partial = ""
+        for line in lines:
+            usage = parse_usage(line)
+            if usage is not None:
+                self.usage.add(self.node, self.phase, usage)
+
+    __call__ = append
+
+
+class TokenBucket:
+    """lets rate bytes a second through, shared by every reader drawing from it"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.free_at = time.monotonic()
+        self.lock = Lock()
+
+    def take(self, size):
+        """books size bytes, returns how long the caller has to wait for them"""
+        with self.lock:
+            now = time.monotonic()
+            self.free_at = max(self.free_at, now) + size / self.rate
+            return self.free_at - now
+
+
+class ThrottledReader:
+    """wraps a stream and sleeps after every read until every bucket let its bytes through
+
+    the node notices once the pipe and the socket fill up, so it sends no faster either
+    """
+
+    def __init__(self, stream, buckets):
+        self.stream = stream
+        self.buckets = buckets
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        wait = max(bucket.take(len(data)) for bucket in self.buckets)
+        if wait >= MIN_SLEEP:
+            time.sleep(wait)
+        return data
+
+
+def bytes_per_second(mbit):
+    return mbit * 1000 * 1000 / 8
+
+
+class Throttle:
+    """caps the Mbit/s the files come back at from every node and from all of them together"""
+
+    def __init__(self, node_mbit=None, total_mbit=None):
+        self.node_mbit = node_mbit
+        self.total_mbit = total_mbit
+        self.total = (
+            None if total_mbit is None else TokenBucket(bytes_per_second(total_mbit))
+        )
+
+    def __bool__(self):
+        return self.node_mbit is not None or self.total_mbit is not None
+
+    def consume(self, consume):
+        """consume reading its stream through the limits, a new node bucket for every stream"""
+        if not self:
+            return consume
+
+        def throttled(stdout):
+            buckets = [] if self.total is None else [self.total]
+            if self.node_mbit is not None:
+                buckets.append(TokenBucket(bytes_per_second(self.node_mbit)))
+            return consume(ThrottledReader(stdout, buckets))
+
+        return throttled
+
+    def kbit_per_transfer(self, transfers):
+        """the Kbit/s of a copy that can only be capped up front (scp -l), the total is split between the transfers"""
+        limits = []
+        if self.node_mbit is not None:
+            limits.append(self.node_mbit)
+        if self.total_mbit is not None:
+            limits.append(self.total_mbit / transfers)
+        return max(int(min(limits) * 1000), 1)
@@ -12,16 +12,39 @@
 import sys
 import argparse
 import os
+import shlex
+import shutil
 import subprocess
-import tarfile
-import time
 from pathlib import Path
-import concurrent.futures
+from urllib.parse import quote
 
+from carrier_archive import DEFAULT_FORMAT, FORMATS
+from carrier_cache import K8S_CACHE_DIR, install_cmd, list_cmd, missing, part_path
+from carrier_compress import COMPRESSIONS, DEFAULT_COMPRESSION, archive_name, tar_cmd
+from carrier_impact import LOW_IMPACT_NODE_BANDWIDTH, low_impact_cmd
+from carrier_log import DEFAULT_LOG_DIR, DEFAULT_TAIL_LINES, NodeLog
+from carrier_live import DEFAULT_LIVE_DIR, DEFAULT_LIVE_INTERVAL, LiveFiles
+from carrier_remote import (
+    BadExitCode,
+    bootstrap_cmd,
+    remote_timeout,
+    timed_out_remotely,
+)
+from carrier_runner import Runner, RunnerParser, work_path
+from carrier_sched import (
+    DEFAULT_PARALLELISM,
+    DEFAULT_TRANSFER_PARALLELISM,
+    PhaseTimeout,
+    parse_phase_timeouts,
+)
+from carrier_sync import CLOCK_PROBE, ClockProbe, clock_offset
+from carrier_targets import DEFAULT_NAMESPACE, Target, discover, parse_target
+from carrier_trace import file_size
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(
-        description="Run a script on multiple pods and collect output."
+
+def parse_arguments(argv=None, out=None, err=None):
+    parser = RunnerParser(
+        out, err, description="Run a script on multiple pods and collect output."
     )
     parser.add_argument("script", help="Path to the script file to run on pods.")
     parser.add_argument(
@@ -31,25 +54,163 @@ def parse_arguments():
         help="Arguments for the script",
     )
     parser.add_argument(
-        "--namespace", default="default", help="Kubernetes namespace to use."
+        "--namespace", default=DEFAULT_NAMESPACE, help="Kubernetes namespace to use."
     )
     parser.add_argument(
-        "--container", required=False, help="Kubernetes container to use."
+        "--container",
+        required=False,
+        help="Kubernetes container to run the script in (default: the default container of the pod).",
     )
     parser.add_argument(
         "--labels",
         help="Comma-separated list of label selectors (e.g., 'app=myapp,env=prod').",
     )
+    parser.add_argument(
+        "--context", help="Kubernetes context to use (default: the current context)."
+    )
+    parser.add_argument("--kubeconfig", help="Kubeconfig file to use.")
+    parser.add_argument(
+        "--target",
+        action="append",
+        default=[],
+        type=parse_target,
+        metavar="CONTEXT:NAMESPACE:SELECTOR:CONTAINER",
+        help="Collect from the pods of this context, namespace and label selector too, running the script in the container. Empty fields take the value of --context, --namespace, --labels and --container. Can be repeated, the pods of every target are looked up at the same time, share --parallelism and end up in one archive as <context>/<namespace>/<pod> (default: one target made of --context, --namespace, --labels and --container).",
+    )
     parser.add_argument(
         "--shell",
         default="bash",
         choices=["bash", "zsh", "sh"],
         help="Shell to use for running the script (default: bash).",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--backend",
+        default="kubectl",
+        choices=["kubectl", "api"],
+        help="Run every step by forking kubectl or in process through the Kubernetes API with one shared connection (default: kubectl).",
+    )
+    parser.add_argument(
+        "--single-session",
+        action="store_true",
+        help="Send the script over stdin and create the work dir, run, collect and clean up in one kubectl exec (default: False).",
+    )
+    parser.add_argument(
+        "--compression",
+        default=DEFAULT_COMPRESSION,
+        choices=COMPRESSIONS,
+        help="How the files are compressed on the pods, pigz and zstd use every core and the pod archives are stored in the final archive without compressing them again (default: gzip).",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Level passed to the compressor, e.g. 1 for fast gzip or 19 for small zstd (default: the compressor's own).",
+    )
+    parser.add_argument(
+        "--format",
+        default=DEFAULT_FORMAT,
+        choices=FORMATS,
+        help="Format of the final archive, zip unpacks the files of every pod into a flat archive with an index so single files can be listed and extracted with carrier_bundle.py (default: tar).",
+    )
+    parser.add_argument(
+        "--attach",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="File to put next to the script on every pod, e.g. a jar the script runs. Files are cached on the pod by their sha256 so they are only copied once, can be repeated.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the pods the last run in this directory collected (as listed in carrier-run.json) and only run the pods that failed, timed out or are new (default: False).",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="Copy new and growing files back while the script runs instead of all at once when it exits, into --live-dir where they can be watched. Runs every pod in a single session (default: False).",
+    )
+    parser.add_argument(
+        "--live-dir",
+        default=DEFAULT_LIVE_DIR,
+        help=f"Directory the files of every pod are copied to as <pod>/<path> with --live (default: {DEFAULT_LIVE_DIR}).",
+    )
+    parser.add_argument(
+        "--live-interval",
+        type=float,
+        default=DEFAULT_LIVE_INTERVAL,
+        help=f"Seconds between two copies of what changed with --live (default: {DEFAULT_LIVE_INTERVAL:g}).",
+    )
+    parser.add_argument(
+        "--sync-start",
+        type=float,
+        metavar="LEAD",
+        help="Copy the script to every pod first, then start it everywhere at the same time LEAD seconds after the last pod is ready, corrected by the clock offset measured on every pod. Every pod runs at once, --parallelism does not apply (default: off).",
+    )
+    parser.add_argument(
+        "--low-impact",
+        action="store_true",
+        help=f"Run every command in the pods at the lowest CPU and IO priority (nice 19, idle IO class), copy the files of every pod back at --node-bandwidth ({LOW_IMPACT_NODE_BANDWIDTH} Mbit/s unless given) and report the CPU and disk IO the collection used in every pod (default: False).",
+    )
+    parser.add_argument(
+        "--node-bandwidth",
+        type=float,
+        metavar="MBIT",
+        help="Mbit/s the files of a single pod may come back at, a throttled copy reads the archive with cat over exec since kubectl cp can not be slowed down (default: no limit).",
+    )
+    parser.add_argument(
+        "--total-bandwidth",
+        type=float,
+        metavar="MBIT",
+        help="Mbit/s the files of all pods together may come back at (default: no limit).",
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        default=DEFAULT_PARALLELISM,
+        help=f"Number of pods running the script at the same time (default: {DEFAULT_PARALLELISM}).",
+    )
+    parser.add_argument(
+        "--transfer-parallelism",
+        type=int,
+        default=DEFAULT_TRANSFER_PARALLELISM,
+        help=f"Number of pods copying files back at the same time (default: {DEFAULT_TRANSFER_PARALLELISM}).",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        help="Directory to write per phase timings (carrier-timings.json) and a Chrome trace (carrier-trace.json) to.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds the whole run may take, stragglers are stopped and whatever they wrote so far is collected (default: no limit).",
+    )
+    parser.add_argument(
+        "--phase-timeout",
+        action="append",
+        metavar="PHASE=SECONDS",
+        help="Seconds a single phase (prepare, upload, execute, archive, download, cleanup, session) may take on each pod, can be repeated.",
+    )
+    parser.add_argument(
+        "--log-dir",
+        default=DEFAULT_LOG_DIR,
+        help=f"Directory the log of every pod is written to as <pod>.log (default: {DEFAULT_LOG_DIR}).",
+    )
+    parser.add_argument(
+        "--log-tail",
+        type=int,
+        default=DEFAULT_TAIL_LINES,
+        help=f"Number of lines of the log of a failed pod to print (default: {DEFAULT_TAIL_LINES}).",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the collected files over kubectl exec straight into the final archive instead of staging a tar.gz on the pod and locally (default: False).",
+    )
+    return parser.parse_args(argv)
+
 
+class CarrierK8s(Runner):
+    NODES = "pods"
 
-class CarrierK8s:
     def __init__(
         self,
         script,
@@ -57,58 +218,485 @@ class CarrierK8s:
         labels,
         shell,
         script_args,
-        output_archive="output.tar.gz",
+        output_archive=None,
         k8s_context=None,
         k8s_config=None,
+        stream=False,
+        backend="kubectl",
+        single_session=False,
+        parallelism=DEFAULT_PARALLELISM,
+        transfer_parallelism=DEFAULT_TRANSFER_PARALLELISM,
+        trace_dir=None,
+        timeout=None,
+        phase_timeouts=None,
+        log_dir=DEFAULT_LOG_DIR,
+        log_tail_lines=DEFAULT_TAIL_LINES,
+        compression=DEFAULT_COMPRESSION,
+        compression_level=None,
+        format=DEFAULT_FORMAT,
+        attachments=None,
+        resume=False,
+        live=False,
+        live_dir=DEFAULT_LIVE_DIR,
+        live_interval=DEFAULT_LIVE_INTERVAL,
+        sync_start=None,
+        container=None,
+        targets=None,
+        low_impact=False,
+        node_bandwidth=None,
+        total_bandwidth=None,
+        warm=None,
+        work_dir=None,
+        out=None,
+        err=None,
     ):
-        self.script = script
-        self.namespace = namespace
-        self.labels = labels
-        self.shell = shell
-        self.script_args = script_args
-        if k8s_context is not None:
-            self.k8s_context = "--context " + k8s_context
+        super().__init__(
+            script,
+            shell,
+            script_args,
+            output_archive=output_archive,
+            stream=stream,
+            single_session=single_session,
+            parallelism=parallelism,
+            transfer_parallelism=transfer_parallelism,
+            trace_dir=trace_dir,
+            timeout=timeout,
+            phase_timeouts=phase_timeouts,
+            compression=compression,
+            compression_level=compression_level,
+            format=format,
+            attachments=attachments,
+            resume=resume,
+            live=live,
+            live_dir=live_dir,
+            live_interval=live_interval,
+            sync_start=sync_start,
+            low_impact=low_impact,
+            node_bandwidth=node_bandwidth,
+            total_bandwidth=total_bandwidth,
+            warm=warm,
+            work_dir=work_dir,
+            out=out,
+            err=err,
+        )
+        # without targets the namespace, labels, context and container make the only one
+        self.targets = targets or [Target(k8s_context, namespace, labels, container)]
+        # every node of the run with its target and pod name, filled in by get_pods
+        self.pods = {}
+        k8s_config = work_path(work_dir, k8s_config)
+        self.k8s_config = k8s_config
+        self.log_dir = work_path(work_dir, log_dir)
+        self.log_tail_lines = log_tail_lines
+        self.apis = None
+        if backend == "api":
+            # only the api backend needs pykube
+            from carrier_k8s_api import K8sApi
+
+            # one pooled connection per cluster
+            self.apis = {}
+            apis = {} if warm is None else warm.apis
+            for target in self.targets:
+                if target.context not in self.apis:
+                    key = (target.context, k8s_config)
+                    if key not in apis:
+                        apis[key] = K8sApi(target.context, k8s_config)
+                    self.apis[target.context] = apis[key]
+
+    async def run_cmd(self, argv, pod_log, timeout=None, phase=None):
+        pod_log.append(f"running command {shlex.join(argv)}\n")
+        pod_log.append("output:\t")
+        # output goes to the pod log as it arrives so a chatty command is never held in memory
+        try:
+            await self.engine.run(argv, pod_log.append, timeout=timeout, phase=phase)
+        except subprocess.CalledProcessError as e:
+            raise BadExitCode(e.returncode) from None
+        finally:
+            pod_log.append("\n\n")
+
+    async def read_cmd(self, argv, pod_log, timeout=None, phase=None):
+        pod_log.append(f"running command {shlex.join(argv)}\n")
+        pod_log.append("output:\t")
+        try:
+            return await self.engine.output(argv, pod_log.append, timeout, phase)
+        except subprocess.CalledProcessError as e:
+            raise BadExitCode(e.returncode) from None
+        finally:
+            pod_log.append("\n\n")
+
+    async def lines_cmd(self, argv, pod_log, receive, timeout=None, phase=None):
+        pod_log.append(f"running command {shlex.join(argv)}\n")
+        pod_log.append("output:\t")
+        try:
+            await self.engine.lines(argv, pod_log.append, receive, timeout, phase)
+        except subprocess.CalledProcessError as e:
+            raise BadExitCode(e.returncode) from None
+        finally:
+            pod_log.append("\n\n")
+
+    async def run_stream_cmd(
+        self, argv, pod_log, consume, stdin=None, timeout=None, phase=None
+    ):
+        # stdout carries the data so only stderr goes to the pod log
+        pod_log.append(f"running command {shlex.join(argv)}\n")
+        pod_log.append("output:\t")
+        try:
+            return await self.engine.stream(
+                argv, pod_log.append, consume, stdin, timeout, phase
+            )
+        except subprocess.CalledProcessError as e:
+            raise BadExitCode(e.returncode) from None
+        finally:
+            pod_log.append("\n\n")
+
+    def limit(self, phase):
+        return None if phase is None else self.deadline.check(phase)
+
+    def pod(self, node):
+        """(target, pod name) of a node, anything get_pods did not find is a pod of the first target"""
+        return self.pods.get(node, (self.targets[0], node))
+
+    def describe(self, node):
+        target, pod_name = self.pod(node)
+        return f"pod {pod_name} in {target}"
+
+    def kubectl_options(self, target):
+        """the flags selecting the cluster and namespace of a target"""
+        options = []
+        if target.context is not None:
+            options += ["--context", target.context]
+        if self.k8s_config is not None:
+            options += ["--kubeconfig", self.k8s_config]
+        return options + ["-n", target.namespace]
+
+    def label_flag(self, target):
+        # --labels is optional, without it every pod of the namespace is collected
+        return ["-l", target.labels] if target.labels is not None else []
+
+    def container_flag(self, target):
+        return ["-c", target.container] if target.container is not None else []
+
+    def exec_cmd(self, target, pod_name, argv, stdin=False):
+        stdin_flag = ["-i"] if stdin else []
+        return [
+            "kubectl",
+            "exec",
+            *stdin_flag,
+            *self.kubectl_options(target),
+            *self.container_flag(target),
+            pod_name,
+            "--",
+            *argv,
+        ]
+
+    def on_pod(self, node, argv, pod_log, phase):
+        """the argv and log of a command in the pod, with --low-impact it runs at the lowest priority and its usage is picked out of the log"""
+        if not self.low_impact:
+            return argv, pod_log
+        return (
+            [self.shell, "-c", low_impact_cmd(shlex.join(argv))],
+            self.usage.watch(node, phase, pod_log.append),
+        )
+
+    def local_archive(self, node):
+        # nodes of several targets hold slashes and contexts can hold colons, which kubectl cp takes for a pod
+        return work_path(
+            self.work_dir, archive_name(quote(node, safe=""), self.compression)
+        )
+
+    async def exec_on_pod(self, node, argv, pod_log, phase=None):
+        timeout = self.limit(phase)
+        target, pod_name = self.pod(node)
+        argv, pod_log = self.on_pod(node, argv, pod_log, phase)
+        if self.apis is not None:
+            await self.apis[target.context].run(
+                target.namespace,
+                pod_name,
+                argv,
+                pod_log,
+                container=target.container,
+                timeout=timeout,
+                phase=phase,
+            )
+            return
+        await self.run_cmd(
+            self.exec_cmd(target, pod_name, argv), pod_log, timeout, phase
+        )
+
+    async def read_from_pod(self, node, argv, pod_log, phase=None):
+        """what argv prints on the pod as text, for short listings"""
+        timeout = self.limit(phase)
+        target, pod_name = self.pod(node)
+        argv, pod_log = self.on_pod(node, argv, pod_log, phase)
+        if self.apis is not None:
+            output = await self.apis[target.context].stream(
+                self.engine,
+                target.namespace,
+                pod_name,
+                argv,
+                pod_log,
+                lambda stdout: stdout.read(),
+                container=target.container,
+                timeout=timeout,
+                phase=phase,
+            )
         else:
-            self.k8s_context = ""
-        if k8s_config is not None:
-            self.k8s_config = "--kubeconfig " + k8s_config
+            output = await self.read_cmd(
+                self.exec_cmd(target, pod_name, argv), pod_log, timeout, phase
+            )
+        return output.decode("utf-8", errors="replace")
+
+    async def stream_from_pod(
+        self, node, argv, pod_log, consume, stdin=None, phase=None
+    ):
+        timeout = self.limit(phase)
+        target, pod_name = self.pod(node)
+        argv, pod_log = self.on_pod(node, argv, pod_log, phase)
+        # the data is read no faster than the bandwidth limits
+        consume = self.throttle.consume(consume)
+        if self.apis is not None:
+            return await self.apis[target.context].stream(
+                self.engine,
+                target.namespace,
+                pod_name,
+                argv,
+                pod_log,
+                consume,
+                stdin,
+                container=target.container,
+                timeout=timeout,
+                phase=phase,
+            )
+        exec_cmd = self.exec_cmd(target, pod_name, argv, stdin is not None)
+        return await self.run_stream_cmd(
+            exec_cmd, pod_log, consume, stdin, timeout, phase
+        )
+
+    async def copy_to_pod(self, node, src, dest, pod_log, phase=None):
+        timeout = self.limit(phase)
+        target, pod_name = self.pod(node)
+        if self.apis is not None:
+            await self.apis[target.context].copy_to(
+                target.namespace,
+                pod_name,
+                src,
+                dest,
+                pod_log,
+                container=target.container,
+                timeout=timeout,
+                phase=phase,
+            )
+            return
+        copy_cmd = [
+            "kubectl",
+            *self.kubectl_options(target),
+            "cp",
+            *self.container_flag(target),
+            os.fspath(src),
+            f"{target.namespace}/{pod_name}:{dest}",
+        ]
+        await self.run_cmd(copy_cmd, pod_log, timeout, phase)
+
+    async def copy_from_pod(self, node, src, dest, pod_log, phase=None):
+        if self.throttle:
+            # kubectl cp can not be slowed down, so the archive is read with cat through the limits instead
+
+            def save(stdout):
+                with open(dest, "wb") as f:
+                    shutil.copyfileobj(stdout, f)
+
+            await self.stream_from_pod(node, ["cat", src], pod_log, save, phase=phase)
+            return
+        timeout = self.limit(phase)
+        target, pod_name = self.pod(node)
+        if self.apis is not None:
+            await self.apis[target.context].copy_from(
+                self.engine,
+                target.namespace,
+                pod_name,
+                src,
+                dest,
+                pod_log,
+                container=target.container,
+                timeout=timeout,
+                phase=phase,
+            )
+            return
+        copy_cmd = [
+            "kubectl",
+            "cp",
+            *self.kubectl_options(target),
+            *self.container_flag(target),
+            f"{target.namespace}/{pod_name}:{src}",
+            dest,
+        ]
+        await self.run_cmd(copy_cmd, pod_log, timeout, phase)
+
+    async def upload_artifacts(self, node, artifacts, pod_log, *dirs):
+        """copies only the artifacts missing from the cache of the pod, returns the command linking them into dirs[0]"""
+        # the uploads are named after the pod, a node of several targets holds slashes
+        _, pod_name = self.pod(node)
+        with self.trace.phase(node, "prepare"):
+            listing = await self.read_from_pod(
+                node,
+                [self.shell, "-c", list_cmd(K8S_CACHE_DIR, *dirs)],
+                pod_log,
+                phase="prepare",
+            )
+        uploads = missing(artifacts, listing)
+        with self.trace.phase(
+            node,
+            "upload",
+            bytes=sum(a.size for a in uploads),
+            cached=len(artifacts) - len(uploads),
+        ):
+            for artifact in uploads:
+                await self.copy_to_pod(
+                    node,
+                    artifact.path,
+                    part_path(K8S_CACHE_DIR, artifact, pod_name),
+                    pod_log,
+                    "upload",
+                )
+        return install_cmd(dirs[0], K8S_CACHE_DIR, artifacts, uploads, pod_name)
+
+    async def run_single_session_on_pod(self, node, pod_tmp_dir, pod_log):
+        with open(self.script, "rb") as f:
+            script = f.read()
+        # Check args has some content to avoid error
+        # "TypeError: can only join an iterable"
+        if self.script_args:
+            script_args_str = " ".join(self.script_args)
         else:
-            self.k8s_config = ""
-        self.output_archive = output_archive
-
-    def run_cmd(self, cmd, pod_log):
-        pod_log.append(f"running command {cmd}\n")
-        if sys.version_info[0] > 2 and sys.version_info[1] < 7:
-            return subprocess.run(
-                cmd,
-                shell=True,
-                check=True,
+            script_args_str = ""
+        install = None
+        if self.attachments:
+            # the script comes on stdin, the attached files go through the cache before the session starts
+            artifacts = self.load_artifacts(*self.attachments)
+            install = await self.upload_artifacts(node, artifacts, pod_log, pod_tmp_dir)
+        # the bootstrap creates the directory, reads the script from stdin, runs it, tars the results to stdout and removes the directory
+        timeout = self.deadline.check("execute")
+        session_cmd = shlex.split(
+            bootstrap_cmd(
+                pod_tmp_dir,
+                Path(self.script).name,
+                self.shell,
+                script_args_str,
+                len(script),
+                timeout,
+                self.compression,
+                self.compression_level,
+                install,
+                [Path(a).name for a in self.attachments],
+                self.live_interval if self.live else None,
             )
-        p = subprocess.run(cmd, shell=True, check=False, capture_output=True, text=True)
-        pod_log.append("output:\t" + p.stdout + p.stderr + "\n\n")
-        if p.returncode != 0:
-            raise Exception("bad exit code " + str(p.returncode))
+        )
+        # upload, execute, archive, download and cleanup all happen inside the one session
+        with self.trace.phase(node, "session", upload_bytes=len(script)) as phase:
+            if self.live:
+                live = LiveFiles(self.live_dir, node)
+                consume = live.consume
+            elif self.stream:
+                consume = self.stream_into_bundle(node, phase)
+            else:
 
-    def get_pods(self):
-        cmd = f"kubectl get pods -n {self.namespace} -l {self.labels} -o jsonpath='{{.items[*].metadata.name}}' {self.k8s_context} {self.k8s_config}"
-        output = subprocess.check_output(cmd, shell=True).decode("utf-8")
-        return output.split()
+                def consume(stdout):
+                    with open(self.local_archive(node), "wb") as f:
+                        shutil.copyfileobj(stdout, f)
+                    phase["bytes"] = file_size(self.local_archive(node))
+
+            try:
+                await self.stream_from_pod(
+                    node, session_cmd, pod_log, consume, script, phase="session"
+                )
+            except BadExitCode as e:
+                if timeout is None or not timed_out_remotely(e):
+                    raise
+                # the bootstrap stopped the script and still sent back what it wrote
+                error = self.script_timed_out(node, timeout, phase)
+                pod_log.append(f"{error}, collecting what the script wrote so far\n")
+            finally:
+                if self.live:
+                    phase["bytes"] = live.bytes
+                    phase["changes"] = live.changes
+        if self.live:
+            await self.add_live_files(node, live)
+
+    def watch_cmd(self, target):
+        # prints a line for every change to the pods of target, nothing for the pods already there
+        return [
+            "kubectl",
+            "get",
+            "pods",
+            *self.kubectl_options(target),
+            *self.label_flag(target),
+            "--watch-only",
+            "-o",
+            "name",
+        ]
+
+    async def list_pods(self, target):
+        if self.warm is not None:
+            # the pods of the last run are used again until the watch started with them sees a change
+            key = (self.k8s_config, target.context, target.namespace, target.labels)
+            return await self.warm.inventory.get(
+                key, self.watch_cmd(target), lambda: self.fetch_pods(target)
+            )
+        return await self.fetch_pods(target)
 
-    def run_script_on_pod(self, pod_name):
+    async def fetch_pods(self, target):
+        if self.apis is not None:
+            return await self.engine.call(
+                self.apis[target.context].get_pods, target.namespace, target.labels
+            )
+        cmd = [
+            "kubectl",
+            "get",
+            "pods",
+            *self.kubectl_options(target),
+            *self.label_flag(target),
+            "-o",
+            "jsonpath={.items[*].metadata.name}",
+        ]
+        # kubectl explains a failed listing on stderr, which goes to the terminal as it is
+        output = await self.engine.output(cmd, (self.err or sys.stderr).write)
+        return output.decode("utf-8").split()
+
+    async def get_pods(self):
+        """the nodes of the run, the pods of every target are looked up at the same time"""
+        self.pods, failures = await discover(self.targets, self.list_pods)
+        if len(failures) == len(self.targets):
+            # there is nothing to collect, the error of the first target says why
+            raise next(iter(failures.values()))
+        # one cluster being down does not stop the others from being collected
+        for target, error in failures.items():
+            self.feedback(f"listing the pods in {target} failed, skipping it: {error}")
+        return list(self.pods)
+
+    async def execute_on_pod(self, node):
         exit_code = 0
-        pod_log = [f"##\n## pod {pod_name} on namespace {self.namespace} log \n##\n"]
+        pod_log = NodeLog(
+            os.path.join(self.log_dir, f"{node}.log"), self.log_tail_lines
+        )
+        pod_log.append(f"##\n## {self.describe(node)} log \n##\n")
+        _, pod_name = self.pod(node)
+        # create a subdirectory under /tmp. We do this as /tmp is a well known location and we create a subdirectory to avoid collisions with other processes
+        # this also makes cleanup easier later
+        pod_tmp_top_level_dir = f"/tmp/{pod_name}_tmp"
+        # we need to separate the collected data and the tar.gz so that we can avoid a race
+        pod_tmp_dir = f"{pod_tmp_top_level_dir}/data"
         try:
-            # create a subdirectory under /tmp. We do this as /tmp is a well known location and we create a subdirectory to avoid collisions with other processes
-            # this also makes cleanup easier later
-            pod_tmp_top_level_dir = f"/tmp/{pod_name}_tmp"
-            # we need to separate the collected data and the tar.gz so that we can avoid a race
-            pod_tmp_dir = f"{pod_tmp_top_level_dir}/data"
-            create_tmp_dir_cmd = f"kubectl exec  {self.k8s_context} {self.k8s_config} -n {self.namespace} {pod_name} -- mkdir -p {pod_tmp_dir}"
-            self.run_cmd(create_tmp_dir_cmd, pod_log)
-
-            # copy the script the subdirectory we created in /tmp
-            copy_script_cmd = f"kubectl {self.k8s_context} {self.k8s_config} cp {self.script} {self.namespace}/{pod_name}:{pod_tmp_dir}/{Path(self.script).name}"
-            self.run_cmd(copy_script_cmd, pod_log)
+            # pods still waiting for a slot when the deadline passes are not started at all
+            self.deadline.check("queue")
+            if self.single_session:
+                await self.run_single_session_on_pod(
+                    node, pod_tmp_top_level_dir, pod_log
+                )
+                pod_log.close()
+                return (exit_code, pod_log)
+
+            # the script goes through the cache like every attached file, only what the pod does not have yet is copied
+            artifacts = self.load_artifacts(self.script, *self.attachments)
+            install = await self.upload_artifacts(node, artifacts, pod_log, pod_tmp_dir)
 
             # Check args has some content to avoid error
             # "TypeError: can only join an iterable"
@@ -118,77 +706,216 @@ class CarrierK8s:
                 script_args_str = ""
 
             # Now cd to the sub directory and run our script using the k8s context, k8s config, k8s namespace and unix shell specified. Likewise pass any args that one needs to pass to the script
-            run_script_cmd = f'kubectl exec {self.k8s_context} {self.k8s_config} -n {self.namespace} {pod_name} -- {self.shell} -c "cd {pod_tmp_dir} && {self.shell} {pod_tmp_dir}/{Path(self.script).name} {script_args_str}"'
-            self.run_cmd(run_script_cmd, pod_log)
+            start_at = ""
+            until_start = 0
+            if self.start_barrier is not None:
+                start_at, until_start = await self.wait_for_start(
+                    node, await self.measure_clock(node, pod_log)
+                )
+            # the script is stopped in the pod itself, killing kubectl alone would leave it running
+            timeout = self.deadline.check("execute")
+            remote = remote_timeout(None if timeout is None else timeout - until_start)
+            run_script_cmd = [
+                self.shell,
+                "-c",
+                f"{install} && cd {pod_tmp_dir} && {start_at}{remote}{self.shell} {pod_tmp_dir}/{Path(self.script).name} {script_args_str}",
+            ]
+            with self.trace.phase(node, "execute") as phase:
+                try:
+                    await self.exec_on_pod(node, run_script_cmd, pod_log, "execute")
+                except (PhaseTimeout, BadExitCode) as e:
+                    if not isinstance(e, PhaseTimeout) and not (
+                        timeout is not None and timed_out_remotely(e)
+                    ):
+                        raise
+                    # keep going so whatever the script wrote so far is still collected
+                    error = self.script_timed_out(node, timeout, phase)
+                    pod_log.append(
+                        f"{error}, collecting what the script wrote so far\n"
+                    )
+
+            if not self.stream:
+                # Now use tar on the pod to archive all output in the subdirectory. We are excluding the script and the tar itself
+                collect_files_cmd = [
+                    self.shell,
+                    "-c",
+                    tar_cmd(
+                        self.compression,
+                        self.compression_level,
+                        f"{pod_tmp_top_level_dir}/{archive_name(pod_name, self.compression)}",
+                        f"{pod_tmp_dir}/",
+                        self.excluded_names(),
+                    ),
+                ]
+                with self.trace.phase(node, "archive"):
+                    await self.exec_on_pod(node, collect_files_cmd, pod_log, "archive")
+        except Exception as e:
+            # since this failed we are returning the error here
+            self.manifest.failed(node, e)
+            pod_log.append("result of last command was: ")
+            pod_log.append(repr(e))
+            pod_log.append("\n\n")
+            exit_code = 1
+        finally:
+            # a pod that failed while staging does not hold back the others
+            if self.start_barrier is not None:
+                self.start_barrier.leave(node)
+        pod_log.close()
+        return (exit_code, pod_log)
 
-            # Now use tar on the pod to archive all output in the subdirectory. We are excluding the script and the tar itself
-            collect_files_cmd = f"kubectl exec {self.k8s_context} {self.k8s_config} -n {self.namespace} {pod_name} -- tar -czf {pod_tmp_top_level_dir}/{pod_name}.tar.gz --exclude={Path(self.script).name} -C {pod_tmp_dir}/ ."
-            self.run_cmd(collect_files_cmd, pod_log)
+    async def measure_clock(self, node, pod_log):
+        probe_argv = [self.shell, "-c", CLOCK_PROBE]
+        with self.trace.phase(node, "clock") as phase:
+            if self.apis is not None:
+                offset = await self.stream_from_pod(
+                    node, probe_argv, pod_log, clock_offset, phase="prepare"
+                )
+            else:
+                # the loop reads the lines itself so every sample is timed the moment it arrives
+                target, pod_name = self.pod(node)
+                probe = ClockProbe()
+                await self.lines_cmd(
+                    self.exec_cmd(target, pod_name, probe_argv),
+                    pod_log,
+                    probe.receive,
+                    self.limit("prepare"),
+                    "prepare",
+                )
+                offset = probe.offset()
+            phase["offset"] = offset
+        return offset
 
-            # copy the tar back to the local machine
-            copy_back_cmd = f"kubectl cp {self.k8s_context} {self.k8s_config} {self.namespace}/{pod_name}:{pod_tmp_top_level_dir}/{pod_name}.tar.gz {pod_name}.tar.gz"
-            self.run_cmd(copy_back_cmd, pod_log)
+    async def collect_from_pod(self, node, executed):
+        exit_code, pod_log = executed
+        _, pod_name = self.pod(node)
+        pod_tmp_top_level_dir = f"/tmp/{pod_name}_tmp"
+        pod_tmp_dir = f"{pod_tmp_top_level_dir}/data"
+        try:
+            # a single session already brought the files back and removed its directory
+            if exit_code == 0 and not self.single_session:
+                if self.stream:
+                    # tar writes to stdout and the members go straight into the final archive, nothing is staged on the pod or locally
+                    with self.trace.phase(node, "download") as phase:
+                        await self.stream_from_pod(
+                            node,
+                            [
+                                self.shell,
+                                "-c",
+                                tar_cmd(
+                                    self.compression,
+                                    self.compression_level,
+                                    "-",
+                                    f"{pod_tmp_dir}/",
+                                    self.excluded_names(),
+                                ),
+                            ],
+                            pod_log,
+                            self.stream_into_bundle(node, phase),
+                            phase="download",
+                        )
+                else:
+                    # copy the tar back to the local machine
+                    with self.trace.phase(node, "download") as phase:
+                        await self.copy_from_pod(
+                            node,
+                            f"{pod_tmp_top_level_dir}/{archive_name(pod_name, self.compression)}",
+                            self.local_archive(node),
+                            pod_log,
+                            "download",
+                        )
+                        phase["bytes"] = file_size(self.local_archive(node))
         except Exception as e:
             # since this failed we are returning the error here
+            self.manifest.failed(node, e)
             pod_log.append("result of last command was: ")
             pod_log.append(repr(e))
             pod_log.append("\n\n")
             exit_code = 1
         finally:
             # now we can to delete our subdirectory so we do not hog up all of the space on the system
-            try:
-                delete_subdir_cmd = f"kubectl exec {self.k8s_context} {self.k8s_config} -n {self.namespace} {pod_name} -- rm -fr {pod_tmp_dir}"
-                self.run_cmd(delete_subdir_cmd, pod_log)
-            except Exception as e:
-                pod_log.append(
-                    f"directory cleanup {pod_tmp_dir} failed due to error {e}\n"
-                )
-        pod_log.append(
-            f"##\n## end log for pod {pod_name} of namespace {self.namespace} \n##\n"
-        )
-        return (exit_code, "".join(pod_log))
-
-    def run(self):
-        pods = self.get_pods()
-        threads = []
-        successful = 0
-        failed = 0
-        # setup a thread pool so the script can run on all the pods at once
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for pod in pods:
-                t = executor.submit(self.run_script_on_pod, pod)
-                print(f"collection started on {pod} in namespace {self.namespace}")
-                threads.append((pod, t))
-
-            # this loops through all the threads in order and logs when they're done
-            for t in threads:
-                result = t[1].result()
-                if result[0] != 0:
-                    failed += 1
-                    print(
-                        f"pod {t[0]} in namespace {self.namespace} failed. Log is \n{result[1]}"
+            if not self.single_session:
+                try:
+                    with self.trace.phase(node, "cleanup"):
+                        await self.exec_on_pod(
+                            node, ["rm", "-fr", pod_tmp_dir], pod_log, "cleanup"
+                        )
+                except Exception as e:
+                    pod_log.append(
+                        f"directory cleanup {pod_tmp_dir} failed due to error {e}\n"
                     )
-                else:
-                    successful += 1
-                    print(f"pod {t[0]} in namespace {self.namespace} is done")
-        if successful > 0:
-            print(
-                f"archiving collected files into one archive named {self.output_archive}"
-            )
-            with tarfile.open(self.output_archive, "w:gz") as big_archive:
-                for pod in pods:
-                    big_archive.add(f"{pod}.tar.gz", arcname=f"{pod}.tar.gz")
-                    os.remove(f"{pod}.tar.gz")
-            return f"All done! The final archive is {self.output_archive}"
-        else:
-            return f"no successful collections out of {successful+ failed} pods"
+        pod_log.append(f"##\n## end log for {self.describe(node)} \n##\n")
+        pod_log.close()
+        # the full log stays on disk, only its tail is kept for the failure summary
+        return (exit_code, pod_log.tail_text(), pod_log.path)
 
+    async def run_script_on_pod(self, node):
+        return await self.collect_from_pod(node, await self.execute_on_pod(node))
 
-def main():
-    args = parse_arguments()
-    runner = CarrierK8s(
-        args.script, args.namespace, args.labels, args.shell, args.script_args
+    async def get_nodes(self):
+        return await self.get_pods()
+
+    def steps(self):
+        return self.execute_on_pod, self.collect_from_pod
+
+    def failure(self, node, task):
+        exit_code, tail, path = task.result()
+        if exit_code != 0:
+            return f"{self.describe(node)} failed. Full log is {path}, it ends with \n{tail}"
+        return None
+
+
+def runner_from_args(args, warm=None, work_dir=None, out=None, err=None):
+    # empty fields of a target fall back to the options given for the single target
+    targets = [
+        Target(
+            target.get("context", args.context),
+            target.get("namespace", args.namespace),
+            target.get("labels", args.labels),
+            target.get("container", args.container),
+        )
+        for target in args.target
+    ]
+    return CarrierK8s(
+        args.script,
+        args.namespace,
+        args.labels,
+        args.shell,
+        args.script_args,
+        k8s_context=args.context,
+        k8s_config=args.kubeconfig,
+        stream=args.stream,
+        backend=args.backend,
+        single_session=args.single_session,
+        parallelism=args.parallelism,
+        transfer_parallelism=args.transfer_parallelism,
+        trace_dir=args.trace_dir,
+        timeout=args.timeout,
+        phase_timeouts=parse_phase_timeouts(args.phase_timeout),
+        log_dir=args.log_dir,
+        log_tail_lines=args.log_tail,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        format=args.format,
+        attachments=args.attach,
+        resume=args.resume,
+        live=args.live,
+        live_dir=args.live_dir,
+        live_interval=args.live_interval,
+        sync_start=args.sync_start,
+        container=args.container,
+        targets=targets,
+        low_impact=args.low_impact,
+        node_bandwidth=args.node_bandwidth,
+        total_bandwidth=args.total_bandwidth,
+        warm=warm,
+        work_dir=work_dir,
+        out=out,
+        err=err,
     )
+
+
+def main():
+    runner = runner_from_args(parse_arguments())
     result = runner.run()
     print(result)
 
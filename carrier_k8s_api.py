@@ -0,0 +1,597 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import base64
+import codecs
+import json
+import os
+import re
+import shlex
+import shutil
+import ssl
+import struct
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlparse
+
+import pykube
+
+from carrier_engine import CHUNK_SIZE, Watch
+from carrier_remote import BadExitCode
+from carrier_sched import PhaseTimeout
+
+STDIN = 0
+STDOUT = 1
+STDERR = 2
+STATUS = 3
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+STDIN_CHUNK_SIZE = 64 * 1024
+
+EXEC_CREDENTIAL_VERSIONS = (
+    "client.authentication.k8s.io/v1alpha1",
+    "client.authentication.k8s.io/v1beta1",
+    "client.authentication.k8s.io/v1",
+)
+# a credential of the exec plugin is asked for again this long before it expires, a session opened right before
+# the expiry would otherwise be refused
+EXEC_CREDENTIAL_MARGIN = 60
+
+
+def mask_payload(key, data):
+    n = len(data)
+    repeated_key = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(repeated_key, "big")).to_bytes(
+        n, "big"
+    )
+
+
+def encode_frame(opcode, payload):
+    # frames sent by a client must always be masked
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([0x80 | length])
+    elif length < 65536:
+        header += bytes([0x80 | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+    key = os.urandom(4)
+    return header + key + mask_payload(key, payload)
+
+
+def exit_code_from_status(status):
+    if status.get("status") == "Success":
+        return 0
+    for cause in status.get("details", {}).get("causes", []):
+        if cause.get("reason") == "ExitCode":
+            return int(cause.get("message"))
+    return 1
+
+
+async def stdin_chunks(stdin):
+    """bytes are sliced, a file is read a chunk at a time on a thread so the disk never holds up the loop"""
+    if isinstance(stdin, bytes):
+        for i in range(0, len(stdin), STDIN_CHUNK_SIZE):
+            yield stdin[i : i + STDIN_CHUNK_SIZE]
+        return
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, stdin.read, STDIN_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def open_pipe(fd):
+    """an asyncio writer of the pipe fd, writes never block the loop and drain waits while the reader is behind"""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(
+        lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+        os.fdopen(fd, "wb", buffering=0),
+    )
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def exec_credential(exec_config):
+    """the status of an ExecCredential printed by the exec plugin of the kubeconfig (e.g. aws eks get-token)"""
+    if exec_config.get("apiVersion") not in EXEC_CREDENTIAL_VERSIONS:
+        raise ValueError(
+            f"the exec plugin of the kubeconfig uses {exec_config.get('apiVersion')}, which is not supported"
+        )
+    env = dict(os.environ)
+    for variable in exec_config.get("env") or []:
+        env[variable["name"]] = variable["value"]
+    process = await asyncio.create_subprocess_exec(
+        exec_config["command"],
+        *(exec_config.get("args") or []),
+        env=env,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    output, _ = await process.communicate()
+    if process.returncode != 0:
+        raise ValueError(
+            f"the exec plugin {exec_config['command']} of the kubeconfig failed with exit code {process.returncode}"
+        )
+    return json.loads(output)["status"]
+
+
+def expires_at(status):
+    """when the ExecCredential status expires as a unix time, None when the plugin gave no expiry"""
+    timestamp = status.get("expirationTimestamp")
+    if not timestamp:
+        return None
+    # RFC 3339, fractions of a second only parse from Python 3.11 on and do not matter here
+    timestamp = re.sub(r"\.\d+", "", timestamp).replace("Z", "+00:00")
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+class ExecSession:
+    """one exec call speaking the v4.channel.k8s.io websocket protocol on the event loop
+
+    stdout is handed to the coroutine function on_stdout and stderr to on_stderr as they arrive, stdin is written
+    while they are read so neither side waits on the other
+    """
+
+    def __init__(self, reader, writer, on_stdout, on_stderr):
+        self.reader = reader
+        self.writer = writer
+        self.on_stdout = on_stdout
+        self.on_stderr = on_stderr
+        self.status = None
+        self.closed = False
+
+    def send(self, opcode, payload):
+        if not self.writer.is_closing():
+            self.writer.write(encode_frame(opcode, payload))
+
+    async def send_stdin(self, stdin):
+        try:
+            async for chunk in stdin_chunks(stdin):
+                if self.closed:
+                    return
+                self.send(OPCODE_BINARY, bytes([STDIN]) + chunk)
+                # only what the connection takes waits in memory
+                await self.writer.drain()
+        except ConnectionError:
+            # the command gave up early, its status tells us why
+            pass
+
+    async def next_message(self):
+        payload = b""
+        while True:
+            first, second = await self.reader.readexactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+            if second & 0x80:
+                key = await self.reader.readexactly(4)
+                data = mask_payload(key, await self.reader.readexactly(length))
+            else:
+                data = await self.reader.readexactly(length)
+            if opcode == OPCODE_PING:
+                self.send(OPCODE_PONG, data)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode == OPCODE_CLOSE:
+                return None
+            payload += data
+            if first & 0x80:
+                return payload
+
+    async def pump(self):
+        """reads the next message and routes it to its channel, returns False once the session is over"""
+        if self.closed:
+            return False
+        try:
+            message = await self.next_message()
+        except (EOFError, OSError):
+            message = None
+        if message is None:
+            self.close()
+            return False
+        if not message:
+            return True
+        channel, data = message[0], message[1:]
+        if channel == STDOUT:
+            await self.on_stdout(data)
+        elif channel == STDERR:
+            self.on_stderr(data.decode("utf-8", errors="replace"))
+        elif channel == STATUS:
+            self.status = json.loads(data.decode("utf-8"))
+        return True
+
+    async def wait(self):
+        while await self.pump():
+            pass
+        if self.status is None:
+            return 1
+        return exit_code_from_status(self.status)
+
+    async def exchange(self, stdin=None):
+        """sends stdin while the output is read and returns the exit code"""
+        if stdin is None:
+            return await self.wait()
+        _, returncode = await asyncio.gather(self.send_stdin(stdin), self.wait())
+        return returncode
+
+    def abort(self):
+        # called by the timer of the loop, the pending read returns EOF and the session ends
+        self.writer.transport.abort()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.send(OPCODE_CLOSE, b"")
+        self.writer.close()
+
+
+class K8sApi:
+    """talks to the Kubernetes API in process, kubeconfig is read once and the REST connection is pooled
+
+    pods are listed with pykube on the thread pool of the engine, exec runs on the event loop over a websocket
+    """
+
+    def __init__(self, k8s_context=None, k8s_config=None, timeout=30):
+        config = pykube.KubeConfig.from_file(k8s_config)
+        if k8s_context is not None:
+            config.set_current_context(k8s_context)
+        self.config = config
+        self.api = pykube.HTTPClient(config)
+        self.timeout = timeout
+        self.ssl_context = None
+        # client certificates handed out by an exec plugin, kept as files for the ssl module
+        self.exec_cert = None
+        # the ExecCredential of the exec plugin, used by every session until it expires
+        self.credential = None
+        self.credential_lock = None
+
+    def get_pods(self, namespace, labels):
+        pods = pykube.Pod.objects(self.api).filter(namespace=namespace, selector=labels)
+        return [pod.name for pod in pods]
+
+    async def auth(self):
+        """the Authorization header and client certificate of the kubeconfig user, the same ones kubectl uses"""
+        user = self.config.user
+        headers = {}
+        cert = None
+        if user.get("token"):
+            headers["Authorization"] = f"Bearer {user['token']}"
+        elif "exec" in user:
+            status = await self.exec_status(user["exec"])
+            if status.get("token"):
+                headers["Authorization"] = f"Bearer {status['token']}"
+            elif status.get("clientCertificateData") and status.get("clientKeyData"):
+                cert = tuple(f.name for f in self.exec_cert)
+            else:
+                raise ValueError(
+                    "the exec plugin of the kubeconfig returned neither a token nor a client certificate"
+                )
+        elif user.get("username") and user.get("password"):
+            basic = f"{user['username']}:{user['password']}".encode("utf-8")
+            headers["Authorization"] = f"Basic {base64.b64encode(basic).decode()}"
+        elif "auth-provider" in user:
+            provider = user["auth-provider"].get("config", {})
+            token = provider.get("id-token") or provider.get("access-token")
+            if not token:
+                raise ValueError(
+                    "the auth-provider of the kubeconfig holds no token, refresh it with any kubectl command or use --backend kubectl"
+                )
+            headers["Authorization"] = f"Bearer {token}"
+        if "client-certificate" in user:
+            cert = (
+                user["client-certificate"].filename(),
+                user["client-key"].filename(),
+            )
+        return headers, cert
+
+    async def exec_status(self, exec_config):
+        """the cached ExecCredential status, the plugin only runs again once it expired (or was refused)"""
+        if self.credential_lock is None:
+            self.credential_lock = asyncio.Lock()
+        # the sessions of every pod start together, only the first one runs the plugin
+        async with self.credential_lock:
+            if self.credential is not None:
+                expiry = expires_at(self.credential)
+                if expiry is None or time.time() < expiry - EXEC_CREDENTIAL_MARGIN:
+                    return self.credential
+            status = await exec_credential(exec_config)
+            if status.get("clientCertificateData") and status.get("clientKeyData"):
+                if self.exec_cert is None:
+                    self.exec_cert = [
+                        tempfile.NamedTemporaryFile(mode="w", suffix=".pem")
+                        for _ in range(2)
+                    ]
+                for f, data in zip(
+                    self.exec_cert,
+                    (status["clientCertificateData"], status["clientKeyData"]),
+                ):
+                    f.seek(0)
+                    f.truncate()
+                    f.write(data)
+                    f.flush()
+                # the context loaded the certificate that expired
+                self.ssl_context = None
+            self.credential = status
+            return status
+
+    def create_ssl_context(self, cert):
+        if self.ssl_context is None:
+            cluster = self.config.cluster
+            context = ssl.create_default_context()
+            if "certificate-authority" in cluster:
+                context.load_verify_locations(
+                    cafile=cluster["certificate-authority"].filename()
+                )
+            elif cluster.get("insecure-skip-tls-verify"):
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if cert is not None:
+                context.load_cert_chain(*cert)
+            self.ssl_context = context
+        return self.ssl_context
+
+    async def exec(
+        self, namespace, pod_name, argv, stdin, container, on_stdout, on_stderr
+    ):
+        params = [("command", arg) for arg in argv]
+        params += [("stdin", "true" if stdin else "false")]
+        params += [("stdout", "true"), ("stderr", "true")]
+        if container:
+            params += [("container", container)]
+        url = urlparse(self.api.url)
+        path = f"{url.path.rstrip('/')}/api/v1/namespaces/{namespace}/pods/{pod_name}/exec?{urlencode(params)}"
+        headers, cert = await self.auth()
+        default_port = 443 if url.scheme == "https" else 80
+        tls = {}
+        if url.scheme == "https":
+            tls["ssl"] = self.create_ssl_context(cert)
+            tls["server_hostname"] = self.config.cluster.get(
+                "tls-server-name", url.hostname
+            )
+        # the websocket takes the connection over, so every session opens its own, only the kubeconfig, the
+        # credential and the ssl context are shared
+        # commands can run for a long time without output, only the handshake is bounded
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, url.port or default_port, **tls),
+            self.timeout,
+        )
+        request = [
+            f"GET {path} HTTP/1.1",
+            f"Host: {url.netloc}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}",
+            "Sec-WebSocket-Version: 13",
+            "Sec-WebSocket-Protocol: v4.channel.k8s.io",
+        ]
+        if "Authorization" in headers:
+            request.append(f"Authorization: {headers['Authorization']}")
+        writer.write(("\r\n".join(request) + "\r\n\r\n").encode("utf-8"))
+        try:
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            if b" 101 " not in status_line:
+                if b" 401 " in status_line:
+                    # the credential was revoked before it expired, the next session asks the plugin again
+                    self.credential = None
+                body = await asyncio.wait_for(reader.read(4096), self.timeout)
+                raise Exception(
+                    f"exec on pod {pod_name} failed: {status_line.decode('utf-8', errors='replace').strip()} {body.decode('utf-8', errors='replace')}"
+                )
+        except BaseException:
+            writer.close()
+            raise
+        return ExecSession(reader, writer, on_stdout, on_stderr)
+
+    async def run(
+        self,
+        namespace,
+        pod_name,
+        argv,
+        pod_log,
+        stdin=None,
+        container=None,
+        timeout=None,
+        phase=None,
+    ):
+        """runs argv with stdin (bytes or a file) and its output going to pod_log, raises PhaseTimeout or BadExitCode"""
+        pod_log.append(f"running command {shlex.join(argv)} through the API\n")
+        pod_log.append("output:\t")
+        # output goes to the log as it arrives so a chatty command is never held in memory
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        async def log_stdout(data):
+            pod_log.append(decoder.decode(data))
+
+        session = await self.exec(
+            namespace,
+            pod_name,
+            argv,
+            stdin is not None,
+            container,
+            log_stdout,
+            pod_log.append,
+        )
+        watch = Watch(session, timeout, ExecSession.abort)
+        try:
+            returncode = await session.exchange(stdin)
+        finally:
+            watch.cancel()
+            session.close()
+        pod_log.append(decoder.decode(b"", final=True) + "\n\n")
+        if watch.fired:
+            raise PhaseTimeout(phase, timeout)
+        if returncode != 0:
+            raise BadExitCode(returncode)
+
+    async def stream(
+        self,
+        engine,
+        namespace,
+        pod_name,
+        argv,
+        pod_log,
+        consume,
+        stdin=None,
+        container=None,
+        timeout=None,
+        phase=None,
+    ):
+        """runs argv with its stdout handed to consume as a file on the thread pool of engine, returns what consume returned
+
+        the loop writes stdout into a pipe that consume reads, so a slow consumer holds the session back
+        instead of the data piling up in memory
+        """
+        pod_log.append(f"running command {shlex.join(argv)} through the API\n")
+        pod_log.append("output:\t")
+        read_fd, write_fd = os.pipe()
+        stdout = os.fdopen(read_fd, "rb")
+        try:
+            pipe = await open_pipe(write_fd)
+        except BaseException:
+            stdout.close()
+            os.close(write_fd)
+            raise
+
+        async def relay(data):
+            if pipe.is_closing():
+                return
+            pipe.write(data)
+            try:
+                await pipe.drain()
+            except ConnectionError:
+                # consume stopped reading, what is left of stdout is dropped
+                pipe.close()
+
+        def read():
+            try:
+                result = consume(stdout)
+                # drain whatever trails the data (e.g. tar padding) so the session ends cleanly
+                while stdout.read(CHUNK_SIZE):
+                    pass
+                return result
+            finally:
+                stdout.close()
+
+        # stdout carries the data so only stderr goes to the log
+        try:
+            session = await self.exec(
+                namespace,
+                pod_name,
+                argv,
+                stdin is not None,
+                container,
+                relay,
+                pod_log.append,
+            )
+        except BaseException:
+            pipe.close()
+            stdout.close()
+            raise
+
+        async def exchange():
+            try:
+                return await session.exchange(stdin)
+            finally:
+                # consume reads to the end of the pipe, which is the end of stdout
+                pipe.close()
+
+        watch = Watch(session, timeout, ExecSession.abort)
+        exchanging = asyncio.ensure_future(exchange())
+        try:
+            try:
+                result = await engine.call(read)
+            except BaseException:
+                session.abort()
+                # a cut off stream is only the symptom of the timeout
+                if not watch.fired:
+                    raise
+            finally:
+                await asyncio.wait({exchanging})
+        finally:
+            watch.cancel()
+            session.close()
+        pod_log.append("\n\n")
+        if watch.fired:
+            raise PhaseTimeout(phase, timeout)
+        returncode = exchanging.result()
+        if returncode != 0:
+            raise BadExitCode(returncode)
+        return result
+
+    async def copy_to(
+        self,
+        namespace,
+        pod_name,
+        src,
+        dest,
+        pod_log,
+        container=None,
+        timeout=None,
+        phase=None,
+    ):
+        # v4.channel.k8s.io has no way to close stdin, so the pod reads exactly the bytes we send
+        argv = ["sh", "-c", f"head -c {os.path.getsize(src)} > {shlex.quote(dest)}"]
+        with open(src, "rb") as f:
+            await self.run(
+                namespace,
+                pod_name,
+                argv,
+                pod_log,
+                stdin=f,
+                container=container,
+                timeout=timeout,
+                phase=phase,
+            )
+
+    async def copy_from(
+        self,
+        engine,
+        namespace,
+        pod_name,
+        src,
+        dest,
+        pod_log,
+        container=None,
+        timeout=None,
+        phase=None,
+    ):
+        def save(stdout):
+            with open(dest, "wb") as f:
+                shutil.copyfileobj(stdout, f)
+
+        await self.stream(
+            engine,
+            namespace,
+            pod_name,
+            ["cat", src],
+            pod_log,
+            save,
+            container=container,
+            timeout=timeout,
+            phase=phase,
+        )
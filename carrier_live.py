@@ -0,0 +1,75 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import os
+import shutil
+
+DEFAULT_LIVE_DIR = "live"
+DEFAULT_LIVE_INTERVAL = 5.0
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def read_line(stream):
+    # the session can be a plain stream without readline, a header is short enough to read byte by byte
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = stream.read(1)
+        if not byte:
+            break
+        line += byte
+    return line
+
+
+def copy_exactly(stream, f, size):
+    while size > 0:
+        chunk = stream.read(min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError(f"the live stream ended {size} bytes short")
+        f.write(chunk)
+        size -= len(chunk)
+
+
+class LiveFiles:
+    """the files of one node as they grow on the node, kept under <live dir>/<node>/ while the script runs"""
+
+    def __init__(self, live_dir, node):
+        self.dir = os.path.join(live_dir, node)
+        # a file left from an earlier run would end up in the final archive next to the new ones
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir)
+        self.bytes = 0
+        self.changes = 0
+
+    def path(self, name):
+        path = os.path.normpath(name)
+        if os.path.isabs(path) or path.split(os.sep)[0] == "..":
+            raise ValueError(f"refusing to write {name} outside of {self.dir}")
+        return os.path.join(self.dir, path)
+
+    def consume(self, stdout):
+        """appends every change the live bootstrap sends until the session ends"""
+        while True:
+            header = read_line(stdout)
+            if not header:
+                return
+            offset, length, name = header.decode("utf-8").rstrip("\n").split(" ", 2)
+            offset, length = int(offset), int(length)
+            target = self.path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "r+b" if os.path.exists(target) else "wb") as f:
+                # a file sent again from the start shrank on the node, it is replaced rather than appended to
+                f.truncate(offset)
+                f.seek(offset)
+                copy_exactly(stdout, f, length)
+            self.bytes += length
+            self.changes += 1
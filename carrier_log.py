@@ -0,0 +1,58 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import collections
+import os
+from threading import Lock
+
+DEFAULT_LOG_DIR = "pod-logs"
+DEFAULT_TAIL_LINES = 100
+# a line longer than this (e.g. binary output) is cut so the tail stays small
+MAX_LINE_LENGTH = 4096
+
+
+class NodeLog:
+    """the log of one node, written to disk as it comes in with only its last lines kept in memory
+
+    it is appended to like a list so it can be handed to anything that used to collect output into one,
+    the file is only open between the first append and close so nodes waiting for a transfer slot hold no handle
+    """
+
+    def __init__(self, path, tail_lines=DEFAULT_TAIL_LINES):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        open(path, "w").close()
+        self.handle = None
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.partial = ""
+        self.lock = Lock()
+
+    def append(self, text):
+        # stderr is logged from its own thread while stdout is logged from the node thread
+        with self.lock:
+            if self.handle is None:
+                self.handle = open(self.path, "a")
+            self.handle.write(text)
+            self.handle.flush()
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()[-MAX_LINE_LENGTH:]
+            self.tail.extend(line[-MAX_LINE_LENGTH:] for line in lines)
+
+    def tail_text(self):
+        with self.lock:
+            return "\n".join(list(self.tail) + [self.partial])
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
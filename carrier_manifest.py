@@ -0,0 +1,153 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import os
+import time
+from threading import Lock
+
+from carrier_archive import count_members
+from carrier_sched import PhaseTimeout
+
+# the name of the run manifest inside the final archive, and of the copy kept next to it while the run goes
+MANIFEST_NAME = "carrier-run.json"
+# the copy next to the final archive is written at most this often, a crash only loses the nodes of the last second
+CHECKPOINT_INTERVAL = 1.0
+# where the final archive of the run being resumed is moved to while the new one is written
+PREVIOUS_SUFFIX = ".previous"
+
+DONE = "done"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+
+class RunManifest:
+    """what happened to every node of a run"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.lock = Lock()
+        self.saved = 0
+
+    def update(self, node, **fields):
+        with self.lock:
+            self.nodes.setdefault(node, {}).update(fields)
+
+    def done(self, node, archive, members=None):
+        """a node whose execute phase timed out keeps that status, its archive only has what was written in time
+
+        members is how many members of the final archive the node takes up, so a resumed run can check they are all there
+        """
+        with self.lock:
+            fields = self.nodes.setdefault(node, {})
+            if fields.get("status") == TIMED_OUT:
+                fields["partial"] = True
+            else:
+                fields["status"] = DONE
+            fields["archive"] = archive
+            if members is not None:
+                fields["members"] = members
+
+    def timed_out(self, node, error):
+        self.update(node, status=TIMED_OUT, phase=error.phase, error=str(error))
+
+    def failed(self, node, error):
+        if isinstance(error, PhaseTimeout):
+            self.timed_out(node, error)
+        else:
+            self.update(node, status=FAILED, error=str(error))
+
+    def get(self, node):
+        with self.lock:
+            return dict(self.nodes.get(node, {}))
+
+    def to_dict(self):
+        with self.lock:
+            nodes = {node: dict(fields) for node, fields in self.nodes.items()}
+        summary = {}
+        for fields in nodes.values():
+            status = fields.get("status")
+            # a checkpoint can catch a node that is still being collected
+            if status is not None:
+                summary[status] = summary.get(status, 0) + 1
+        return {"summary": summary, "nodes": nodes}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def save(self, path, force=False, **run):
+        """writes the manifest plus run (e.g. which final archive it belongs to) to path, replacing it in one go"""
+        now = time.time()
+        if not force and now - self.saved < CHECKPOINT_INTERVAL:
+            return
+        self.saved = now
+        write_json(path, {**self.to_dict(), **run})
+
+    def resume(self, previous, bundle):
+        """copies the nodes the previous run finished into bundle and returns them, they are not run again
+
+        when the previous run never closed its final archive only nodes with every member in it are kept
+        """
+        nodes = {
+            node: fields
+            for node, fields in previous["nodes"].items()
+            if fields.get("status") == DONE and "members" in fields
+        }
+        archive = previous.get("previous_archive")
+        if archive is None:
+            return set()
+        if not previous.get("complete"):
+            counts = count_members(archive, set(nodes))
+            nodes = {
+                node: fields
+                for node, fields in nodes.items()
+                if counts.get(node, 0) == fields["members"]
+            }
+        if nodes:
+            bundle.copy_from(archive, set(nodes))
+        for node, fields in nodes.items():
+            self.update(node, **fields, resumed=True)
+        return set(nodes)
+
+
+def write_json(path, data):
+    # a crash while writing leaves the old file in place rather than half of the new one
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def load_previous_run(path, output_archive):
+    """the saved manifest of the run to resume, its final archive is moved aside so the new one can take its name"""
+    if not os.path.exists(path):
+        raise ValueError(f"there is no run to resume, {path} is missing")
+    with open(path) as f:
+        previous = json.load(f)
+    moved = output_archive + PREVIOUS_SUFFIX
+    if previous.get("bundle") is None:
+        # the run collected nothing and removed its archive, every node runs again
+        previous["previous_archive"] = None
+        return previous
+    if previous.get("bundle") not in (output_archive, moved):
+        raise ValueError(
+            f"the run to resume wrote {previous.get('bundle')}, resume it with the same --format, --compression and --stream"
+        )
+    if previous["bundle"] == output_archive and os.path.exists(output_archive):
+        os.replace(output_archive, moved)
+        previous["bundle"] = moved
+        # resuming again before the new run saves its own manifest still finds the moved archive
+        write_json(path, previous)
+    previous["previous_archive"] = None
+    if previous["bundle"] == moved and os.path.exists(moved):
+        previous["previous_archive"] = moved
+    return previous
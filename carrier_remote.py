@@ -0,0 +1,141 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import math
+import shlex
+
+from carrier_compress import DEFAULT_COMPRESSION, tar_cmd
+
+# exit codes of `timeout` when it had to stop the command, with TERM and with KILL
+TIMED_OUT_EXIT_CODES = (124, 137)
+
+# runs on the node as `sh -c BOOTSTRAP carrier <workdir> <script name> <shell> <script args>`
+# the script arrives on stdin, its output goes to stderr so stdout only carries the tar.gz of the results
+BOOTSTRAP = """n="$2"; s="$3"
+mkdir -p "$1" && {install}cd "$1" || exit 1
+d=$(pwd)
+trap 'cd / && rm -fr "$d"' EXIT
+shift 3
+head -c {size} > "$n" || exit 1
+{timeout}"$s" "$n" "$@" < /dev/null 1>&2
+rc=$?
+{tar} || [ $rc -ne 0 ] || rc=1
+exit $rc"""
+
+
+# the live variant runs the script in the background and every few seconds sends what changed in the workdir,
+# each change is a line `<offset> <length> <path>` followed by exactly length bytes of the file from offset.
+# $o holds the size sent of every file, its mtime is when the last sweep started so `-newer` finds files written since
+LIVE_BOOTSTRAP = """n="$2"; s="$3"
+mkdir -p "$1" && {install}cd "$1" || exit 1
+d=$(pwd)
+o="$d.sent"
+trap 'cd / && rm -fr "$d" "$o" "$o.next" "$o.touched"' EXIT
+shift 3
+head -c {size} > "$n" || exit 1
+: > "$o"
+sweep() {{
+  : > "$o.next"
+  find . -type f -newer "$o" > "$o.touched"
+  find . -type f ! -path "./$n"{excludes} -exec wc -c {{}} + | awk -v o="$o" '{changes}' |
+  while read -r off len f; do
+    printf '%s %s %s\\n' "$off" "$len" "$f"
+    (tail -c +$((off + 1)) "$f"; cat /dev/zero) 2>/dev/null | head -c "$len"
+  done
+  mv "$o.next" "$o"
+}}
+{timeout}"$s" "$n" "$@" < /dev/null 1>&2 &
+p=$!
+while kill -0 $p 2>/dev/null; do
+  sleep {interval}
+  sweep
+done
+wait $p
+rc=$?
+sweep
+exit $rc"""
+
+# reads `wc -c` of every file, the sizes sent so far from o and the files written since the last sweep from o.touched,
+# writes the new sizes to o.next and prints `<offset> <length> <path>` for every file that grew. A file is sent again
+# whole when it shrank (e.g. it was rotated) or was written without growing, anything else is taken to be appended to
+LIVE_CHANGES = """BEGIN {
+  while ((getline l < o) > 0) { i = index(l, " "); sent[substr(l, i + 1)] = substr(l, 1, i - 1) }
+  while ((getline l < (o ".touched")) > 0) touched[l] = 1
+}
+{ size = $1 + 0; sub(/^ *[0-9]+ /, ""); if (substr($0, 1, 2) != "./") next
+  printf "%.0f %s\\n", size, $0 > (o ".next")
+  off = ($0 in sent) ? sent[$0] + 0 : 0
+  if (size < off || (size == off && $0 in touched)) off = 0
+  if (size > off) printf "%.0f %.0f %s\\n", off, size - off, $0 }"""
+
+
+class BadExitCode(Exception):
+    def __init__(self, returncode):
+        super().__init__("bad exit code " + str(returncode))
+        self.returncode = returncode
+
+
+def remote_timeout(timeout):
+    """prefix that stops a remote command after timeout seconds, killing it 5 seconds later if it ignores TERM"""
+    if timeout is None:
+        return ""
+    return f"timeout -k 5 {max(math.ceil(timeout), 1)} "
+
+
+def timed_out_remotely(error):
+    return getattr(error, "returncode", None) in TIMED_OUT_EXIT_CODES
+
+
+def bootstrap_cmd(
+    workdir,
+    script_name,
+    shell,
+    script_args_str,
+    script_size,
+    timeout=None,
+    compression=DEFAULT_COMPRESSION,
+    compression_level=None,
+    install=None,
+    attachment_names=(),
+    live_interval=None,
+):
+    """one command that creates the workdir, reads the script from stdin, runs it, writes the results to stdout and cleans up
+
+    with a timeout the script is stopped when it runs out and whatever it wrote so far is still sent back,
+    install puts the attached files into the workdir before the script runs and they are left out of the results,
+    with a live_interval the results are sent every live_interval seconds as they grow instead of as one tar at the end
+    """
+    install = "" if not install else f"{install} && "
+    if live_interval is not None:
+        bootstrap = LIVE_BOOTSTRAP.format(
+            size=script_size,
+            timeout=remote_timeout(timeout),
+            install=install,
+            excludes="".join(
+                f" ! -path {shlex.quote('./' + name)}" for name in attachment_names
+            ),
+            changes=LIVE_CHANGES,
+            interval=f"{live_interval:g}",
+        )
+    else:
+        bootstrap = BOOTSTRAP.format(
+            size=script_size,
+            timeout=remote_timeout(timeout),
+            install=install,
+            tar=tar_cmd(
+                compression, compression_level, "-", ".", ['"$n"', *attachment_names]
+            ),
+        )
+    cmd = f"sh -c {shlex.quote(bootstrap)} carrier {shlex.quote(str(workdir))} {shlex.quote(script_name)} {shell}"
+    if script_args_str:
+        cmd += f" {script_args_str}"
+    return cmd
@@ -0,0 +1,371 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+from carrier_archive import DEFAULT_FORMAT, bundle_name, open_bundle
+from carrier_cache import Artifact, check_names
+from carrier_compress import DEFAULT_COMPRESSION, archive_name, decompressed
+from carrier_engine import Engine, run_coroutine
+from carrier_impact import LOW_IMPACT_NODE_BANDWIDTH, NodeUsage, Throttle
+from carrier_live import DEFAULT_LIVE_DIR, DEFAULT_LIVE_INTERVAL
+from carrier_manifest import MANIFEST_NAME, RunManifest, load_previous_run
+from carrier_sched import (
+    DEFAULT_PARALLELISM,
+    DEFAULT_TRANSFER_PARALLELISM,
+    Deadline,
+    PhaseTimeout,
+    Scheduler,
+    StartBarrier,
+)
+from carrier_sync import start_at_cmd
+from carrier_trace import CountingReader, Trace
+
+
+def work_path(work_dir, path):
+    """path as given by a user working in work_dir, absolute paths and no work_dir leave it as it is"""
+    if work_dir is None or path is None:
+        return path
+    return os.path.join(work_dir, path)
+
+
+class RunnerParser(argparse.ArgumentParser):
+    """writes the help and the errors to out and err instead of the stdout and stderr of the process"""
+
+    def __init__(self, out=None, err=None, **kwargs):
+        super().__init__(**kwargs)
+        self.out = out
+        self.err = err
+
+    def print_usage(self, file=None):
+        # argparse prints the usage to stderr before an error
+        if file is None:
+            file = self.out
+        elif file is sys.stderr and self.err is not None:
+            file = self.err
+        super().print_usage(file)
+
+    def print_help(self, file=None):
+        super().print_help(file or self.out)
+
+    def exit(self, status=0, message=None):
+        if message:
+            (self.err or sys.stderr).write(message)
+        super().exit(status)
+
+
+class Runner:
+    """what carrier.py and carrier_k8s.py share: the final archive, the run manifest and the scheduling of the nodes
+
+    a runner lists its nodes with get_nodes, returns the execute and collect steps the scheduler runs for every
+    node from steps and says why a finished node failed, if it did, with failure
+    """
+
+    # how the nodes are called in the messages of the run
+    NODES = "nodes"
+
+    def __init__(
+        self,
+        script,
+        shell,
+        script_args,
+        output_archive=None,
+        stream=False,
+        single_session=False,
+        parallelism=DEFAULT_PARALLELISM,
+        transfer_parallelism=DEFAULT_TRANSFER_PARALLELISM,
+        trace_dir=None,
+        timeout=None,
+        phase_timeouts=None,
+        compression=DEFAULT_COMPRESSION,
+        compression_level=None,
+        format=DEFAULT_FORMAT,
+        attachments=None,
+        resume=False,
+        live=False,
+        live_dir=DEFAULT_LIVE_DIR,
+        live_interval=DEFAULT_LIVE_INTERVAL,
+        sync_start=None,
+        low_impact=False,
+        node_bandwidth=None,
+        total_bandwidth=None,
+        warm=None,
+        work_dir=None,
+        out=None,
+        err=None,
+    ):
+        # relative paths are taken from work_dir rather than the working directory of the process, a daemon runs
+        # the collections of clients working in other directories
+        self.work_dir = work_dir
+        # where the progress goes, the stdout and stderr of the process when not given
+        self.out = out
+        self.err = err
+        script = work_path(work_dir, script)
+        attachments = [work_path(work_dir, a) for a in attachments or []]
+        self.script = script
+        self.shell = shell
+        self.script_args = script_args
+        self.compression = compression
+        self.compression_level = compression_level
+        self.format = format
+        self.attachments = attachments
+        self.resume = resume
+        check_names([script] + self.attachments)
+        # a daemon keeps the hashed files between runs, and whatever else the runner can use again
+        self.warm = warm
+        self.artifacts = {} if warm is None else warm.artifacts
+        self.loaded = set()
+        self.live = live
+        self.live_dir = work_path(work_dir, live_dir)
+        self.live_interval = live_interval
+        if live:
+            # the files arrive over the session that runs the script and go into the final archive like streamed ones
+            stream = True
+            single_session = True
+        if sync_start is not None and single_session:
+            raise ValueError(
+                "--sync-start copies the script before it starts, a single session (also used by --live) does both at once"
+            )
+        self.sync_start = sync_start
+        self.start_barrier = None
+        self.low_impact = low_impact
+        if low_impact and node_bandwidth is None:
+            node_bandwidth = LOW_IMPACT_NODE_BANDWIDTH
+        self.throttle = Throttle(node_bandwidth, total_bandwidth)
+        self.usage = NodeUsage()
+        # the extension follows how the final archive is compressed, output.tar by default
+        if output_archive is None:
+            output_archive = bundle_name("output", format, compression, stream)
+        self.output_archive = work_path(work_dir, output_archive)
+        self.stream = stream
+        self.single_session = single_session
+        self.parallelism = parallelism
+        self.transfer_parallelism = transfer_parallelism
+        self.trace_dir = work_path(work_dir, trace_dir)
+        self.trace = Trace()
+        self.bundle = None
+        self.timeout = timeout
+        self.phase_timeouts = phase_timeouts
+        self.deadline = Deadline(timeout, phase_timeouts)
+        self.manifest = RunManifest()
+        # the readers of streams (and the calls of the api backend) are the only threads, bounded by the slots
+        self.engine = Engine(parallelism + transfer_parallelism)
+
+    async def get_nodes(self):
+        raise NotImplementedError
+
+    def steps(self):
+        raise NotImplementedError
+
+    def failure(self, node, task):
+        raise NotImplementedError
+
+    async def close_sessions(self):
+        # whatever the nodes kept open until the end of the run
+        pass
+
+    def describe(self, node):
+        return node
+
+    def feedback(self, text):
+        print(text, file=self.out)
+
+    def local_archive(self, node):
+        return work_path(self.work_dir, archive_name(node, self.compression))
+
+    def load_artifacts(self, *paths):
+        # every file is hashed once per run, not once per node, and a daemon only hashes it again once it changed
+        keys = [os.path.abspath(path) for path in paths]
+        for key in keys:
+            if key not in self.loaded:
+                if key not in self.artifacts or self.artifacts[key].changed():
+                    self.artifacts[key] = Artifact(key)
+                self.loaded.add(key)
+        return [self.artifacts[key] for key in keys]
+
+    def excluded_names(self):
+        # the script and the attached files are inputs, they are left out of the results
+        return [Path(self.script).name] + [Path(a).name for a in self.attachments]
+
+    def stream_into_bundle(self, node, phase):
+        def consume(stdout):
+            reader = CountingReader(stdout)
+            with decompressed(reader, self.compression) as members:
+                count = self.bundle.add_stream(members, node)
+            phase["bytes"] = reader.bytes
+            # a resumed run checks every member of the node made it into the final archive
+            self.manifest.update(node, members=count)
+
+        return consume
+
+    async def add_live_files(self, node, live):
+        # the files are complete locally by now, only the final archive is still missing them
+        with self.trace.phase(node, "local_archive"):
+            members = await self.engine.call(self.bundle.add_directory, live.dir, node)
+        # a resumed run checks every member of the node made it into the final archive
+        self.manifest.update(node, members=members)
+
+    def script_timed_out(self, node, timeout, phase):
+        """records that the script of node ran out of time and returns the timeout"""
+        # the node still counts as collected, the manifest records that its files are partial
+        phase["timed_out"] = True
+        error = PhaseTimeout("execute", timeout)
+        self.manifest.timed_out(node, error)
+        self.feedback(
+            f"{self.describe(node)} timed out running the script, collecting what it wrote so far"
+        )
+        return error
+
+    async def wait_for_start(self, node, offset):
+        """waits for every node to be staged, returns the command holding the script until the common start and how far off that is
+
+        offset is how far the clock of node is ahead of the local one
+        """
+        with self.trace.phase(node, "barrier"):
+            start = await self.start_barrier.arrive(
+                node, self.deadline.limit("execute")
+            )
+        # the start in the clock of the node, the offset is what lines them up
+        self.manifest.update(
+            node, clock_offset=round(offset, 3), start=round(start + offset, 3)
+        )
+        return start_at_cmd(start + offset) + " && ", max(start - time.time(), 0)
+
+    def checkpoint_path(self):
+        # the manifest is kept next to the final archive while the run goes so it can be resumed
+        return os.path.join(os.path.dirname(self.output_archive), MANIFEST_NAME)
+
+    def save_manifest(self, force=False, complete=False):
+        self.manifest.save(
+            self.checkpoint_path(),
+            force,
+            bundle=self.output_archive,
+            complete=complete,
+        )
+
+    def close_bundle(self, successful):
+        # which nodes finished, failed or timed out and in which phase
+        self.bundle.add_data(MANIFEST_NAME, self.manifest.to_json().encode("utf-8"))
+        self.bundle.close()
+        if successful > 0:
+            self.save_manifest(force=True, complete=True)
+            return
+        # an archive without any node is not kept, the checkpoint says so instead of pointing at it
+        os.remove(self.output_archive)
+        self.manifest.save(self.checkpoint_path(), True, bundle=None, complete=True)
+
+    def run(self):
+        return run_coroutine(self.run_async())
+
+    async def run_async(self):
+        nodes = await self.get_nodes()
+        failed = 0
+        # the deadline counts from the start of the run, not from when the runner was created
+        self.deadline = Deadline(self.timeout, self.phase_timeouts)
+        previous = None
+        if self.resume:
+            previous = load_previous_run(self.checkpoint_path(), self.output_archive)
+        # the final archive is written as nodes finish so archiving overlaps with the slower nodes
+        self.bundle = open_bundle(
+            self.output_archive,
+            self.format,
+            self.compression,
+            self.compression_level,
+            self.stream,
+        )
+        resumed = set()
+        if previous is not None:
+            resumed = self.manifest.resume(previous, self.bundle)
+            self.feedback(
+                f"resuming, {len(resumed)} {self.NODES} were collected already"
+            )
+        successful = len(resumed)
+        self.save_manifest(force=True)
+        self.feedback(
+            f"archiving collected files into one archive named {self.output_archive}"
+        )
+        nodes = [node for node in nodes if node not in resumed]
+        parallelism = self.parallelism
+        if self.sync_start is not None:
+            self.start_barrier = StartBarrier(nodes, self.sync_start)
+            # every node waits at the barrier holding its slot, so they all need one
+            parallelism = max(parallelism, len(nodes))
+        # the scheduler runs the script on many nodes at once while the copies back are pipelined behind it
+        scheduler = Scheduler(parallelism, self.transfer_parallelism, self.trace)
+        tasks = {}
+        try:
+            # every file is hashed before the first node starts instead of holding up the loop while nodes run
+            await self.engine.call(self.load_artifacts, self.script, *self.attachments)
+            finished = asyncio.Queue()
+            for node in nodes:
+                self.feedback(f"working with {self.describe(node)}")
+                t = scheduler.submit(node, *self.steps())
+                # nodes are handled in the order they finish so one slow node does not hold back the others
+                t.add_done_callback(finished.put_nowait)
+                tasks[t] = node
+
+            for _ in range(len(tasks)):
+                t = await finished.get()
+                node = tasks[t]
+                if self.low_impact:
+                    self.manifest.update(node, usage=self.usage.of(node))
+                reason = self.failure(node, t)
+                if reason is not None:
+                    failed += 1
+                    self.feedback(reason)
+                    self.save_manifest()
+                    continue
+                archive = node
+                members = None
+                if not self.stream:
+                    # add the node archive right away and drop the local copy so disk usage stays bounded
+                    with self.trace.phase(node, "local_archive"):
+                        local = self.local_archive(node)
+                        members = await self.engine.call(
+                            self.bundle.add_node_archive, local, node
+                        )
+                        os.remove(local)
+                        if self.format == "tar":
+                            archive = archive_name(node, self.compression)
+                self.manifest.done(node, archive, members)
+                successful += 1
+                self.feedback(f"{self.describe(node)} is done")
+                self.save_manifest()
+            if self.low_impact:
+                self.feedback(self.usage.report(self.NODES))
+        finally:
+            # nodes still running when the run is stopped must not write into the archive once it is closed
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close_sessions()
+            await self.engine.shutdown()
+            # writing the end of the final archive can take a while, it does not hold up the loop either
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.close_bundle, successful
+            )
+            if previous is not None and previous["previous_archive"] is not None:
+                os.remove(previous["previous_archive"])
+            if self.trace_dir:
+                self.trace.write(self.trace_dir)
+
+        if successful > 0:
+            return f"All done! The final archive is {self.output_archive}"
+        else:
+            return (
+                f"no successful collections out of {successful + failed} {self.NODES}"
+            )
@@ -0,0 +1,207 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import os
+import signal
+import time
+
+DEFAULT_PARALLELISM = 64
+DEFAULT_TRANSFER_PARALLELISM = 8
+# once the deadline has passed collecting may still take this long, so partial results come back
+DEFAULT_GRACE = 120
+# a single session collects too, so it gets the grace as well
+COLLECT_PHASES = ("archive", "download", "cleanup", "session")
+# local processes get a little longer than the remote timeout so the node can report back first
+WATCHDOG_SLACK = 10
+
+
+class PhaseTimeout(Exception):
+    def __init__(self, phase, timeout):
+        if timeout > 0:
+            message = f"{phase} timed out after {timeout:.0f} seconds"
+        else:
+            message = f"deadline passed before {phase}"
+        super().__init__(message)
+        self.phase = phase
+        self.timeout = timeout
+
+
+class Deadline:
+    """the global deadline of a run plus optional limits per phase"""
+
+    def __init__(self, timeout=None, phase_timeouts=None, grace=DEFAULT_GRACE):
+        self.end = None if timeout is None else time.time() + timeout
+        self.phase_timeouts = phase_timeouts or {}
+        self.grace = grace
+
+    def limit(self, phase):
+        """seconds the phase may take from now, None when nothing limits it"""
+        limit = self.phase_timeouts.get(phase)
+        if self.end is not None:
+            remaining = self.end - time.time()
+            if phase in COLLECT_PHASES:
+                remaining = max(remaining, 0) + self.grace
+            limit = remaining if limit is None else min(limit, remaining)
+        return limit
+
+    def check(self, phase):
+        """like limit but raises PhaseTimeout when there is no time left to start the phase"""
+        limit = self.limit(phase)
+        if limit is not None and limit <= 0:
+            raise PhaseTimeout(phase, 0)
+        return limit
+
+
+def parse_phase_timeouts(values):
+    """turns ['execute=600', 'download=120'] into {'execute': 600.0, 'download': 120.0}"""
+    phase_timeouts = {}
+    for value in values or []:
+        phase, _, seconds = value.partition("=")
+        phase_timeouts[phase] = float(seconds)
+    return phase_timeouts
+
+
+def kill_process_group(process):
+    # the process was started with start_new_session=True so the shell and the ssh or kubectl it runs go together
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class Scheduler:
+    """bounds the execute phase of the nodes with one semaphore and their transfer phase with another
+
+    a node gives its execute slot back as soon as it is executed and waits for a transfer slot, so copies are
+    pipelined behind execution without every download starting at once. It is made inside the running loop
+    """
+
+    def __init__(
+        self,
+        parallelism=DEFAULT_PARALLELISM,
+        transfer_parallelism=DEFAULT_TRANSFER_PARALLELISM,
+        trace=None,
+    ):
+        self.trace = trace
+        self.execute_slots = asyncio.Semaphore(parallelism)
+        self.transfer_slots = asyncio.Semaphore(transfer_parallelism)
+
+    async def queued(self, node, phase, slots, func, *args):
+        # the time a node spends waiting for a free slot shows up as its own phase
+        since = time.time()
+        async with slots:
+            if self.trace is not None:
+                self.trace.record(node, phase, since, time.time())
+            return await func(*args)
+
+    def submit(self, node, execute, transfer=None):
+        """returns a task for the whole node, transfer gets the node and the result of execute"""
+
+        async def run():
+            result = await self.queued(node, "queue", self.execute_slots, execute, node)
+            if transfer is None:
+                return result
+            return await self.queued(
+                node, "transfer_queue", self.transfer_slots, transfer, node, result
+            )
+
+        return asyncio.ensure_future(run())
+
+
+class RelayTree:
+    """nodes get their files from a parent node instead of the local machine
+
+    the nodes form a tree with fanout children per node in the order they are given, the first fanout nodes
+    are fed from the local machine, so the files reach n nodes in about log(n) rounds of copies
+    """
+
+    def __init__(self, nodes, fanout):
+        self.parents = {}
+        for i, node in enumerate(nodes):
+            parent = i // fanout - 1
+            self.parents[node] = nodes[parent] if parent >= 0 else None
+        self.events = {}
+        self.holding = set()
+
+    def released(self, node):
+        # the events are made on first use so they belong to the loop of the run
+        if node not in self.events:
+            self.events[node] = asyncio.Event()
+        return self.events[node]
+
+    def ready(self, node):
+        """node holds every file now, its children can copy from it"""
+        self.holding.add(node)
+        self.released(node).set()
+
+    def release(self, node):
+        # a node that failed still has to let its children go, they move on to the next ancestor
+        self.released(node).set()
+
+    async def source(self, node, timeout=None):
+        """the closest ancestor holding the files, None when they have to come from the local machine
+
+        parents are always submitted first, so waiting on one never waits on a node without a slot
+        """
+        parent = self.parents.get(node)
+        end = None if timeout is None else time.time() + timeout
+        while parent is not None:
+            wait = None if end is None else max(end - time.time(), 0)
+            try:
+                await asyncio.wait_for(self.released(parent).wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            if parent in self.holding:
+                return parent
+            parent = self.parents[parent]
+        return None
+
+
+class StartBarrier:
+    """holds every node once it is staged until all of them are, then lets them start at one common time
+
+    the start is lead seconds after the last node arrived so every node gets the command to start in time,
+    it is made inside the running loop
+    """
+
+    def __init__(self, nodes, lead):
+        self.staging = set(nodes)
+        self.lead = lead
+        self.start = None
+        self.fixed = asyncio.Event()
+
+    def fix_start(self):
+        if self.start is None:
+            self.start = time.time() + self.lead
+            self.fixed.set()
+
+    async def arrive(self, node, timeout=None):
+        """the local time every node starts at, waits for the nodes still staging first
+
+        when the timeout runs out the others start without the nodes still staging, those start once they are staged
+        """
+        self.staging.discard(node)
+        if not self.staging:
+            self.fix_start()
+        try:
+            await asyncio.wait_for(self.fixed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.fix_start()
+        return self.start
+
+    def leave(self, node):
+        # a node that failed while staging does not hold back the others
+        self.staging.discard(node)
+        if not self.staging:
+            self.fix_start()
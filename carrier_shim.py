@@ -0,0 +1,166 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# stand-ins for ssh, scp and kubectl used by carrier_bench.py, every node is a local directory
+# this runs once per command so it only uses the standard library and starts with `python -S`
+import os
+import random
+import shutil
+import sys
+import time
+
+ROOT_ENV = "CARRIER_BENCH_ROOT"
+NODES_ENV = "CARRIER_BENCH_NODES"
+LATENCY_ENV = "CARRIER_BENCH_LATENCY"
+FAILURE_RATE_ENV = "CARRIER_BENCH_FAILURE_RATE"
+SEED_ENV = "CARRIER_BENCH_SEED"
+
+# options of ssh and scp that take a value, everything else is a flag
+SSH_VALUE_OPTIONS = "BbcDEeFIiJLlmOopQRSWw"
+SCP_VALUE_OPTIONS = "cDFiJloPSX"
+KUBECTL_VALUE_OPTIONS = (
+    "--context",
+    "--kubeconfig",
+    "-n",
+    "--namespace",
+    "-l",
+    "-o",
+    "-c",
+)
+
+
+def node_name(index):
+    return f"node-{index}"
+
+
+def node_dir(node):
+    return os.path.join(os.environ[ROOT_ENV], node)
+
+
+def is_failing(node, failure_rate, seed=0):
+    # decided per node and seed, so the benchmark knows up front how many nodes should come back
+    return random.Random(f"{seed}:{node}").random() < failure_rate
+
+
+def connect(tool, node):
+    time.sleep(float(os.environ.get(LATENCY_ENV, 0)))
+    failure_rate = float(os.environ.get(FAILURE_RATE_ENV, 0))
+    seed = os.environ.get(SEED_ENV, "0")
+    if not os.path.isdir(node_dir(node)) or is_failing(node, failure_rate, seed):
+        sys.stderr.write(f"{tool}: connect to host {node}: Connection refused\n")
+        sys.exit(255)
+
+
+def parse_options(args, value_options):
+    """splits getopt style options from the positional arguments, returns (options, positional)"""
+    options = {}
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        flags = args[i][1:]
+        for j, flag in enumerate(flags):
+            if flag in value_options:
+                value = flags[j + 1 :]
+                if not value:
+                    i += 1
+                    value = args[i]
+                options[flag] = value
+                break
+            options[flag] = True
+        i += 1
+    return options, args[i:]
+
+
+def ssh(args):
+    options, positional = parse_options(args, SSH_VALUE_OPTIONS)
+    node = positional[0].split("@")[-1]
+    command = " ".join(positional[1:])
+    connect("ssh", node)
+    if "O" in options or not command:
+        # control commands and background masters (-N -f) have nothing to run
+        sys.exit(0)
+    os.chdir(node_dir(node))
+    os.execv("/bin/sh", ["sh", "-c", command])
+
+
+def scp_path(spec):
+    host, sep, path = spec.partition(":")
+    if not sep or "@" not in host:
+        return spec
+    node = host.split("@")[-1]
+    connect("scp", node)
+    return os.path.join(node_dir(node), path)
+
+
+def scp(args):
+    _, (src, dest) = parse_options(args, SCP_VALUE_OPTIONS)
+    try:
+        shutil.copyfile(scp_path(src), scp_path(dest))
+    except OSError as e:
+        sys.stderr.write(f"scp: {e}\n")
+        sys.exit(1)
+
+
+def pod_path(pod, path):
+    # pods write to /tmp, which is moved into the directory of the pod
+    return path.replace("/tmp/", os.path.join(node_dir(pod), "tmp") + "/")
+
+
+def kubectl_path(spec):
+    location, sep, path = spec.partition(":")
+    if not sep or "/" not in location:
+        return spec
+    pod = location.split("/", 1)[1]
+    connect("kubectl", pod)
+    return pod_path(pod, path)
+
+
+def kubectl(args):
+    command = []
+    if "--" in args:
+        command = args[args.index("--") + 1 :]
+        args = args[: args.index("--")]
+    positional = []
+    i = 0
+    while i < len(args):
+        if args[i] in KUBECTL_VALUE_OPTIONS:
+            i += 1
+        elif not args[i].startswith("-") and args[i]:
+            positional.append(args[i])
+        i += 1
+    if positional[0] == "get" and "--watch-only" in args:
+        # the pods never change, the watch runs until it is stopped
+        while True:
+            time.sleep(3600)
+    if positional[0] == "get":
+        count = int(os.environ[NODES_ENV])
+        print(" ".join(node_name(i) for i in range(count)))
+    elif positional[0] == "exec":
+        pod = positional[1]
+        connect("kubectl", pod)
+        os.chdir(node_dir(pod))
+        argv = [pod_path(pod, arg) for arg in command]
+        os.execvp(argv[0], argv)
+    elif positional[0] == "cp":
+        try:
+            shutil.copyfile(kubectl_path(positional[1]), kubectl_path(positional[2]))
+        except OSError as e:
+            sys.stderr.write(f"error: {e}\n")
+            sys.exit(1)
+    else:
+        sys.stderr.write(f"kubectl {positional[0]} is not simulated\n")
+        sys.exit(1)
+
+
+TOOLS = {"ssh": ssh, "scp": scp, "kubectl": kubectl}
+
+if __name__ == "__main__":
+    TOOLS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,72 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import math
+import time
+
+from carrier_live import read_line
+
+# the node prints its clock a few times, the sample that came back the fastest says the most about the offset
+CLOCK_PROBE = "for i in 1 2 3 4 5; do date +%s.%N; sleep 0.1; done"
+
+
+def parse_clock(line):
+    """seconds since the epoch printed by `date +%s.%N`, a date without %N gives the middle of the second"""
+    seconds, _, fraction = line.strip().partition(".")
+    if not seconds.isdigit():
+        return None
+    if fraction.isdigit():
+        return float(f"{seconds}.{fraction}")
+    return int(seconds) + 0.5
+
+
+class ClockProbe:
+    """how far the clock of the node is ahead of the local one, from the lines of CLOCK_PROBE as they arrive
+
+    every sample is late by the time it took to arrive, so the largest difference is the closest to the real offset
+    """
+
+    def __init__(self):
+        self.best = None
+
+    def receive(self, line):
+        received = time.time()
+        node_clock = parse_clock(line.decode("utf-8", errors="replace"))
+        if node_clock is not None:
+            sample = node_clock - received
+            self.best = sample if self.best is None else max(self.best, sample)
+
+    def offset(self):
+        if self.best is None:
+            raise ValueError("the node did not print its clock")
+        return self.best
+
+
+def clock_offset(stdout):
+    """the ClockProbe offset read from a blocking stdout"""
+    probe = ClockProbe()
+    while True:
+        line = read_line(stdout)
+        if not line:
+            break
+        probe.receive(line)
+    return probe.offset()
+
+
+def start_at_cmd(start):
+    """shell waiting until the clock of the node reaches start (seconds since the epoch)"""
+    # whole seconds first so a long wait does not fork awk over and over, then what is left to the millisecond
+    return (
+        f"while [ $(( {math.floor(start)} - $(date +%s) )) -gt 1 ]; do sleep 1; done; "
+        f"sleep $(awk -v start={start:.3f} -v now=$(date +%s.%N) 'BEGIN {{ print (start > now ? start - now : 0) }}')"
+    )
@@ -0,0 +1,87 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import itertools
+
+DEFAULT_NAMESPACE = "default"
+TARGET_FIELDS = ("context", "namespace", "labels", "container")
+
+
+class Target:
+    """one place pods are collected from
+
+    a kube context (None for the current one), a namespace, a label selector and the container the script
+    runs in (None for the default container of the pod)
+    """
+
+    def __init__(
+        self, context=None, namespace=DEFAULT_NAMESPACE, labels=None, container=None
+    ):
+        self.context = context
+        self.namespace = namespace
+        self.labels = labels
+        self.container = container
+
+    def __str__(self):
+        if self.context is None:
+            return f"namespace {self.namespace}"
+        return f"namespace {self.namespace} of context {self.context}"
+
+    def node(self, pod, qualified):
+        """the name the pod goes by in the run, <context>/<namespace>/<pod> when pods of several targets are collected"""
+        if not qualified:
+            return pod
+        return "/".join(part for part in (self.context, self.namespace, pod) if part)
+
+
+def parse_target(value):
+    """turns CONTEXT:NAMESPACE:SELECTOR:CONTAINER into a dict of the fields given, empty ones are left out
+
+    the context is the only field that can hold colons (e.g. the ARN of an EKS cluster), so it takes whatever
+    comes before the last three
+    """
+    fields = value.rsplit(":", 3)
+    if len(fields) != len(TARGET_FIELDS):
+        raise argparse.ArgumentTypeError(
+            f"{value} is not CONTEXT:NAMESPACE:SELECTOR:CONTAINER, leave a field empty to use its default"
+        )
+    return {name: field for name, field in zip(TARGET_FIELDS, fields) if field}
+
+
+async def discover(targets, list_pods):
+    """looks up the pods of every target at the same time, list_pods is a coroutine function
+
+    returns ({node: (target, pod)}, {target: error}) with the targets taking turns so no cluster gets every
+    slot first, a pod matched by two targets is only collected once
+    """
+    results = await asyncio.gather(
+        *(list_pods(target) for target in targets), return_exceptions=True
+    )
+    found = []
+    failures = {}
+    for target, result in zip(targets, results):
+        if isinstance(result, Exception):
+            failures[target] = result
+            found.append([])
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            found.append(result)
+    qualified = len(targets) > 1
+    pods = {}
+    for row in itertools.zip_longest(*found):
+        for target, pod in zip(targets, row):
+            if pod is not None:
+                pods.setdefault(target.node(pod, qualified), (target, pod))
+    return pods, failures
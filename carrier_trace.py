@@ -0,0 +1,145 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+TIMINGS_FILE = "carrier-timings.json"
+TRACE_FILE = "carrier-trace.json"
+
+
+def percentile(values, fraction):
+    # nearest rank, so the result is always one of the measured values
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def file_size(path):
+    # timings must never be the reason a node fails
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class CountingReader:
+    """wraps a stream and counts the bytes read through it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data
+
+
+class Trace:
+    """records how long every phase took on every node"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.lock = Lock()
+
+    def record(self, node, name, start, end, **args):
+        with self.lock:
+            self.events.append(
+                {"node": node, "phase": name, "start": start, "end": end, "args": args}
+            )
+
+    @contextmanager
+    def phase(self, node, name, **args):
+        """times the block, the yielded dict can be filled in with more details such as bytes"""
+        start = time.time()
+        try:
+            yield args
+        except BaseException:
+            args["error"] = True
+            raise
+        finally:
+            self.record(node, name, start, time.time(), **args)
+
+    def summary(self):
+        with self.lock:
+            events = list(self.events)
+        phases = {}
+        nodes = {}
+        for event in events:
+            duration = event["end"] - event["start"]
+            phase = phases.setdefault(event["phase"], {"durations": [], "bytes": 0})
+            phase["durations"].append(duration)
+            phase["bytes"] += event["args"].get("bytes", 0)
+            node = nodes.setdefault(
+                event["node"], {"start": event["start"], "end": event["end"]}
+            )
+            node["start"] = min(node["start"], event["start"])
+            node["end"] = max(node["end"], event["end"])
+            node[event["phase"]] = node.get(event["phase"], 0) + duration
+        for phase in phases.values():
+            durations = phase.pop("durations")
+            phase["count"] = len(durations)
+            phase["p50"] = percentile(durations, 0.5)
+            phase["p95"] = percentile(durations, 0.95)
+            phase["max"] = max(durations)
+            phase["total"] = sum(durations)
+        for node in nodes.values():
+            node["wall"] = node.pop("end") - node.pop("start")
+        return {
+            "wall": time.time() - self.start,
+            "phases": phases,
+            "nodes": nodes,
+        }
+
+    def chrome_trace(self):
+        """the trace event format understood by chrome://tracing and Perfetto, one row per node"""
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e["start"])
+        rows = {}
+        trace_events = []
+        for event in events:
+            if event["node"] not in rows:
+                rows[event["node"]] = len(rows) + 1
+                trace_events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": 1,
+                        "tid": rows[event["node"]],
+                        "args": {"name": event["node"]},
+                    }
+                )
+            trace_events.append(
+                {
+                    "name": event["phase"],
+                    "cat": "carrier",
+                    "ph": "X",
+                    "pid": 1,
+                    "tid": rows[event["node"]],
+                    "ts": int((event["start"] - self.start) * 1e6),
+                    "dur": int((event["end"] - event["start"]) * 1e6),
+                    "args": event["args"],
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, TIMINGS_FILE), "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(os.path.join(directory, TRACE_FILE), "w") as f:
+            json.dump(self.chrome_trace(), f)
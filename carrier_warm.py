@@ -0,0 +1,149 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import shutil
+import subprocess
+import tempfile
+
+# minutes an idle ssh master of the daemon stays up, so masters left behind by a killed daemon go away on their own
+DEFAULT_PERSIST_MINUTES = 30
+
+
+class SshConnections:
+    """the ssh masters opened by earlier runs, kept up for the next ones
+
+    every master is a background ssh listening on a socket in control_dir, named after user@host
+    """
+
+    def __init__(self, persist_minutes=DEFAULT_PERSIST_MINUTES):
+        self.control_dir = tempfile.mkdtemp(prefix="carrier-daemon-")
+        self.persist = f"{persist_minutes}m"
+        self.open = set()
+
+    def options(self):
+        # %C is a hash of the connection details which keeps the socket path short
+        return ["-o", f"ControlPath {self.control_dir}/%C"]
+
+    async def close(self, ssh_options):
+        async def close(destination):
+            process = await asyncio.create_subprocess_exec(
+                "ssh",
+                *ssh_options,
+                *self.options(),
+                "-q",
+                "-O",
+                "exit",
+                destination,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            await process.wait()
+
+        destinations = sorted(self.open)
+        self.open.clear()
+        await asyncio.gather(*(close(d) for d in destinations))
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class PodWatch:
+    def __init__(self, process):
+        self.process = process
+        self.changes = 0
+        self.task = None
+
+
+class PodInventory:
+    """the pods of every target as last listed, dropped as soon as a watch on them reports a change
+
+    the watch is started before the pods are listed and a listing that saw a change come in is not kept, a watch
+    that ends (e.g. the API server closed it) drops the listing as well and a new one is started with the next run
+    """
+
+    def __init__(self):
+        self.pods = {}
+        self.watches = {}
+
+    async def get(self, key, watch_argv, list_pods):
+        """the cached pods of key, listed with the coroutine function list_pods when there are none"""
+        if key in self.pods and key in self.watches:
+            return list(self.pods[key])
+        if key not in self.watches:
+            await self.watch(key, watch_argv)
+        watch = self.watches.get(key)
+        changes = None if watch is None else watch.changes
+        pods = await list_pods()
+        # a change reported while the pods were listed may not be in them
+        if watch is not None and self.watches.get(key) is watch:
+            if watch.changes == changes:
+                self.pods[key] = list(pods)
+        return pods
+
+    async def watch(self, key, argv):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError:
+            # without kubectl (e.g. only the api backend) the pods are listed every time
+            return
+        watch = PodWatch(process)
+        self.watches[key] = watch
+        watch.task = asyncio.ensure_future(self.follow(key, watch))
+
+    async def follow(self, key, watch):
+        async for _ in watch.process.stdout:
+            watch.changes += 1
+            self.pods.pop(key, None)
+        await watch.process.wait()
+        self.pods.pop(key, None)
+        if self.watches.get(key) is watch:
+            del self.watches[key]
+
+    async def close(self):
+        watches = list(self.watches.values())
+        self.watches.clear()
+        self.pods.clear()
+        for watch in watches:
+            if watch.process.returncode is None:
+                watch.process.kill()
+        await asyncio.gather(*(w.task for w in watches), return_exceptions=True)
+
+
+class WarmState:
+    """what the runs of the daemon share: ssh masters, pod listings, API connections and hashed artifacts"""
+
+    def __init__(self, persist_minutes=DEFAULT_PERSIST_MINUTES):
+        self.connections = SshConnections(persist_minutes)
+        self.inventory = PodInventory()
+        # K8sApi by context and kubeconfig, each holding its pooled connection and credentials
+        self.apis = {}
+        # Artifact by absolute path, hashed again once the file changes
+        self.artifacts = {}
+
+    def status(self):
+        return {
+            "connections": len(self.connections.open),
+            "pod_listings": len(self.inventory.pods),
+            "pod_watches": len(self.inventory.watches),
+            "api_connections": len(self.apis),
+            "artifacts": len(self.artifacts),
+        }
+
+    async def close(self, ssh_options):
+        await self.inventory.close()
+        await self.connections.close(ssh_options)
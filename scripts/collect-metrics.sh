@@ -16,11 +16,16 @@ TTOP_ALLOC_LOG="$MONDIR/$NODE-$DATE-monitor-ttop-alloc-$DR_PID.out"
 export PATH=$PATH:$JAVA_HOME/bin
 JSTACK=$(which jstack)
 JAVA=$(which java)" -jar "
-SJK="/tmp/sjk-plus.jar"
+# run with `--attach sjk-plus.jar` to bring the jar along, nodes without internet access can not download it
+if [ -f "$(pwd)/sjk-plus.jar" ]; then
+    SJK="$(pwd)/sjk-plus.jar"
+else
+    SJK="/tmp/sjk-plus.jar"
+fi
 COUNT=30    # number of iterations
 DELAY=2    # seconds between iterations
 
-# Find the SJK tool, if its not there, download the binary. For more info on the SJK see: https://github.com/aragozin/jvm-tools
+# Find the SJK tool, if it was not attached and is not there, download the binary. For more info on the SJK see: https://github.com/aragozin/jvm-tools
 function find_sjk {
     if [ ! -f $SJK ]; then
         echo "SJK not found, attempting to download ..."
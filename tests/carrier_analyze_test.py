@@ -0,0 +1,249 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import csv
+import io
+import os
+import tempfile
+import unittest
+from carrier_analyze import (
+    DUMP_START,
+    DUMP_TIME_LINE,
+    HOT_STACKS_FILE,
+    LOCK_CHAINS_FILE,
+    THREAD_SERIES_FILE,
+    analyze,
+    analyze_dumps,
+    analyze_ttop,
+    split_records,
+)
+from carrier_archive import Bundle, ZipBundle
+from carrier_bundle import read_files
+from tests.carrier_archive_test import make_tar_gz
+
+DUMP = """>>> Mon Apr 17 10:00:00 UTC 2023 running thread dump
+{time}
+Full thread dump OpenJDK 64-Bit Server VM (11.0.18+10 mixed mode):
+
+"main" #1 prio=5 os_prio=0 cpu=10.00ms elapsed=100.00s tid=0x1 nid=0x1 runnable  [0x1]
+   java.lang.Thread.State: RUNNABLE
+	at com.dremio.Hot.spin(Hot.java:10)
+	at com.dremio.Main.main(Main.java:5)
+
+   Locked ownable synchronizers:
+	- None
+
+"worker "quoted" 1" #20 prio=5 os_prio=0 tid=0x2 nid=0x2 waiting for monitor entry  [0x2]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+	at com.dremio.Store.put(Store.java:20)
+	- waiting to lock <0x00000000aaaa> (a java.lang.Object)
+	at com.dremio.Worker.run(Worker.java:7)
+
+   Locked ownable synchronizers:
+	- None
+
+"writer" #21 prio=5 os_prio=0 tid=0x3 nid=0x3 waiting on condition  [0x3]
+   java.lang.Thread.State: WAITING (parking)
+	at jdk.internal.misc.Unsafe.park(Native Method)
+	- parking to wait for  <0x00000000bbbb> (a java.util.concurrent.locks.ReentrantLock$NonfairSync)
+	at com.dremio.Store.flush(Store.java:40)
+	- locked <0x00000000aaaa> (a java.lang.Object)
+
+   Locked ownable synchronizers:
+	- None
+
+"flusher" #22 prio=5 os_prio=0 tid=0x4 nid=0x4 in Object.wait()  [0x4]
+   java.lang.Thread.State: WAITING (on object monitor)
+	at java.lang.Object.wait(Native Method)
+	- waiting on <0x00000000cccc> (a java.lang.Object)
+	at com.dremio.Store.sync(Store.java:50)
+	- locked <0x00000000cccc> (a java.lang.Object)
+	- waiting to lock <0x00000000aaaa> (a java.lang.Object)
+
+   Locked ownable synchronizers:
+	- <0x00000000bbbb> (a java.util.concurrent.locks.ReentrantLock$NonfairSync)
+
+"GC Thread#0" os_prio=0 tid=0x5 nid=0x5 runnable
+
+JNI global refs: 10, weak refs: 0
+
+"""
+
+TTOP = """{time} Process summary
+  process cpu=101.00%
+  application cpu=95.00% (user=90.00% sys=5.00%)
+  other: cpu=6.00%
+  thread count: 2
+  heap allocation rate 12mb/s
+[000021] user=80.00% sys= 2.00% alloc=   10mb/s - worker "quoted" 1
+[000001] user= 0.50% sys= 0.00% alloc=  512kb/s - main
+
+"""
+
+
+def dumps(*times):
+    return "".join(DUMP.format(time=time) for time in times).encode()
+
+
+def ttop(*times):
+    return "".join(TTOP.format(time=time) for time in times).encode()
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+class TestCarrierAnalyze(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.temp_dir.name, "analysis")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_split_records_keeps_every_dump_whole(self):
+        data = dumps(
+            "2023-04-17 10:00:00", "2023-04-17 10:00:01", "2023-04-17 10:00:02"
+        )
+        pieces = list(
+            split_records(io.BytesIO(data), DUMP_START, DUMP_TIME_LINE, size=100)
+        )
+        self.assertEqual(b"".join(piece for piece, _ in pieces), data)
+        self.assertEqual([records for _, records in pieces], [1, 1, 1])
+        # the time of a dump goes with it, not with the dump before
+        for piece, _ in pieces[1:]:
+            self.assertTrue(piece.startswith(b"2023-04-17 10:00:0"))
+
+    def test_dumps(self):
+        result = analyze_dumps(
+            "host1", "dump.out", dumps("2023-04-17 10:00:00").decode(), 5, 1
+        )
+        self.assertEqual(result["dumps"], 1)
+        self.assertEqual(
+            result["stacks"],
+            {
+                ("RUNNABLE", "com.dremio.Hot.spin(Hot.java:10)"): [1, "main"],
+                ("BLOCKED", "com.dremio.Store.put(Store.java:20)"): [
+                    1,
+                    'worker "quoted" 1',
+                ],
+                ("WAITING", "jdk.internal.misc.Unsafe.park(Native Method)"): [
+                    1,
+                    "writer",
+                ],
+                ("WAITING", "java.lang.Object.wait(Native Method)"): [1, "flusher"],
+            },
+        )
+        locks = {row["lock"]: row for row in result["locks"]}
+        self.assertEqual(sorted(locks), ["0x00000000aaaa", "0x00000000bbbb"])
+        blocked = locks["0x00000000aaaa"]
+        self.assertEqual(blocked["dump"], 5)
+        self.assertEqual(blocked["time"], "2023-04-17 10:00:00")
+        self.assertEqual(blocked["waiters"], 2)
+        self.assertEqual(blocked["waiting_threads"], 'worker "quoted" 1;flusher')
+        self.assertEqual(blocked["owner"], "writer")
+        self.assertEqual(
+            blocked["owner_frame"], "jdk.internal.misc.Unsafe.park(Native Method)"
+        )
+        # writer waits for the lock of flusher which waits for the monitor of writer
+        self.assertEqual(blocked["chain"], "writer -> flusher -> writer")
+        self.assertTrue(blocked["deadlock"])
+        self.assertEqual(locks["0x00000000bbbb"]["owner"], "flusher")
+
+    def test_ttop(self):
+        series = analyze_ttop(
+            "host1", "ttop.out", ttop("2023-04-17T10:00:00.000+0000").decode()
+        )["series"]
+        self.assertEqual(
+            series,
+            [
+                [
+                    "host1",
+                    "ttop.out",
+                    "2023-04-17T10:00:00.000+0000",
+                    21,
+                    'worker "quoted" 1',
+                    80.0,
+                    2.0,
+                    10 * 2**20,
+                ],
+                [
+                    "host1",
+                    "ttop.out",
+                    "2023-04-17T10:00:00.000+0000",
+                    1,
+                    "main",
+                    0.5,
+                    0.0,
+                    512 * 2**10,
+                ],
+            ],
+        )
+
+    def node_files(self, seconds):
+        times = [f"2023-04-17 10:00:{s:02}" for s in range(seconds)]
+        return make_tar_gz(
+            {
+                "./node-monitor-thread-dump-42.out": dumps(*times),
+                "./node-monitor-ttop-cpu-42.out": ttop(
+                    *(t.replace(" ", "T") for t in times)
+                ),
+                "./carrier.log": b"log",
+            }
+        )
+
+    def check_analysis(self, bundle):
+        bundle.add_stream(self.node_files(3), "host1")
+        bundle.add_stream(self.node_files(2), "host2")
+        bundle.close()
+        summary = analyze(read_files(bundle.path), self.out, workers=2, depth=2)
+        self.assertEqual(summary.nodes, {"host1", "host2"})
+        self.assertEqual(summary.dumps, 5)
+        self.assertEqual(summary.samples, 10)
+        self.assertEqual((summary.chains, summary.deadlocks), (10, 10))
+        hot = read_csv(os.path.join(self.out, HOT_STACKS_FILE))
+        self.assertEqual(len(hot), 4)
+        self.assertEqual(hot[0]["samples"], "5")
+        self.assertEqual(hot[0]["nodes"], "2")
+        running = [row for row in hot if row["state"] == "RUNNABLE"]
+        self.assertEqual(
+            running[0]["stack"],
+            "com.dremio.Hot.spin(Hot.java:10);com.dremio.Main.main(Main.java:5)",
+        )
+        series = read_csv(os.path.join(self.out, THREAD_SERIES_FILE))
+        self.assertEqual(len(series), 10)
+        self.assertEqual(
+            sorted({(row["node"], row["time"]) for row in series})[0],
+            ("host1", "2023-04-17T10:00:00"),
+        )
+        chains = read_csv(os.path.join(self.out, LOCK_CHAINS_FILE))
+        self.assertEqual(
+            sorted({(row["node"], row["dump"]) for row in chains}),
+            [
+                ("host1", "0"),
+                ("host1", "1"),
+                ("host1", "2"),
+                ("host2", "0"),
+                ("host2", "1"),
+            ],
+        )
+
+    def test_tar_bundle(self):
+        self.check_analysis(Bundle(os.path.join(self.temp_dir.name, "output.tar.gz")))
+
+    def test_zip_bundle(self):
+        self.check_analysis(ZipBundle(os.path.join(self.temp_dir.name, "output.zip")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from carrier_archive import INDEX_NAME, Bundle, ZipBundle, count_members
+
+
+def make_tar_gz(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    data.seek(0)
+    return data
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "output.tar.gz")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_add_stream_prefixes_members(self):
+        bundle = Bundle(self.path)
+        count = bundle.add_stream(
+            make_tar_gz({"./carrier.log": b"log", "./sub/big.out": b"x" * 2000000}),
+            "host1",
+        )
+        bundle.close()
+        self.assertEqual(count, 2)
+        with tarfile.open(self.path, "r:gz") as tar:
+            self.assertEqual(
+                sorted(tar.getnames()), ["host1/carrier.log", "host1/sub/big.out"]
+            )
+            self.assertEqual(tar.extractfile("host1/carrier.log").read(), b"log")
+            self.assertEqual(len(tar.extractfile("host1/sub/big.out").read()), 2000000)
+
+    def test_add_file(self):
+        node_archive = os.path.join(self.temp_dir.name, "host1.tar.gz")
+        with open(node_archive, "wb") as f:
+            f.write(make_tar_gz({"a.txt": b"a"}).read())
+        bundle = Bundle(self.path)
+        bundle.add_file(node_archive, "host1.tar.gz")
+        bundle.close()
+        with tarfile.open(self.path, "r:gz") as tar:
+            self.assertEqual(tar.getnames(), ["host1.tar.gz"])
+
+    def test_add_stream_keeps_bundle_valid_when_cut_short(self):
+        stream = make_tar_gz({"./big.out": os.urandom(2000000)}).getvalue()
+        bundle = Bundle(self.path)
+        with self.assertRaises(tarfile.ReadError):
+            bundle.add_stream(io.BytesIO(stream[: len(stream) // 2]), "host1")
+        bundle.add_data("carrier-run.json", b"{}")
+        bundle.close()
+        with tarfile.open(self.path, "r:gz") as tar:
+            self.assertEqual(tar.getnames(), ["host1/big.out", "carrier-run.json"])
+            self.assertEqual(len(tar.extractfile("host1/big.out").read()), 2000000)
+            self.assertEqual(tar.extractfile("carrier-run.json").read(), b"{}")
+
+    def test_add_directory(self):
+        files = os.path.join(self.temp_dir.name, "live", "host1")
+        os.makedirs(os.path.join(files, "sub"))
+        for name in ("ttop.out", "sub/jstack.out"):
+            with open(os.path.join(files, name), "w") as f:
+                f.write(name)
+        bundle = Bundle(self.path)
+        self.assertEqual(bundle.add_directory(files, "host1"), 2)
+        bundle.close()
+        with tarfile.open(self.path) as tar:
+            self.assertEqual(tar.getnames(), ["host1/ttop.out", "host1/sub/jstack.out"])
+            self.assertEqual(tar.extractfile("host1/ttop.out").read(), b"ttop.out")
+
+    def test_count_members_of_an_archive_cut_short(self):
+        bundle = Bundle(self.path, "w")
+        bundle.add_stream(make_tar_gz({"./a.txt": b"a", "./b.txt": b"b"}), "host1")
+        bundle.add_stream(make_tar_gz({"./big.out": os.urandom(200000)}), "host2")
+        bundle.close()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(count_members(self.path), {"host1": 2, "host2": 1})
+        # the last member of host1 only counts once the header after it was read
+        with open(self.path, "wb") as f:
+            f.write(data[:100000])
+        self.assertEqual(count_members(self.path), {"host1": 2})
+        with open(self.path, "wb") as f:
+            f.write(data[:1600])
+        self.assertEqual(count_members(self.path), {"host1": 1})
+
+    def test_count_members_of_nodes_with_slashes(self):
+        bundle = Bundle(self.path)
+        bundle.add_stream(make_tar_gz({"./a.txt": b"a"}), "eu/dremio/pod-0")
+        bundle.add_stream(make_tar_gz({"./a.txt": b"b"}), "eu/dremio")
+        nested = os.path.join(self.temp_dir.name, "us%2Fdremio%2Fpod-0.tar.gz")
+        with open(nested, "wb") as f:
+            f.write(make_tar_gz({"./a.txt": b"c"}).read())
+        bundle.add_node_archive(nested, "us/dremio/pod-0")
+        bundle.close()
+        nodes = {"eu/dremio/pod-0", "eu/dremio", "us/dremio/pod-0"}
+        self.assertEqual(
+            count_members(self.path, nodes),
+            {"eu/dremio/pod-0": 1, "eu/dremio": 1, "us/dremio/pod-0": 1},
+        )
+        with tarfile.open(self.path) as tar:
+            self.assertIn("us/dremio/pod-0.tar.gz", tar.getnames())
+
+    def test_copy_from(self):
+        previous = os.path.join(self.temp_dir.name, "previous.tar.gz")
+        bundle = Bundle(previous)
+        bundle.add_stream(make_tar_gz({"./a.txt": b"a"}), "host1")
+        bundle.add_stream(make_tar_gz({"./a.txt": b"b"}), "host2")
+        bundle.add_data("carrier-run.json", b"{}")
+        bundle.close()
+        bundle = Bundle(self.path)
+        bundle.copy_from(previous, {"host2"})
+        bundle.close()
+        with tarfile.open(self.path) as tar:
+            self.assertEqual(tar.getnames(), ["host2/a.txt"])
+            self.assertEqual(tar.extractfile("host2/a.txt").read(), b"b")
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_external_compressor(self):
+        path = os.path.join(self.temp_dir.name, "output.tar.zst")
+        bundle = Bundle(path, "w|", "zstd -q")
+        bundle.add_stream(make_tar_gz({"./carrier.log": b"log"}), "host1")
+        bundle.close()
+        with open(path, "rb") as f:
+            data = subprocess.run(
+                ["zstd", "-d", "-c", "-q"], stdin=f, capture_output=True, check=True
+            ).stdout
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.assertEqual(tar.extractfile("host1/carrier.log").read(), b"log")
+
+
+class TestZipBundle(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "output.zip")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_add_stream_indexes_files(self):
+        bundle = ZipBundle(self.path)
+        count = bundle.add_stream(
+            make_tar_gz({"./carrier.log": b"log", "./sub/big.out": b"x" * 2000000}),
+            "host1",
+        )
+        bundle.close()
+        self.assertEqual(count, 2)
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertEqual(archive.read("host1/carrier.log"), b"log")
+            self.assertEqual(len(archive.read("host1/sub/big.out")), 2000000)
+            index = json.loads(archive.read(INDEX_NAME))["files"]
+        self.assertEqual(
+            [(e["node"], e["path"], e["size"]) for e in index],
+            [("host1", "carrier.log", 3), ("host1", "sub/big.out", 2000000)],
+        )
+        self.assertEqual(
+            index[0]["sha256"],
+            "836ff184e7b41b1e13cb5fd89fa1de98dbbab99e9d2918913ff43b86a5c7c213",
+        )
+
+    def test_add_stream_keeps_what_arrived_when_cut_short(self):
+        stream = make_tar_gz({"./big.out": os.urandom(2000000)}).getvalue()
+        bundle = ZipBundle(self.path)
+        with self.assertRaises(tarfile.ReadError):
+            bundle.add_stream(io.BytesIO(stream[: len(stream) // 2]), "host1")
+        bundle.close()
+        with zipfile.ZipFile(self.path) as archive:
+            index = json.loads(archive.read(INDEX_NAME))["files"]
+            self.assertEqual(len(archive.read("host1/big.out")), index[0]["size"])
+        self.assertTrue(index[0]["truncated"])
+        self.assertLess(index[0]["size"], 2000000)
+
+    def test_add_directory_indexes_files(self):
+        files = os.path.join(self.temp_dir.name, "live", "host1")
+        os.makedirs(os.path.join(files, "sub"))
+        with open(os.path.join(files, "sub", "jstack.out"), "w") as f:
+            f.write("jstack")
+        os.utime(os.path.join(files, "sub", "jstack.out"), (1700000000, 1700000000))
+        bundle = ZipBundle(self.path)
+        self.assertEqual(bundle.add_directory(files, "host1"), 1)
+        bundle.close()
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertEqual(archive.read("host1/sub/jstack.out"), b"jstack")
+            index = json.loads(archive.read(INDEX_NAME))["files"]
+        self.assertEqual(
+            [(e["node"], e["path"], e["size"], e["mtime"]) for e in index],
+            [("host1", "sub/jstack.out", 6, 1700000000)],
+        )
+
+    def test_copy_from_keeps_the_index(self):
+        previous = os.path.join(self.temp_dir.name, "previous.zip")
+        bundle = ZipBundle(previous)
+        bundle.add_stream(make_tar_gz({"./a.txt": b"a"}), "host1")
+        bundle.add_stream(make_tar_gz({"./a.txt": b"b"}), "host2")
+        bundle.close()
+        self.assertEqual(count_members(previous), {"host1": 1, "host2": 1})
+        bundle = ZipBundle(self.path)
+        bundle.copy_from(previous, {"host2"})
+        bundle.close()
+        with zipfile.ZipFile(previous) as archive:
+            before = json.loads(archive.read(INDEX_NAME))["files"][1]
+        with zipfile.ZipFile(self.path) as archive:
+            self.assertEqual(archive.read("host2/a.txt"), b"b")
+            index = json.loads(archive.read(INDEX_NAME))["files"]
+        self.assertEqual(index, [before])
+
+
+if __name__ == "__main__":
+    unittest.main()
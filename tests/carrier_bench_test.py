@@ -0,0 +1,112 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import unittest
+from carrier_bench import benchmark, expected_done, regressions
+
+
+def bench_args(**overrides):
+    args = argparse.Namespace(
+        latency=0.0,
+        output_size=4096,
+        script_seconds=0.0,
+        failure_rate=0.0,
+        seed=0,
+        stream=False,
+        single_session=False,
+        multiplex=False,
+        parallelism=4,
+        transfer_parallelism=2,
+        compression="gzip",
+        compression_level=None,
+        format="tar",
+        attach_size=0,
+        relay=None,
+        live=False,
+        sync_start=None,
+        low_impact=False,
+    )
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
+
+
+class TestBaseline(unittest.TestCase):
+    def test_regressions(self):
+        baseline = [
+            {"runner": "ssh", "nodes": 10, "wall": 2.0},
+            {"runner": "ssh", "nodes": 50, "wall": 10.0},
+            {"runner": "ssh", "nodes": 100, "wall": 20.0},
+            {"runner": "k8s", "nodes": 10, "wall": 3.0},
+            {"runner": "k8s", "nodes": 50, "wall": 15.0},
+        ]
+        results = [
+            # a machine three times slower grows the same way
+            {"runner": "ssh", "nodes": 10, "wall": 6.0},
+            {"runner": "ssh", "nodes": 50, "wall": 30.0},
+            # while growing more than twice as fast as the baseline is a regression
+            {"runner": "ssh", "nodes": 100, "wall": 130.0},
+            {"runner": "k8s", "nodes": 10, "wall": 1.0},
+            {"runner": "k8s", "nodes": 50, "wall": 9.0},
+            # nothing to compare with
+            {"runner": "k8s", "nodes": 500, "wall": 500.0},
+        ]
+        slow = regressions(results, baseline, 1.0)
+        self.assertEqual(len(slow), 1)
+        self.assertIn("ssh with 100 nodes", slow[0])
+        self.assertEqual(regressions(results, baseline, 2.5), [])
+
+
+class TestBench(unittest.TestCase):
+    def test_ssh(self):
+        result = benchmark("ssh", 3, bench_args())
+        self.assertEqual(result["done"], 3)
+        self.assertEqual(result["errors"], {})
+        self.assertGreater(result["archive_bytes"], 3 * 4096)
+        self.assertGreater(result["peak_rss"], 0)
+        self.assertGreater(result["peak_fds"], 0)
+
+    def test_k8s_streamed_single_session(self):
+        args = bench_args(stream=True, single_session=True)
+        result = benchmark("k8s", 3, args)
+        self.assertEqual(result["done"], 3)
+        self.assertGreater(result["archive_bytes"], 3 * 4096)
+
+    def test_k8s_live(self):
+        result = benchmark("k8s", 3, bench_args(live=True, script_seconds=1.5))
+        self.assertEqual(result["done"], 3)
+        self.assertGreater(result["archive_bytes"], 3 * 4096)
+
+    def test_ssh_relay(self):
+        result = benchmark("ssh", 7, bench_args(attach_size=100000, relay=2))
+        self.assertEqual(result["done"], 7)
+        # only the first two hosts get the attached file from here
+        self.assertGreater(result["upload_bytes"], 2 * 100000)
+        self.assertLess(result["upload_bytes"], 3 * 100000)
+
+    def test_k8s_low_impact(self):
+        # the archives are read with cat through the bandwidth limit instead of kubectl cp
+        result = benchmark("k8s", 3, bench_args(low_impact=True))
+        self.assertEqual(result["done"], 3)
+        self.assertGreater(result["archive_bytes"], 3 * 4096)
+        self.assertGreaterEqual(result["node_cpu"], 0)
+
+    def test_failing_nodes(self):
+        args = bench_args(failure_rate=0.5, seed=1)
+        result = benchmark("ssh", 6, args)
+        self.assertEqual(result["done"], expected_done(6, args), result)
+        self.assertEqual(len(result["errors"]), 6 - expected_done(6, args))
+
+
+if __name__ == "__main__":
+    unittest.main()
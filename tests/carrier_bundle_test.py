@@ -0,0 +1,105 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import tempfile
+import unittest
+from carrier_archive import Bundle, ZipBundle
+from carrier_bundle import extract_files, list_files
+from tests.carrier_archive_test import make_tar_gz
+
+FILES = {"./carrier.log": b"log", "./jstack/jstack-1.txt": b"threads"}
+
+
+class TestCarrierBundle(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.temp_dir.name, "out")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def node_archive(self, node):
+        path = os.path.join(self.temp_dir.name, f"{node}.tar.gz")
+        with open(path, "wb") as f:
+            f.write(make_tar_gz(FILES).read())
+        return path
+
+    def write_bundle(self, bundle):
+        bundle.add_node_archive(self.node_archive("host1"), "host1")
+        bundle.add_stream(make_tar_gz(FILES), "host2")
+        bundle.add_data("carrier-run.json", b"{}")
+        bundle.close()
+        return bundle.path
+
+    def check_bundle(self, path):
+        entries = list_files(path)
+        self.assertEqual(
+            sorted((e["node"], e["path"], e["size"]) for e in entries),
+            [
+                ("host1", "carrier.log", 3),
+                ("host1", "jstack/jstack-1.txt", 7),
+                ("host2", "carrier.log", 3),
+                ("host2", "jstack/jstack-1.txt", 7),
+            ],
+        )
+        written = extract_files(path, "host2", "jstack*", self.dest)
+        self.assertEqual(
+            written, [os.path.join(self.dest, "host2/jstack/jstack-1.txt")]
+        )
+        with open(written[0], "rb") as f:
+            self.assertEqual(f.read(), b"threads")
+
+    def test_zip(self):
+        path = self.write_bundle(
+            ZipBundle(os.path.join(self.temp_dir.name, "output.zip"))
+        )
+        self.check_bundle(path)
+        self.assertEqual(len(list_files(path, pattern="*.log")), 2)
+        self.assertEqual(len(list_files(path)[0]["sha256"]), 64)
+
+    def test_nested_tar(self):
+        path = self.write_bundle(
+            Bundle(os.path.join(self.temp_dir.name, "output.tar.gz"))
+        )
+        self.check_bundle(path)
+
+    def test_nodes_with_slashes(self):
+        path = os.path.join(self.temp_dir.name, "output.tar.gz")
+        bundle = Bundle(path)
+        bundle.add_node_archive(self.node_archive("eu"), "eu/dremio/pod-0")
+        bundle.add_stream(make_tar_gz(FILES), "us/dremio/pod-0")
+        bundle.close()
+        self.assertEqual(
+            sorted((e["node"], e["path"]) for e in list_files(path)),
+            [
+                ("eu/dremio/pod-0", "carrier.log"),
+                ("eu/dremio/pod-0", "jstack/jstack-1.txt"),
+                ("us/dremio/pod-0", "carrier.log"),
+                ("us/dremio/pod-0", "jstack/jstack-1.txt"),
+            ],
+        )
+        written = extract_files(path, "eu/*", "carrier.log", self.dest)
+        self.assertEqual(
+            written, [os.path.join(self.dest, "eu/dremio/pod-0/carrier.log")]
+        )
+
+    def test_extract_refuses_paths_outside_dest(self):
+        bundle = ZipBundle(os.path.join(self.temp_dir.name, "output.zip"))
+        bundle.add_stream(make_tar_gz({"../../escape.txt": b"x"}), "host1")
+        bundle.close()
+        with self.assertRaises(ValueError):
+            extract_files(bundle.path, dest=self.dest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from carrier_cache import (
+    Artifact,
+    check_names,
+    install_cmd,
+    list_cmd,
+    missing,
+    part_path,
+)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.jar = self.write("local/sjk-plus.jar", b"jar")
+        self.script = self.write("local/collect.sh", b"echo hi\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.temp_dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def sh(self, cmd):
+        return subprocess.run(
+            cmd,
+            shell=True,
+            cwd=self.temp_dir.name,
+            capture_output=True,
+            check=True,
+        ).stdout.decode("utf-8")
+
+    def test_artifact_is_named_by_content(self):
+        artifact = Artifact(self.jar)
+        self.assertEqual(artifact.name, "sjk-plus.jar")
+        self.assertEqual(artifact.size, 3)
+        self.assertEqual(artifact.digest, hashlib.sha256(b"jar").hexdigest())
+
+    def test_only_missing_files_are_copied(self):
+        jar, script = Artifact(self.jar), Artifact(self.script)
+        listing = self.sh(list_cmd(".carrier-cache", "node_tmp/data"))
+        self.assertEqual(missing([jar, script], listing), [jar, script])
+        # an upload lands as a part file and only enters the cache once it is complete
+        shutil.copy(
+            self.jar,
+            os.path.join(self.temp_dir.name, part_path(".carrier-cache", jar, "node")),
+        )
+        self.sh(install_cmd("node_tmp/data", ".carrier-cache", [jar], [jar], "node"))
+        with open(
+            os.path.join(self.temp_dir.name, "node_tmp/data/sjk-plus.jar"), "rb"
+        ) as f:
+            self.assertEqual(f.read(), b"jar")
+        listing = self.sh(list_cmd(".carrier-cache", "node_tmp/data"))
+        self.assertEqual(listing.split(), [jar.digest])
+        self.assertEqual(missing([jar, script], listing), [script])
+
+    def test_same_content_is_copied_once(self):
+        jar = Artifact(self.jar)
+        copy = Artifact(self.write("other/copy.jar", b"jar"))
+        self.assertEqual(missing([jar, copy], ""), [jar])
+
+    def test_names_have_to_be_unique(self):
+        check_names([self.script, self.jar])
+        with self.assertRaises(ValueError):
+            check_names([self.jar, "other/sjk-plus.jar"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from carrier_compress import (
+    bundle_options,
+    decompressed,
+    output_name,
+    tar_cmd,
+)
+
+
+def make_tar(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+class TestCompress(unittest.TestCase):
+    def test_tar_cmd(self):
+        self.assertEqual(
+            tar_cmd("gzip", None, "h.tar.gz", "data/", ["s.sh"]),
+            "tar -czf h.tar.gz --exclude=s.sh -C data/ .",
+        )
+        self.assertIn(
+            'tar -cf - --exclude=s.sh -C data/ . && rm "$t"; } | gzip -1 > h.tar.gz',
+            tar_cmd("gzip", 1, "h.tar.gz", "data/", ["s.sh"]),
+        )
+        self.assertIn(
+            'tar -cf - -C data/ . && rm "$t"; } | zstd -T0 -q && ',
+            tar_cmd("zstd", None, "-", "data/", []),
+        )
+        self.assertEqual(tar_cmd("none", 5, "-", ".", []), "tar -cf - -C . .")
+
+    @unittest.skipIf(shutil.which("zstd") is None, "zstd is not installed")
+    def test_tar_failure_is_the_exit_code(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_dir = os.path.join(temp_dir, "data")
+            os.makedirs(data_dir)
+            with open(os.path.join(data_dir, "out.txt"), "w") as f:
+                f.write("collected\n")
+            dest = os.path.join(temp_dir, "h.tar.zst")
+            ok = subprocess.run(["sh", "-c", tar_cmd("zstd", 3, dest, data_dir, [])])
+            self.assertEqual(ok.returncode, 0)
+            with open(dest, "rb") as f, decompressed(f, "zstd") as members:
+                with tarfile.open(fileobj=members, mode="r|") as tar:
+                    self.assertIn("./out.txt", tar.getnames())
+            # zstd compresses the empty output of a tar that failed without complaint
+            missing = os.path.join(temp_dir, "missing")
+            failed = subprocess.run(
+                ["sh", "-c", tar_cmd("zstd", None, "-", missing, [])],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self.assertNotEqual(failed.returncode, 0)
+
+    def test_final_archive(self):
+        # node archives are already compressed
+        self.assertEqual(bundle_options("gzip", None, False), ("w", None))
+        self.assertEqual(bundle_options("gzip", None, True), ("w:gz", None))
+        self.assertEqual(bundle_options("zstd", 3, False), ("w", None))
+        self.assertEqual(bundle_options("zstd", 3, True), ("w|", "zstd -T0 -q -3"))
+        self.assertEqual(output_name("output", "gzip", False), "output.tar")
+        self.assertEqual(output_name("output", "gzip", True), "output.tar.gz")
+        self.assertEqual(output_name("output", "pigz", False), "output.tar")
+        self.assertEqual(output_name("output", "pigz", True), "output.tar.gz")
+        self.assertEqual(output_name("output", "zstd", True), "output.tar.zst")
+        self.assertEqual(output_name("output", "none", True), "output.tar")
+
+    def test_decompressed_passes_gzip_through(self):
+        stream = io.BytesIO(b"data")
+        with decompressed(stream, "gzip") as members:
+            self.assertIs(members, stream)
+
+    @unittest.skipUnless(shutil.which("zstd"), "zstd is not installed")
+    def test_decompressed_zstd(self):
+        compressed = subprocess.run(
+            ["zstd", "-c", "-q"],
+            input=make_tar({"a.txt": b"a" * 100000}),
+            capture_output=True,
+            check=True,
+        ).stdout
+        with decompressed(io.BytesIO(compressed), "zstd") as members:
+            with tarfile.open(fileobj=members, mode="r|") as tar:
+                for member in tar:
+                    self.assertEqual(member.name, "a.txt")
+                    self.assertEqual(tar.extractfile(member).read(), b"a" * 100000)
+
+
+if __name__ == "__main__":
+    unittest.main()
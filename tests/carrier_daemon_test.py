@@ -0,0 +1,209 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from carrier_bench import install_shims
+from carrier_client import request
+from carrier_daemon import ClientStream, ClientWriter
+from carrier_shim import NODES_ENV, ROOT_ENV, node_name
+
+DAEMON = os.path.join(os.path.dirname(os.path.dirname(__file__)), "carrier_daemon.py")
+
+
+class TestCarrierDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        root = self.temp_dir.name
+        for path in ("bin", "work"):
+            os.makedirs(os.path.join(root, path))
+        install_shims(os.path.join(root, "bin"))
+        # refuses every password, like sudo given a wrong one
+        sudo = os.path.join(root, "bin", "sudo")
+        with open(sudo, "w") as f:
+            f.write("#!/bin/sh\nexit 1\n")
+        os.chmod(sudo, 0o755)
+        for i in range(3):
+            os.makedirs(os.path.join(root, "nodes", node_name(i), "tmp"))
+        self.script = os.path.join(root, "collect.sh")
+        with open(self.script, "w") as f:
+            f.write("echo collected > out.txt\n")
+        self.work = os.path.join(root, "work")
+        self.socket = os.path.join(root, "carrier.sock")
+        env = dict(os.environ)
+        env["PATH"] = os.path.join(root, "bin") + os.pathsep + env["PATH"]
+        env[ROOT_ENV] = os.path.join(root, "nodes")
+        env[NODES_ENV] = "3"
+        self.daemon = subprocess.Popen(
+            [sys.executable, DAEMON, "--socket", self.socket],
+            env=env,
+            stdout=subprocess.PIPE,
+        )
+        # it says so once the socket is there
+        self.daemon.stdout.readline()
+        self.asked = 0
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.terminate()
+        self.daemon.wait()
+        self.daemon.stdout.close()
+        self.temp_dir.cleanup()
+
+    def ask(self, prompt):
+        self.asked += 1
+        return "secret"
+
+    def submit(self, runner, *argv):
+        stdout = io.StringIO()
+        self.stderr = io.StringIO()
+        message = {"command": "run", "runner": runner, "argv": list(argv)}
+        message["cwd"] = self.work
+        code = request(self.socket, message, stdout, self.stderr, self.ask)
+        return code, stdout.getvalue()
+
+    def status(self):
+        stdout = io.StringIO()
+        self.assertEqual(request(self.socket, {"command": "status"}, stdout), 0)
+        return json.loads(stdout.getvalue())
+
+    def test_k8s_pods_are_listed_once(self):
+        for _ in range(2):
+            code, output = self.submit(
+                "k8s", "--labels", "app=test", "--shell", "sh", self.script
+            )
+            self.assertEqual(code, 0)
+            self.assertIn("All done!", output)
+            self.assertIn(f"pod {node_name(2)}", output)
+        status = self.status()
+        self.assertEqual(status["runs"], 2)
+        # the watch saw no change, so the second run used the pods of the first
+        self.assertEqual(status["pod_listings"], 1)
+        self.assertEqual(status["pod_watches"], 1)
+        self.assertEqual(status["artifacts"], 1)
+        self.assertTrue(os.path.exists(os.path.join(self.work, "output.tar")))
+
+    def test_k8s_without_labels(self):
+        # the script is found from the directory of the client, not the one of the daemon
+        script = os.path.relpath(self.script, self.work)
+        code, output = self.submit("k8s", "--shell", "sh", script)
+        self.assertEqual(code, 0)
+        self.assertIn("All done!", output)
+        self.assertIn(f"pod {node_name(2)}", output)
+        # the watch runs without a selector as well
+        status = self.status()
+        self.assertEqual(status["pod_listings"], 1)
+        self.assertEqual(status["pod_watches"], 1)
+
+    def test_ssh_connections_stay_open(self):
+        hosts = ",".join(node_name(i) for i in range(3))
+        for _ in range(2):
+            code, output = self.submit(
+                "ssh",
+                "--hosts",
+                hosts,
+                "--username",
+                "test",
+                "--use-key",
+                "--shell",
+                "sh",
+                self.script,
+            )
+            self.assertEqual(code, 0)
+            self.assertIn("All done!", output)
+        self.assertEqual(self.status()["connections"], 3)
+        self.assertEqual(self.asked, 0)
+
+    def test_password_without_success_is_asked_again(self):
+        for _ in range(2):
+            code, output = self.submit(
+                "ssh", "--hosts", node_name(0), "--username", "test", self.script
+            )
+            self.assertEqual(code, 0)
+            self.assertIn("no successful collections", output)
+        self.assertEqual(self.asked, 2)
+        self.assertEqual(self.status()["passwords"], 0)
+
+    def test_wrong_arguments(self):
+        code, _ = self.submit("ssh", "--no-such-flag")
+        self.assertEqual(code, 2)
+        self.assertIn(
+            "error: the following arguments are required", self.stderr.getvalue()
+        )
+
+    def test_bad_requests(self):
+        requests = [
+            {"command": "run", "runner": "ftp", "argv": [], "cwd": self.work},
+            {"command": "run", "runner": "ssh", "cwd": self.work},
+            {"command": "run", "runner": "ssh", "argv": []},
+            {"command": "restart"},
+            ["run"],
+        ]
+        for message in requests:
+            stderr = io.StringIO()
+            code = request(self.socket, message, io.StringIO(), stderr)
+            self.assertEqual(code, 2)
+            self.assertIn("the daemon refused the request", stderr.getvalue())
+        # none of them got as far as a run and the daemon is still up
+        self.assertEqual(self.status()["runs"], 0)
+
+    def test_stop(self):
+        self.assertEqual(request(self.socket, {"command": "stop"}), 0)
+        self.assertEqual(self.daemon.wait(timeout=10), 0)
+        self.assertFalse(os.path.exists(self.socket))
+
+
+class TestClientWriter(unittest.TestCase):
+    async def write(self, lines, limit, read):
+        ours, theirs = socket.socketpair()
+        reader, writer = await asyncio.open_unix_connection(sock=ours)
+        client = ClientWriter(writer, limit)
+        stream = ClientStream(client, "stdout")
+        received = asyncio.ensure_future(
+            asyncio.get_running_loop().run_in_executor(None, read, theirs)
+        )
+        for i in range(lines):
+            stream.write(f"line {i}\n")
+        await client.close()
+        closing = writer.is_closing()
+        writer.close()
+        data = await received
+        theirs.close()
+        return closing, data
+
+    def test_output_reaches_a_slow_client_in_order(self):
+        def read(sock):
+            data = b""
+            while data.count(b"\n") < 100000:
+                data += sock.recv(4096)
+            return data
+
+        closing, data = asyncio.run(self.write(100000, 16 * 1024 * 1024, read))
+        self.assertFalse(closing)
+        lines = [json.loads(line)["stdout"] for line in data.splitlines()]
+        self.assertEqual(lines, [f"line {i}\n" for i in range(100000)])
+
+    def test_client_that_stops_reading_is_dropped(self):
+        closing, _ = asyncio.run(self.write(100000, 64 * 1024, lambda sock: None))
+        # the run went on without waiting for it
+        self.assertTrue(closing)
+
+
+if __name__ == "__main__":
+    unittest.main()
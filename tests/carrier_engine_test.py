@@ -0,0 +1,161 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from carrier_engine import CHUNK_SIZE, Engine, run_coroutine
+from carrier_sched import PhaseTimeout
+
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(4)
+        self.logged = []
+
+    def tearDown(self):
+        self.engine.close()
+
+    def test_run_logs_whole_lines(self):
+        run_coroutine(
+            self.engine.run(
+                ["sh", "-c", "printf 'one\\ntw'; sleep 0.1; printf 'o\\nthree'"],
+                self.logged.append,
+            )
+        )
+        self.assertEqual(self.logged, ["one\n", "two\n", "three"])
+
+    def test_long_line_is_logged_in_pieces(self):
+        run_coroutine(
+            self.engine.run(
+                ["head", "-c", str(CHUNK_SIZE * 3), "/dev/zero"], self.logged.append
+            )
+        )
+        self.assertEqual(sum(len(text) for text in self.logged), CHUNK_SIZE * 3)
+        self.assertGreater(len(self.logged), 1)
+
+    def test_arguments_are_not_split_or_expanded(self):
+        run_coroutine(
+            self.engine.run(["echo", "$HOME", "a b", "'c'"], self.logged.append)
+        )
+        self.assertEqual(self.logged, ["$HOME a b 'c'\n"])
+
+    def test_run_raises_on_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as raised:
+            run_coroutine(self.engine.run(["sh", "-c", "exit 3"], print))
+        self.assertEqual(raised.exception.returncode, 3)
+
+    @patch("carrier_sched.WATCHDOG_SLACK", 0)
+    def test_timeout_kills_the_process_group(self):
+        start = time.time()
+        with self.assertRaisesRegex(PhaseTimeout, "execute timed out"):
+            run_coroutine(
+                self.engine.run(
+                    ["sh", "-c", "sleep 30 & sleep 30"],
+                    self.logged.append,
+                    timeout=0.2,
+                    phase="execute",
+                )
+            )
+        self.assertLess(time.time() - start, 5)
+
+    def test_stdin(self):
+        run_coroutine(self.engine.run(["cat"], self.logged.append, b"hello\n"))
+        self.assertEqual(self.logged, ["hello\n"])
+
+    def test_output_keeps_stderr_apart(self):
+        output = run_coroutine(
+            self.engine.output(
+                ["sh", "-c", "echo data; echo noise >&2"], self.logged.append
+            )
+        )
+        self.assertEqual(output, b"data\n")
+        self.assertEqual(self.logged, ["noise\n"])
+
+    def test_lines_arrive_one_by_one(self):
+        arrived = []
+        run_coroutine(
+            self.engine.lines(
+                ["sh", "-c", "echo one; sleep 0.3; echo two"],
+                self.logged.append,
+                lambda line: arrived.append((line, time.time())),
+            )
+        )
+        self.assertEqual([line for line, _ in arrived], [b"one\n", b"two\n"])
+        self.assertGreater(arrived[1][1] - arrived[0][1], 0.2)
+
+    def test_stream_hands_stdout_to_a_reader(self):
+        readers = []
+
+        def consume(stdout):
+            readers.append(threading.current_thread().name)
+            return stdout.read(3)
+
+        # whatever the reader leaves is drained so the command still exits cleanly
+        result = run_coroutine(
+            self.engine.stream(
+                ["sh", "-c", "head -c 1000000 /dev/zero; echo done >&2"],
+                self.logged.append,
+                consume,
+            )
+        )
+        self.assertEqual(result, b"\0\0\0")
+        self.assertEqual(self.logged, ["done\n"])
+        self.assertTrue(readers[0].startswith("carrier-io"))
+
+    def test_stream_with_stdin(self):
+        result = run_coroutine(
+            self.engine.stream(
+                ["cat"], self.logged.append, lambda stdout: stdout.read(), b"x" * 300000
+            )
+        )
+        self.assertEqual(result, b"x" * 300000)
+
+    @patch("carrier_sched.WATCHDOG_SLACK", 0)
+    def test_stream_timeout(self):
+        with self.assertRaisesRegex(PhaseTimeout, "download timed out"):
+            run_coroutine(
+                self.engine.stream(
+                    ["sh", "-c", "echo started; sleep 30"],
+                    self.logged.append,
+                    lambda stdout: stdout.read(),
+                    timeout=0.2,
+                    phase="download",
+                )
+            )
+
+    def test_waiting_commands_hold_no_threads(self):
+        async def run():
+            commands = asyncio.gather(
+                *(self.engine.run(["sleep", "1"], print) for _ in range(200))
+            )
+            await asyncio.sleep(0.5)
+            running = threading.active_count()
+            await commands
+            return running
+
+        start = time.time()
+        before = threading.active_count()
+        running = run_coroutine(run())
+        self.assertLess(time.time() - start, 10)
+        # without pidfds asyncio waits for each child on a thread of its own
+        if sys.version_info >= (3, 9) and hasattr(os, "pidfd_open"):
+            self.assertLess(running - before, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import subprocess
+import time
+import unittest
+from carrier_impact import (
+    NodeUsage,
+    Throttle,
+    low_impact_cmd,
+    parse_usage,
+)
+
+
+class TestLowImpact(unittest.TestCase):
+    def test_command_runs_niced_and_reports_its_usage(self):
+        result = subprocess.run(
+            ["sh", "-c", low_impact_cmd("nice && exit 3")],
+            capture_output=True,
+            text=True,
+        )
+        # the exit code is the one of the command, the report comes after it
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout, "19\n")
+        self.assertIsNotNone(parse_usage(result.stderr))
+
+    def test_parse_usage(self):
+        self.assertEqual(
+            parse_usage("carrier-usage 100 150 50 4096 8192 \n"),
+            {"cpu": 2.0, "read_bytes": 4096, "write_bytes": 8192},
+        )
+        # no /proc/<pid>/io
+        self.assertEqual(parse_usage("carrier-usage 100 1 1 \n")["write_bytes"], 0)
+        self.assertIsNone(parse_usage("carrier-usage is a word\n"))
+        self.assertIsNone(parse_usage("hello\n"))
+
+    def test_watch_passes_output_on_and_adds_up_usage(self):
+        usage = NodeUsage()
+        logged = []
+        watch = usage.watch("node1", "execute", logged.append)
+        watch.append("output\ncarrier-usage 100 10 ")
+        watch.append("10 0 4096\n")
+        watch.append("carrier-usage 100 20 0 0 4096\n")
+        self.assertEqual(
+            "".join(logged),
+            "output\ncarrier-usage 100 10 10 0 4096\ncarrier-usage 100 20 0 0 4096\n",
+        )
+        self.assertEqual(
+            usage.of("node1")["execute"],
+            {"cpu": 0.4, "read_bytes": 0, "write_bytes": 8192},
+        )
+
+    def test_report_names_the_busiest_node(self):
+        usage = NodeUsage()
+        usage.add("node1", "execute", {"cpu": 1.0, "write_bytes": 2**20})
+        usage.add("node2", "execute", {"cpu": 3.0})
+        usage.add("node2", "archive", {"cpu": 1.0, "read_bytes": 2**20})
+        self.assertEqual(usage.of("node2")["total"]["cpu"], 4.0)
+        self.assertEqual(
+            usage.report("hosts"),
+            "the collection used 5.0 CPU seconds, read 1.0 MiB and wrote 1.0 MiB on 2 hosts, the most on node2 with 4.0 CPU seconds",
+        )
+
+
+class TestThrottle(unittest.TestCase):
+    def test_unlimited_reads_as_it_is(self):
+        consume = lambda stdout: stdout
+        self.assertIs(Throttle().consume(consume), consume)
+
+    def test_node_limit(self):
+        # 4 Mbit/s is 500 kB/s
+        read = Throttle(node_mbit=4).consume(
+            lambda stdout: [stdout.read(50000) for _ in range(3)]
+        )
+        start = time.monotonic()
+        self.assertEqual(len(b"".join(read(io.BytesIO(b"x" * 150000)))), 150000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+    def test_total_limit_is_shared(self):
+        # 4 Mbit/s is 500 kB/s for every node together
+        read = Throttle(node_mbit=100, total_mbit=4).consume(
+            lambda stdout: stdout.read()
+        )
+        start = time.monotonic()
+        # the second node waits for the bytes the first one took
+        read(io.BytesIO(b"x" * 50000))
+        read(io.BytesIO(b"x" * 50000))
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_kbit_per_transfer(self):
+        self.assertEqual(Throttle(node_mbit=100).kbit_per_transfer(8), 100000)
+        self.assertEqual(Throttle(100, 400).kbit_per_transfer(8), 50000)
+
+
+if __name__ == "__main__":
+    unittest.main()
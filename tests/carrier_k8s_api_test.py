@@ -0,0 +1,333 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+from carrier_engine import Engine
+from carrier_k8s_api import STDIN_CHUNK_SIZE, K8sApi, mask_payload
+from carrier_sched import PhaseTimeout
+
+
+def server_frame(opcode, payload):
+    # frames sent by the server are never masked
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 65536:
+        header += bytes([126]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack("!Q", len(payload))
+    return header + payload
+
+
+def read_client_frame(reader):
+    first, second = reader.read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", reader.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", reader.read(8))[0]
+    key = reader.read(4)
+    return first & 0x0F, mask_payload(key, reader.read(length))
+
+
+class FakeApiServer:
+    """accepts a single connection and answers it like the API server would for pods/exec"""
+
+    def __init__(
+        self,
+        stdout=b"",
+        stderr=b"",
+        exit_code=0,
+        stdin_size=0,
+        hang=False,
+        stdout_first=False,
+        sessions=1,
+    ):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.stdin_size = stdin_size
+        self.hang = hang
+        self.stdout_first = stdout_first
+        self.sessions = sessions
+        self.authorizations = []
+        self.stdin = b""
+        self.largest_stdin_frame = 0
+        self.request_line = None
+        self.headers = {}
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        for _ in range(self.sessions):
+            self.serve_session()
+        self.sock.close()
+
+    def serve_session(self):
+        conn, _ = self.sock.accept()
+        reader = conn.makefile("rb")
+        self.request_line = reader.readline().decode()
+        while True:
+            line = reader.readline().decode().strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            self.headers[name.lower()] = value.strip()
+        self.authorizations.append(self.headers.get("authorization"))
+        conn.sendall(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Protocol: v4.channel.k8s.io\r\n\r\n"
+        )
+        if self.stdout_first:
+            # a command that writes all of its output before it reads its input
+            conn.sendall(server_frame(0x2, b"\x01" + self.stdout))
+        while len(self.stdin) < self.stdin_size:
+            opcode, payload = read_client_frame(reader)
+            self.stdin += payload[1:]
+            self.largest_stdin_frame = max(self.largest_stdin_frame, len(payload) - 1)
+        if self.hang:
+            # like a command that never finishes, wait until the client gives up
+            reader.read()
+            reader.close()
+            conn.close()
+            return
+        if not self.stdout_first:
+            conn.sendall(server_frame(0x2, b"\x01" + self.stdout))
+        conn.sendall(server_frame(0x2, b"\x02" + self.stderr))
+        if self.exit_code == 0:
+            status = {"status": "Success"}
+        else:
+            status = {
+                "status": "Failure",
+                "reason": "NonZeroExitCode",
+                "details": {
+                    "causes": [{"reason": "ExitCode", "message": str(self.exit_code)}]
+                },
+            }
+        conn.sendall(server_frame(0x2, b"\x03" + json.dumps(status).encode()))
+        conn.sendall(server_frame(0x8, b""))
+        reader.close()
+        conn.close()
+
+    def query(self):
+        return parse_qs(urlparse(self.request_line.split()[1]).query)
+
+
+class TestK8sApi(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_api(self, server, user=None):
+        config = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [
+                {
+                    "name": "fake",
+                    "cluster": {"server": f"http://127.0.0.1:{server.port}"},
+                }
+            ],
+            "users": [{"name": "fake", "user": user or {"token": "secret"}}],
+            "contexts": [
+                {"name": "fake", "context": {"cluster": "fake", "user": "fake"}}
+            ],
+            "current-context": "fake",
+        }
+        path = os.path.join(self.temp_dir.name, "kubeconfig")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        return K8sApi("fake", path)
+
+    def test_run_logs_output(self):
+        server = FakeApiServer(stdout=b"hello\n", stderr=b"warning\n")
+        pod_log = []
+        asyncio.run(
+            self.make_api(server).run("default", "pod-0", ["echo", "hello"], pod_log)
+        )
+        server.thread.join()
+        self.assertEqual("".join(pod_log[1:]), "output:\thello\nwarning\n\n\n")
+        self.assertIn("/api/v1/namespaces/default/pods/pod-0/exec", server.request_line)
+        self.assertEqual(server.query()["command"], ["echo", "hello"])
+        self.assertEqual(server.headers["authorization"], "Bearer secret")
+
+    def test_exec_plugin_token(self):
+        credential = {"status": {"token": "from-plugin"}}
+        user = {
+            "exec": {
+                "apiVersion": "client.authentication.k8s.io/v1beta1",
+                "command": sys.executable,
+                "args": ["-c", f"print({json.dumps(json.dumps(credential))})"],
+            }
+        }
+        server = FakeApiServer()
+        asyncio.run(self.make_api(server, user).run("default", "pod-0", ["true"], []))
+        server.thread.join()
+        self.assertEqual(server.headers["authorization"], "Bearer from-plugin")
+
+    def run_with_plugin(self, credential, sessions):
+        # the plugin counts how often it ran
+        calls = os.path.join(self.temp_dir.name, "calls")
+        code = f"open({calls!r}, 'a').write('x'); print({json.dumps(json.dumps(credential))})"
+        user = {
+            "exec": {
+                "apiVersion": "client.authentication.k8s.io/v1beta1",
+                "command": sys.executable,
+                "args": ["-c", code],
+            }
+        }
+        server = FakeApiServer(sessions=sessions)
+        api = self.make_api(server, user)
+
+        async def run():
+            await asyncio.gather(
+                *(api.run("default", f"pod-{i}", ["true"], []) for i in range(sessions))
+            )
+
+        asyncio.run(run())
+        server.thread.join()
+        with open(calls) as f:
+            return len(f.read()), server.authorizations
+
+    def test_exec_plugin_runs_once(self):
+        credential = {
+            "status": {"token": "cached", "expirationTimestamp": "2999-01-01T00:00:00Z"}
+        }
+        calls, authorizations = self.run_with_plugin(credential, 5)
+        self.assertEqual(calls, 1)
+        self.assertEqual(authorizations, ["Bearer cached"] * 5)
+
+    def test_expired_exec_credential_is_renewed(self):
+        credential = {
+            "status": {
+                "token": "expired",
+                "expirationTimestamp": "2000-01-01T00:00:00.123456789Z",
+            }
+        }
+        calls, _ = self.run_with_plugin(credential, 3)
+        self.assertEqual(calls, 3)
+
+    def test_run_raises_on_exit_code(self):
+        server = FakeApiServer(exit_code=3)
+        with self.assertRaisesRegex(Exception, "bad exit code 3"):
+            asyncio.run(self.make_api(server).run("default", "pod-0", ["false"], []))
+        server.thread.join()
+
+    def test_copy_to_sends_file_on_stdin(self):
+        src = os.path.join(self.temp_dir.name, "script.sh")
+        content = b"echo hi\n" * 20000
+        with open(src, "wb") as f:
+            f.write(content)
+        server = FakeApiServer(stdin_size=len(content))
+        asyncio.run(
+            self.make_api(server).copy_to("default", "pod-0", src, "/tmp/s.sh", [])
+        )
+        server.thread.join()
+        self.assertEqual(server.stdin, content)
+        # the file goes out a chunk at a time
+        self.assertEqual(server.largest_stdin_frame, STDIN_CHUNK_SIZE)
+        self.assertEqual(
+            server.query()["command"],
+            ["sh", "-c", f"head -c {len(content)} > /tmp/s.sh"],
+        )
+
+    def test_copy_from_saves_stdout(self):
+        dest = os.path.join(self.temp_dir.name, "pod-0.tar.gz")
+        server = FakeApiServer(stdout=b"x" * 50000)
+        engine = Engine(1)
+        asyncio.run(
+            self.make_api(server).copy_from(
+                engine, "default", "pod-0", "/tmp/a.tar.gz", dest, []
+            )
+        )
+        engine.close()
+        server.thread.join()
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 50000)
+
+    @patch("carrier_sched.WATCHDOG_SLACK", 0)
+    def test_run_times_out(self):
+        server = FakeApiServer(hang=True)
+        api = self.make_api(server)
+        with self.assertRaisesRegex(PhaseTimeout, "execute timed out"):
+            asyncio.run(
+                api.run(
+                    "default",
+                    "pod1",
+                    ["sleep", "600"],
+                    [],
+                    timeout=0.5,
+                    phase="execute",
+                )
+            )
+        server.thread.join()
+
+    def test_stdin_is_written_while_stdout_is_read(self):
+        # more than the socket buffers hold either way, written one after the other both sides would wait forever
+        stdin = os.urandom(8 * 1024 * 1024)
+        stdout = os.urandom(8 * 1024 * 1024)
+        server = FakeApiServer(stdout=stdout, stdin_size=len(stdin), stdout_first=True)
+        engine = Engine(1)
+        output = asyncio.run(
+            self.make_api(server).stream(
+                engine,
+                "default",
+                "pod-0",
+                ["sh"],
+                [],
+                lambda f: f.read(),
+                stdin,
+            )
+        )
+        engine.close()
+        server.thread.join()
+        self.assertEqual(output, stdout)
+        self.assertEqual(server.stdin, stdin)
+
+    @patch("carrier_sched.WATCHDOG_SLACK", 0)
+    def test_stream_times_out(self):
+        server = FakeApiServer(hang=True)
+        engine = Engine(1)
+        with self.assertRaisesRegex(PhaseTimeout, "download timed out"):
+            asyncio.run(
+                self.make_api(server).stream(
+                    engine,
+                    "default",
+                    "pod1",
+                    ["cat", "/tmp/a"],
+                    [],
+                    lambda f: f.read(),
+                    timeout=0.5,
+                    phase="download",
+                )
+            )
+        engine.close()
+        server.thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
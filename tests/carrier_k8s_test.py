@@ -10,6 +10,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
 import unittest
 import os
 from carrier_k8s import CarrierK8s
@@ -26,7 +27,7 @@ TEST_DATA_DIR = Path(__file__).resolve().parent / "data"
 
 
 def search_file_in_nested_tar_gz(archive_path, file_name):
-    with tarfile.open(archive_path, "r:gz") as tar:
+    with tarfile.open(archive_path, "r:*") as tar:
         for member in tar.getmembers():
             if member.isfile() and member.name == file_name:
                 # Found the desired file in the current nested tar.gz
@@ -56,7 +57,7 @@ def search_file_in_nested_tar_gz(archive_path, file_name):
 
 def check_file_in_tar_gz(archive_path, file_name):
     # Open the tar.gz archive
-    with tarfile.open(archive_path, "r:gz") as tar:
+    with tarfile.open(archive_path, "r:*") as tar:
         # Check if the file exists in the archive
         return file_name in tar.getnames()
 
@@ -99,23 +100,23 @@ class TestCarrierK8s(unittest.TestCase):
             "app.kubernetes.io/name=dremio-easy-chart",
             "bash",
             [],
-            TEST_DATA_DIR / "output" / "output.tar.gz",
+            TEST_DATA_DIR / "output" / "output.tar",
             "kind-dremio-testing",
             ".pytest-kind/dremio-testing/kubeconfig",
         )
 
     def tearDown(self):
         try:
-            os.remove(TEST_DATA_DIR / "output" / "output.tar.gz")
+            os.remove(TEST_DATA_DIR / "output" / "output.tar")
         except:
             pass
 
     def test_get_pods(self):
-        pods = self.runner.get_pods()
+        pods = asyncio.run(self.runner.get_pods())
         self.assertEqual(pods, ["demo-dremio-easy-chart-0"])
 
     def test_run_carrier(self):
-        archive_path = TEST_DATA_DIR / "output" / "output.tar.gz"
+        archive_path = TEST_DATA_DIR / "output" / "output.tar"
         nested_archive = "demo-dremio-easy-chart-0.tar.gz"
         self.runner.run()
         check_file_in_tar_gz(archive_path, nested_archive)
@@ -124,6 +125,44 @@ class TestCarrierK8s(unittest.TestCase):
         server_out = search_file_in_nested_tar_gz(archive_path, "./server.out")
         self.assertNotEqual(None, server_out)
 
+    def test_get_pods_api_backend(self):
+        runner = CarrierK8s(
+            TEST_DATA_DIR / "test_script.sh",
+            "default",
+            "app.kubernetes.io/name=dremio-easy-chart",
+            "bash",
+            [],
+            TEST_DATA_DIR / "output" / "output.tar",
+            "kind-dremio-testing",
+            ".pytest-kind/dremio-testing/kubeconfig",
+            backend="api",
+        )
+        self.assertEqual(asyncio.run(runner.get_pods()), ["demo-dremio-easy-chart-0"])
+
+    def test_run_carrier_api_backend(self):
+        archive_path = TEST_DATA_DIR / "output" / "output.tar"
+        runner = CarrierK8s(
+            TEST_DATA_DIR / "test_script.sh",
+            "default",
+            "app.kubernetes.io/name=dremio-easy-chart",
+            "bash",
+            [],
+            archive_path,
+            "kind-dremio-testing",
+            ".pytest-kind/dremio-testing/kubeconfig",
+            backend="api",
+        )
+        runner.run()
+        f = search_file_in_nested_tar_gz(archive_path, "./carrier.log")
+        self.assertEqual("this is my test log\n", f)
+
+    def test_run_carrier_single_session(self):
+        archive_path = TEST_DATA_DIR / "output" / "output.tar"
+        self.runner.single_session = True
+        self.runner.run()
+        f = search_file_in_nested_tar_gz(archive_path, "./carrier.log")
+        self.assertEqual("this is my test log\n", f)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,71 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import io
+import os
+import tempfile
+import unittest
+from carrier_live import LiveFiles
+
+
+def changes(*items):
+    data = b""
+    for offset, path, content in items:
+        data += f"{offset} {len(content)} {path}\n".encode("utf-8") + content
+    return io.BytesIO(data)
+
+
+class TestLiveFiles(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.live = LiveFiles(self.temp_dir.name, "host1")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read(self, path):
+        with open(os.path.join(self.temp_dir.name, "host1", path), "rb") as f:
+            return f.read()
+
+    def test_appends_and_replaces(self):
+        self.live.consume(
+            changes(
+                (0, "./ttop.out", b"first\n"),
+                (0, "./sub/my file.out", b"a"),
+                (6, "./ttop.out", b"second\n"),
+                # the file shrank on the node, it starts over
+                (0, "./sub/my file.out", b""),
+            )
+        )
+        self.assertEqual(self.read("ttop.out"), b"first\nsecond\n")
+        self.assertEqual(self.read("sub/my file.out"), b"")
+        self.assertEqual(self.live.changes, 4)
+        self.assertEqual(self.live.bytes, 14)
+
+    def test_clears_files_of_an_earlier_run(self):
+        self.live.consume(changes((0, "./old.out", b"old")))
+        live = LiveFiles(self.temp_dir.name, "host1")
+        self.assertEqual(os.listdir(live.dir), [])
+
+    def test_stream_cut_short(self):
+        data = changes((0, "./ttop.out", b"first\n")).getvalue()
+        with self.assertRaises(EOFError):
+            self.live.consume(io.BytesIO(data[:-2]))
+
+    def test_refuses_paths_outside_the_node(self):
+        with self.assertRaises(ValueError):
+            self.live.consume(changes((0, "../../etc/passwd", b"x")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import tempfile
+import unittest
+from carrier_log import MAX_LINE_LENGTH, NodeLog
+
+
+class TestNodeLog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "logs", "pod-0.log")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_full_log_on_disk_and_tail_in_memory(self):
+        log = NodeLog(self.path, tail_lines=3)
+        for i in range(1000):
+            log.append(f"line {i}\n")
+        log.append("no newline yet")
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.read().splitlines()), 1001)
+        self.assertEqual(
+            log.tail_text(), "line 997\nline 998\nline 999\nno newline yet"
+        )
+
+    def test_lines_split_over_appends(self):
+        log = NodeLog(self.path)
+        log.append("output:\thel")
+        log.append("lo\nwor")
+        log.append("ld\n")
+        log.close()
+        self.assertEqual(log.tail_text(), "output:\thello\nworld\n")
+
+    def test_long_lines_are_cut(self):
+        log = NodeLog(self.path)
+        log.append("x" * (MAX_LINE_LENGTH * 10))
+        log.append("y" * (MAX_LINE_LENGTH * 10) + "\n")
+        log.close()
+        self.assertEqual(log.tail_text(), "y" * MAX_LINE_LENGTH + "\n")
+        self.assertEqual(os.path.getsize(self.path), MAX_LINE_LENGTH * 20 + 1)
+
+    def test_reopens_after_close(self):
+        log = NodeLog(self.path)
+        log.append("executed\n")
+        log.close()
+        self.assertIsNone(log.handle)
+        log.append("collected\n")
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "executed\ncollected\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+from carrier_archive import Bundle
+from carrier_manifest import (
+    DONE,
+    FAILED,
+    TIMED_OUT,
+    RunManifest,
+    load_previous_run,
+)
+from carrier_sched import PhaseTimeout
+
+
+class TestRunManifest(unittest.TestCase):
+    def test_statuses(self):
+        manifest = RunManifest()
+        manifest.done("host1", "host1.tar.gz")
+        manifest.failed("host2", Exception("bad exit code 1"))
+        manifest.failed("host3", PhaseTimeout("download", 60))
+        manifest.timed_out("host4", PhaseTimeout("execute", 600))
+        manifest.done("host4", "host4.tar.gz")
+        run = json.loads(manifest.to_json())
+        self.assertEqual(run["summary"], {DONE: 1, FAILED: 1, TIMED_OUT: 2})
+        self.assertEqual(
+            run["nodes"]["host1"], {"status": DONE, "archive": "host1.tar.gz"}
+        )
+        self.assertEqual(run["nodes"]["host2"]["error"], "bad exit code 1")
+        self.assertEqual(run["nodes"]["host3"]["phase"], "download")
+        self.assertNotIn("archive", run["nodes"]["host3"])
+        # the script ran out of time but what it wrote was collected
+        self.assertEqual(run["nodes"]["host4"]["phase"], "execute")
+        self.assertEqual(run["nodes"]["host4"]["archive"], "host4.tar.gz")
+        self.assertTrue(run["nodes"]["host4"]["partial"])
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.temp_dir.name, "output.tar.gz")
+        self.checkpoint = os.path.join(self.temp_dir.name, "carrier-run.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_run(self, complete):
+        with tarfile.open(self.output, "w:gz") as tar:
+            for node in ("host1", "host2"):
+                info = tarfile.TarInfo(f"{node}/carrier.log")
+                info.size = len(node)
+                tar.addfile(info, io.BytesIO(node.encode("utf-8")))
+        manifest = RunManifest()
+        manifest.done("host1", "host1", 1)
+        # host2 claims more members than the archive has, as if the run died while it was copied
+        manifest.done("host2", "host2", 2)
+        manifest.failed("host3", Exception("bad exit code 1"))
+        manifest.save(self.checkpoint, bundle=self.output, complete=complete)
+
+    def test_save_is_throttled(self):
+        manifest = RunManifest()
+        manifest.save(self.checkpoint, bundle=self.output)
+        manifest.done("host1", "host1")
+        manifest.save(self.checkpoint)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)["nodes"], {})
+        manifest.save(self.checkpoint, force=True)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)["nodes"]["host1"]["status"], DONE)
+
+    def test_resume_keeps_nodes_with_every_member(self):
+        self.write_run(complete=False)
+        previous = load_previous_run(self.checkpoint, self.output)
+        self.assertEqual(previous["previous_archive"], self.output + ".previous")
+        self.assertFalse(os.path.exists(self.output))
+        manifest = RunManifest()
+        bundle = Bundle(self.output)
+        self.assertEqual(manifest.resume(previous, bundle), {"host1"})
+        bundle.close()
+        with tarfile.open(self.output) as tar:
+            self.assertEqual(tar.getnames(), ["host1/carrier.log"])
+        self.assertTrue(manifest.get("host1")["resumed"])
+        self.assertEqual(manifest.get("host2"), {})
+
+    def test_resume_trusts_a_complete_run(self):
+        self.write_run(complete=True)
+        previous = load_previous_run(self.checkpoint, self.output)
+        bundle = Bundle(self.output)
+        self.assertEqual(RunManifest().resume(previous, bundle), {"host1", "host2"})
+        bundle.close()
+
+    def test_resume_again_finds_the_moved_archive(self):
+        self.write_run(complete=False)
+        load_previous_run(self.checkpoint, self.output)
+        previous = load_previous_run(self.checkpoint, self.output)
+        self.assertEqual(previous["previous_archive"], self.output + ".previous")
+
+    def test_resume_a_run_without_archive(self):
+        manifest = RunManifest()
+        manifest.failed("host1", Exception("bad exit code 1"))
+        manifest.save(self.checkpoint, bundle=None, complete=True)
+        previous = load_previous_run(self.checkpoint, self.output)
+        self.assertIsNone(previous["previous_archive"])
+        bundle = Bundle(self.output)
+        self.assertEqual(RunManifest().resume(previous, bundle), set())
+        bundle.close()
+
+    def test_resume_needs_the_same_archive(self):
+        self.write_run(complete=True)
+        with self.assertRaises(ValueError):
+            load_previous_run(self.checkpoint, self.output[: -len(".gz")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import io
+import os
+import subprocess
+import tarfile
+import tempfile
+import unittest
+from carrier_live import LiveFiles
+from carrier_remote import bootstrap_cmd, timed_out_remotely
+
+SCRIPT = b"""echo "running with $1 $2"
+echo "this is my test log" > carrier.log
+mkdir sub && echo nested > sub/nested.out
+"""
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.workdir = os.path.join(self.temp_dir.name, "host1_tmp")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_bootstrap(
+        self, script, timeout=None, compression="gzip", install=None, live_interval=None
+    ):
+        cmd = bootstrap_cmd(
+            self.workdir,
+            "script.sh",
+            "bash",
+            "a b",
+            len(script),
+            timeout,
+            compression,
+            install=install,
+            attachment_names=["tool.jar"] if install else [],
+            live_interval=live_interval,
+        )
+        return subprocess.run(
+            cmd, shell=True, input=script, capture_output=True, cwd=self.temp_dir.name
+        )
+
+    def test_bootstrap_runs_script_and_streams_results(self):
+        p = self.run_bootstrap(SCRIPT)
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(p.stderr, b"running with a b\n")
+        with tarfile.open(fileobj=io.BytesIO(p.stdout), mode="r:gz") as tar:
+            names = tar.getnames()
+            self.assertIn("./carrier.log", names)
+            self.assertIn("./sub/nested.out", names)
+            self.assertNotIn("./script.sh", names)
+        self.assertFalse(os.path.exists(self.workdir))
+
+    def test_bootstrap_keeps_results_of_failed_script(self):
+        p = self.run_bootstrap(b"echo partial > partial.out\nexit 4\n")
+        self.assertEqual(p.returncode, 4)
+        with tarfile.open(fileobj=io.BytesIO(p.stdout), mode="r:gz") as tar:
+            self.assertIn("./partial.out", tar.getnames())
+        self.assertFalse(os.path.exists(self.workdir))
+
+    def test_bootstrap_keeps_results_of_timed_out_script(self):
+        p = self.run_bootstrap(b"echo partial > partial.out\nsleep 30\n", timeout=1)
+        self.assertTrue(timed_out_remotely(p))
+        with tarfile.open(fileobj=io.BytesIO(p.stdout), mode="r:gz") as tar:
+            self.assertIn("./partial.out", tar.getnames())
+        self.assertFalse(os.path.exists(self.workdir))
+
+    def test_bootstrap_uncompressed(self):
+        p = self.run_bootstrap(SCRIPT, compression="none")
+        self.assertEqual(p.returncode, 0)
+        with tarfile.open(fileobj=io.BytesIO(p.stdout), mode="r:") as tar:
+            self.assertIn("./carrier.log", tar.getnames())
+
+    def test_bootstrap_installs_attached_files(self):
+        jar = os.path.join(self.temp_dir.name, "cached-jar")
+        with open(jar, "w") as f:
+            f.write("jar")
+        p = self.run_bootstrap(
+            b"cat tool.jar > seen.out\n",
+            install=f"cp {jar} {self.workdir}/tool.jar",
+        )
+        self.assertEqual(p.returncode, 0)
+        with tarfile.open(fileobj=io.BytesIO(p.stdout), mode="r:gz") as tar:
+            self.assertNotIn("./tool.jar", tar.getnames())
+            self.assertEqual(tar.extractfile("./seen.out").read(), b"jar")
+
+    def test_live_bootstrap_sends_files_as_they_grow(self):
+        jar = os.path.join(self.temp_dir.name, "cached-jar")
+        with open(jar, "w") as f:
+            f.write("jar")
+        p = self.run_bootstrap(
+            b"""for i in 1 2 3; do echo "sample $i" >> samples.out; sleep 0.3; done
+mkdir sub && echo nested > sub/nested.out
+echo first > status.out; sleep 1.1; echo again > status.out
+""",
+            install=f"cp {jar} {self.workdir}/tool.jar",
+            live_interval=0.2,
+        )
+        self.assertEqual(p.returncode, 0)
+        live = LiveFiles(os.path.join(self.temp_dir.name, "live"), "host1")
+        live.consume(io.BytesIO(p.stdout))
+        self.assertEqual(
+            sorted(os.listdir(live.dir)), ["samples.out", "status.out", "sub"]
+        )
+        with open(os.path.join(live.dir, "samples.out")) as f:
+            self.assertEqual(f.read(), "sample 1\nsample 2\nsample 3\n")
+        # rewritten without growing, it is sent again whole
+        with open(os.path.join(live.dir, "status.out")) as f:
+            self.assertEqual(f.read(), "again\n")
+        self.assertGreater(live.changes, 4)
+        self.assertFalse(os.path.exists(self.workdir))
+        self.assertFalse(os.path.exists(self.workdir + ".sent"))
+
+    def test_live_bootstrap_keeps_results_of_timed_out_script(self):
+        p = self.run_bootstrap(
+            b"echo partial > partial.out\nsleep 30\n", timeout=1, live_interval=0.5
+        )
+        self.assertTrue(timed_out_remotely(p))
+        live = LiveFiles(os.path.join(self.temp_dir.name, "live"), "host1")
+        live.consume(io.BytesIO(p.stdout))
+        self.assertEqual(os.listdir(live.dir), ["partial.out"])
+
+
+if __name__ == "__main__":
+    unittest.main()
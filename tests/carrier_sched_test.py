@@ -0,0 +1,198 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import time
+import unittest
+from carrier_sched import (
+    Deadline,
+    PhaseTimeout,
+    RelayTree,
+    StartBarrier,
+    Scheduler,
+    parse_phase_timeouts,
+)
+
+
+class Counter:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *args):
+        self.current -= 1
+
+
+class TestScheduler(unittest.TestCase):
+    def test_limits_each_phase(self):
+        executing = Counter()
+        transferring = Counter()
+
+        async def execute(node):
+            with executing:
+                await asyncio.sleep(0.05)
+            return node * 2
+
+        async def transfer(node, executed):
+            with transferring:
+                await asyncio.sleep(0.05)
+            return executed + 1
+
+        async def run():
+            scheduler = Scheduler(4, 2)
+            tasks = [scheduler.submit(n, execute, transfer) for n in range(20)]
+            return sorted(await asyncio.gather(*tasks))
+
+        results = asyncio.run(run())
+        self.assertEqual(results, sorted(n * 2 + 1 for n in range(20)))
+        self.assertEqual(executing.peak, 4)
+        self.assertEqual(transferring.peak, 2)
+
+    def test_failed_execute_skips_transfer(self):
+        transferred = []
+
+        async def execute(node):
+            raise ValueError(f"{node} failed")
+
+        async def transfer(node, executed):
+            transferred.append(node)
+
+        async def run():
+            await Scheduler(2, 2).submit("host1", execute, transfer)
+
+        with self.assertRaisesRegex(ValueError, "host1 failed"):
+            asyncio.run(run())
+        self.assertEqual(transferred, [])
+
+    def test_first_completed(self):
+        async def run():
+            scheduler = Scheduler(2, 1)
+            slow = scheduler.submit(0.3, asyncio.sleep)
+            fast = scheduler.submit(0.01, asyncio.sleep)
+            done, _ = await asyncio.wait(
+                [slow, fast], return_when=asyncio.FIRST_COMPLETED
+            )
+            await slow
+            return done, fast
+
+        done, fast = asyncio.run(run())
+        self.assertEqual(done, {fast})
+
+
+class TestDeadline(unittest.TestCase):
+    def test_no_limits(self):
+        self.assertIsNone(Deadline().limit("execute"))
+
+    def test_phase_timeout(self):
+        deadline = Deadline(phase_timeouts={"execute": 5})
+        self.assertEqual(deadline.limit("execute"), 5)
+        self.assertIsNone(deadline.limit("download"))
+
+    def test_global_timeout_bounds_phases(self):
+        deadline = Deadline(100, {"execute": 500, "upload": 5})
+        self.assertLessEqual(deadline.limit("execute"), 100)
+        self.assertEqual(deadline.limit("upload"), 5)
+
+    def test_collect_phases_get_grace_after_deadline(self):
+        deadline = Deadline(-10, grace=30)
+        self.assertEqual(deadline.limit("download"), 30)
+        with self.assertRaisesRegex(PhaseTimeout, "deadline passed before execute"):
+            deadline.check("execute")
+
+    def test_parse_phase_timeouts(self):
+        self.assertEqual(
+            parse_phase_timeouts(["execute=600", "download=1.5"]),
+            {"execute": 600.0, "download": 1.5},
+        )
+        self.assertEqual(parse_phase_timeouts(None), {})
+
+
+class TestRelayTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = RelayTree([f"host{i}" for i in range(7)], 2)
+
+    def test_fanout(self):
+        self.assertEqual(self.tree.parents["host0"], None)
+        self.assertEqual(self.tree.parents["host1"], None)
+        self.assertEqual(self.tree.parents["host2"], "host0")
+        self.assertEqual(self.tree.parents["host3"], "host0")
+        self.assertEqual(self.tree.parents["host4"], "host1")
+        self.assertEqual(self.tree.parents["host6"], "host2")
+
+    def test_source_waits_for_parent(self):
+        async def run():
+            self.assertIsNone(await self.tree.source("host0"))
+            source = asyncio.ensure_future(self.tree.source("host2"))
+            await asyncio.sleep(0.1)
+            self.assertFalse(source.done())
+            self.tree.ready("host0")
+            return await asyncio.wait_for(source, 5)
+
+        self.assertEqual(asyncio.run(run()), "host0")
+
+    def test_failed_parent_falls_back_to_its_ancestors(self):
+        async def run():
+            self.tree.ready("host0")
+            self.tree.release("host2")
+            self.assertEqual(await self.tree.source("host6"), "host0")
+            self.tree.release("host1")
+            self.assertIsNone(await self.tree.source("host4"))
+
+        asyncio.run(run())
+
+    def test_source_gives_up_after_timeout(self):
+        self.assertIsNone(asyncio.run(self.tree.source("host6", 0.1)))
+
+
+class TestStartBarrier(unittest.TestCase):
+    def test_every_node_gets_the_same_start(self):
+        async def run():
+            barrier = StartBarrier(["host0", "host1", "host2"], 2)
+            first = asyncio.ensure_future(barrier.arrive("host0"))
+            second = asyncio.ensure_future(barrier.arrive("host1"))
+            await asyncio.sleep(0.1)
+            self.assertFalse(first.done())
+            before = time.time()
+            last = await barrier.arrive("host2")
+            self.assertEqual(await first, last)
+            self.assertEqual(await second, last)
+            return before, last
+
+        before, last = asyncio.run(run())
+        self.assertAlmostEqual(last, before + 2, delta=0.5)
+
+    def test_failed_node_does_not_hold_back_the_others(self):
+        async def run():
+            barrier = StartBarrier(["host0", "host1"], 0)
+            start = asyncio.ensure_future(barrier.arrive("host0"))
+            await asyncio.sleep(0.1)
+            self.assertFalse(start.done())
+            barrier.leave("host1")
+            await asyncio.wait_for(start, 5)
+
+        asyncio.run(run())
+
+    def test_late_node_starts_once_staged(self):
+        async def run():
+            barrier = StartBarrier(["host0", "host1"], 0)
+            start = await barrier.arrive("host0", 0.1)
+            self.assertEqual(await barrier.arrive("host1"), start)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
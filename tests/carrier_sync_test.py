@@ -0,0 +1,66 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import io
+import subprocess
+import time
+import unittest
+from carrier_sync import ClockProbe, clock_offset, parse_clock, start_at_cmd
+
+
+class TestClock(unittest.TestCase):
+    def test_parse_clock(self):
+        self.assertEqual(parse_clock("1700000000.250000000\n"), 1700000000.25)
+        # a date without %N prints it as it is
+        self.assertEqual(parse_clock("1700000000.%N\n"), 1700000000.5)
+        self.assertIsNone(parse_clock("date: command not found\n"))
+
+    def test_clock_offset(self):
+        now = time.time()
+        probe = io.BytesIO(
+            f"{now + 60.5:.9f}\n{now + 60:.9f}\nno clock here\n".encode("utf-8")
+        )
+        self.assertAlmostEqual(clock_offset(probe), 60.5, delta=0.5)
+
+    def test_clock_probe_keeps_the_least_delayed_sample(self):
+        probe = ClockProbe()
+        now = time.time()
+        probe.receive(f"{now + 59:.9f}\n".encode("utf-8"))
+        probe.receive(f"{now + 60:.9f}\n".encode("utf-8"))
+        probe.receive(b"no clock here\n")
+        self.assertAlmostEqual(probe.offset(), 60, delta=0.5)
+
+    def test_clock_offset_needs_a_clock(self):
+        with self.assertRaises(ValueError):
+            clock_offset(io.BytesIO(b"sh: date: not found\n"))
+
+
+class TestStartAt(unittest.TestCase):
+    def test_waits_until_start(self):
+        start = time.time() + 1.5
+        subprocess.run(["sh", "-c", start_at_cmd(start)], check=True)
+        self.assertAlmostEqual(time.time(), start, delta=0.3)
+
+    def test_start_within_the_second(self):
+        start = time.time() + 0.5
+        subprocess.run(["sh", "-c", start_at_cmd(start)], check=True)
+        self.assertAlmostEqual(time.time(), start, delta=0.3)
+
+    def test_start_in_the_past(self):
+        before = time.time()
+        subprocess.run(["sh", "-c", start_at_cmd(before - 10)], check=True)
+        self.assertLess(time.time() - before, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
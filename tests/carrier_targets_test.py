@@ -0,0 +1,102 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import unittest
+from carrier_targets import Target, discover, parse_target
+
+
+class TestParseTarget(unittest.TestCase):
+    def test_every_field(self):
+        self.assertEqual(
+            parse_target("prod-eu:dremio:app=dremio-executor:dremio"),
+            {
+                "context": "prod-eu",
+                "namespace": "dremio",
+                "labels": "app=dremio-executor",
+                "container": "dremio",
+            },
+        )
+
+    def test_empty_fields_are_left_out(self):
+        self.assertEqual(parse_target(":dremio::"), {"namespace": "dremio"})
+
+    def test_context_with_colons(self):
+        target = parse_target(
+            "arn:aws:eks:us-east-1:123456789012:cluster/prod:dremio:app=dremio:"
+        )
+        self.assertEqual(
+            target["context"], "arn:aws:eks:us-east-1:123456789012:cluster/prod"
+        )
+        self.assertEqual(target["labels"], "app=dremio")
+
+    def test_missing_fields(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_target("prod-eu:dremio")
+
+
+def listing(listed):
+    async def list_pods(target):
+        return listed[target]
+
+    return list_pods
+
+
+class TestDiscover(unittest.TestCase):
+    def test_one_target_keeps_pod_names(self):
+        target = Target()
+        listed = {target: ["pod-0", "pod-1"]}
+        pods, failures = asyncio.run(discover([target], listing(listed)))
+        self.assertEqual(list(pods), ["pod-0", "pod-1"])
+        self.assertEqual(failures, {})
+
+    def test_targets_take_turns(self):
+        eu = Target("eu", "dremio", "app=dremio")
+        us = Target("us", "dremio", "app=dremio", "dremio")
+        listed = {eu: ["pod-0", "pod-1", "pod-2"], us: ["pod-0"]}
+        pods, _ = asyncio.run(discover([eu, us], listing(listed)))
+        self.assertEqual(
+            list(pods),
+            [
+                "eu/dremio/pod-0",
+                "us/dremio/pod-0",
+                "eu/dremio/pod-1",
+                "eu/dremio/pod-2",
+            ],
+        )
+        self.assertEqual(pods["us/dremio/pod-0"], (us, "pod-0"))
+
+    def test_pod_of_two_targets_is_collected_once(self):
+        coordinator = Target("eu", "dremio", "role=coordinator")
+        everything = Target("eu", "dremio", "app=dremio")
+        listed = {coordinator: ["master-0"], everything: ["master-0", "executor-0"]}
+        pods, _ = asyncio.run(discover([coordinator, everything], listing(listed)))
+        self.assertEqual(list(pods), ["eu/dremio/master-0", "eu/dremio/executor-0"])
+        self.assertIs(pods["eu/dremio/master-0"][0], coordinator)
+
+    def test_failing_target(self):
+        eu = Target("eu", "dremio")
+        us = Target("us", "dremio")
+
+        async def list_pods(target):
+            if target is us:
+                raise RuntimeError("connection refused")
+            return ["pod-0"]
+
+        pods, failures = asyncio.run(discover([eu, us], list_pods))
+        self.assertEqual(list(pods), ["eu/dremio/pod-0"])
+        self.assertEqual(list(failures), [us])
+
+
+if __name__ == "__main__":
+    unittest.main()
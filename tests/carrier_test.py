@@ -11,19 +11,46 @@
 #    limitations under the License.
 
 
+import asyncio
+import io
+import json
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 from carrier import Carrier
+from carrier_archive import Bundle
+from carrier_manifest import MANIFEST_NAME, RunManifest
+from carrier_sched import PhaseTimeout, StartBarrier
+
+
+def commands(mock):
+    # every command is an argv list, joined they read like the command line
+    return [" ".join(call[0][0]) for call in mock.call_args_list]
 
 
 class TestCarrier(unittest.TestCase):
     def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # runs keep their manifest next to the final archive, which is in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.temp_dir.name)
+        self.script = os.path.join(self.temp_dir.name, "test_script.sh")
+        with open(self.script, "w") as f:
+            f.write("echo hi\n")
         self.runner = Carrier(
-            "test_script.sh", ["host1", "host2"], "user", "password", False, "bash"
+            self.script, ["host1", "host2"], "user", "password", False, "bash"
         )
 
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.temp_dir.cleanup()
+
     def test_init(self):
-        self.assertEqual(self.runner.script, "test_script.sh")
+        self.assertEqual(self.runner.script, self.script)
         self.assertEqual(self.runner.hosts, ["host1", "host2"])
         self.assertEqual(self.runner.username, "user")
         self.assertEqual(self.runner.use_key, False)
@@ -40,20 +67,426 @@ class TestCarrier(unittest.TestCase):
         self.assertIn("scp", cmd)
 
     @patch("carrier.Carrier.run_cmd")
-    def test_run_script_on_host(self, mock_run_cmd):
-        self.runner.run_script_on_host("host1")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    def test_run_script_on_host(self, mock_read_cmd, mock_run_cmd):
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        # mkdir and list the cache, then copy script, run, tar and copy back
+        self.assertEqual(mock_read_cmd.call_count, 1)
+        self.assertEqual(mock_run_cmd.call_count, 4)
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    def test_commands_skip_the_local_shell(self, mock_read_cmd, mock_run_cmd):
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        run_script_cmd = mock_run_cmd.call_args_list[1][0][0]
+        # the remote command is one argument, nothing on this side splits or expands it
+        self.assertEqual(run_script_cmd[0], "ssh")
+        self.assertIn("StrictHostKeyChecking no", run_script_cmd)
+        self.assertEqual(run_script_cmd[-2], "-t")
+        self.assertTrue(run_script_cmd[-1].startswith("echo password | sudo -S "))
+        self.assertIn("cd host1_tmp/data && bash test_script.sh", run_script_cmd[-1])
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd")
+    def test_cached_files_are_not_copied_again(self, mock_read_cmd, mock_run_cmd):
+        jar = os.path.join(self.temp_dir.name, "sjk-plus.jar")
+        with open(jar, "wb") as f:
+            f.write(b"jar")
+        self.runner.attachments = [jar]
+        script, attached = self.runner.load_artifacts(self.script, jar)
+        mock_read_cmd.return_value = f"{script.digest}\n"
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        # only the jar is copied, to a part file that is moved into the cache before the script runs
+        cmds = commands(mock_run_cmd)
+        copies = [cmd for cmd in cmds if cmd.startswith("scp")]
+        self.assertEqual(len(copies), 2)
+        self.assertIn(f"host1:.carrier-cache/{attached.digest}.host1.part", copies[0])
+        self.assertIn(f"mv -f .carrier-cache/{attached.digest}.host1.part", cmds[1])
+        self.assertIn("host1_tmp/data/sjk-plus.jar", cmds[1])
+        self.assertIn("--exclude=sjk-plus.jar", cmds[2])
+
+    def test_run_cmd_prefixes_output_with_host(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            asyncio.run(
+                self.runner.run_cmd(["sh", "-c", "echo hello; echo world"], "host1")
+            )
+            self.runner.close_log()
+            with open(self.runner.log_file) as log:
+                self.assertEqual("[host1] hello\n[host1] world\n", log.read())
+
+    def test_log_keeps_the_order_of_the_lines(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            logs = [self.runner.log_lines(f"host{i}") for i in range(3)]
+            for n in range(3000):
+                logs[n % 3](f"line {n}\n")
+            self.runner.close_log()
+            with open(self.runner.log_file) as log:
+                expected = "".join(f"[host{n % 3}] line {n}\n" for n in range(3000))
+                self.assertEqual(log.read(), expected)
+            # the writer is gone until something is logged again
+            self.assertIsNone(self.runner.log_writer)
+
+    def test_run_cmd_raises_on_failure(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            with self.assertRaises(subprocess.CalledProcessError):
+                asyncio.run(self.runner.run_cmd(["sh", "-c", "exit 3"], "host1"))
+            self.runner.close_log()
+
+    @patch("carrier_sched.WATCHDOG_SLACK", 0)
+    def test_run_cmd_kills_command_on_timeout(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            self.runner.deadline.phase_timeouts = {"execute": 0.2}
+            start = time.time()
+            with self.assertRaisesRegex(PhaseTimeout, "execute timed out"):
+                asyncio.run(
+                    self.runner.run_cmd(
+                        ["sh", "-c", "echo started; sleep 30"], "host1", "execute"
+                    )
+                )
+            self.assertLess(time.time() - start, 10)
+            self.runner.close_log()
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    def test_relayed_files_come_from_parent(self, mock_read_cmd, mock_run_cmd):
+        runner = Carrier(
+            self.script, ["host1", "host2"], "user", None, True, "bash", relay=1
+        )
+
+        async def run():
+            runner.relay.ready("host1")
+            await runner.execute_on_host("host2")
+            return runner.relay.released("host2").is_set()
+
+        self.assertTrue(asyncio.run(run()))
+        cmds = commands(mock_run_cmd)
+        # nothing is copied from here, host1 copies the script to host2 and host2 moves it into its cache
+        self.assertFalse(any(cmd.startswith("scp") for cmd in cmds))
+        self.assertIn("ForwardAgent yes", cmds[0])
+        self.assertIn("user@host1 scp -q -o 'StrictHostKeyChecking no'", cmds[0])
+        self.assertIn("user@host2:.carrier-cache/", cmds[0])
+        self.assertIn("user@host2 mv -f .carrier-cache/", cmds[1])
+
+    def test_relay_needs_key(self):
+        with self.assertRaises(ValueError):
+            Carrier(self.script, ["host1"], "user", "password", False, "bash", relay=2)
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    def test_timed_out_script_is_still_collected(self, mock_read_cmd, mock_run_cmd):
+        def run_cmd(cmd, host=None, phase=None):
+            if phase == "execute":
+                raise subprocess.CalledProcessError(124, cmd)
+
+        mock_run_cmd.side_effect = run_cmd
+        self.runner.deadline.phase_timeouts = {"execute": 60}
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        self.assertIn("timeout -k 5 60 bash", commands(mock_run_cmd)[1])
+        # archive and download still run after the script was stopped
+        self.assertEqual(mock_run_cmd.call_count, 4)
+        self.assertEqual(self.runner.manifest.get("host1")["phase"], "execute")
+
+    def test_run_cmd_does_not_serialize_hosts(self):
+        async def run():
+            await asyncio.gather(
+                *(self.runner.run_cmd(["sleep", "1"], f"host{i}") for i in range(4))
+            )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            start = time.time()
+            asyncio.run(run())
+            self.runner.close_log()
+            self.assertLess(time.time() - start, 3)
+
+    def test_run_stream_cmd_into_bundle(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            data_dir = os.path.join(temp_dir, "data")
+            os.mkdir(data_dir)
+            with open(os.path.join(data_dir, "carrier.log"), "w") as f:
+                f.write("this is my test log\n")
+            archive = os.path.join(temp_dir, "output.tar.gz")
+            self.runner.bundle = Bundle(archive)
+            asyncio.run(
+                self.runner.run_stream_cmd(
+                    ["sh", "-c", f"tar -czf - -C {data_dir} . ; echo done >&2"],
+                    "host1",
+                    lambda stdout: self.runner.bundle.add_stream(stdout, "host1"),
+                )
+            )
+            self.runner.bundle.close()
+            self.runner.close_log()
+            with tarfile.open(archive, "r:gz") as tar:
+                self.assertIn("host1/carrier.log", tar.getnames())
+            with open(self.runner.log_file) as log:
+                self.assertEqual("[host1] done\n", log.read())
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    @patch("carrier.Carrier.run_stream_cmd")
+    def test_run_script_on_host_streamed(
+        self, mock_run_stream_cmd, mock_read_cmd, mock_run_cmd
+    ):
+        self.runner.stream = True
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        # copy script and run, then tar streams back instead of tar + scp
+        self.assertEqual(mock_run_cmd.call_count, 2)
+        self.assertIn("tar -czf - ", commands(mock_run_stream_cmd)[0])
+        self.assertIn("-T", mock_run_stream_cmd.call_args[0][0])
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.run_stream_cmd")
+    def test_run_script_on_host_single_session(self, mock_run_stream_cmd, mock_run_cmd):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.script = os.path.join(temp_dir, "test_script.sh")
+            with open(self.runner.script, "w") as f:
+                f.write("echo hi\n")
+            self.runner.single_session = True
+            asyncio.run(self.runner.run_script_on_host("host1"))
+        mock_run_cmd.assert_not_called()
+        self.assertEqual(mock_run_stream_cmd.call_count, 1)
+        cmd, host, consume, stdin = mock_run_stream_cmd.call_args[0]
+        self.assertEqual(cmd[-3:-1], ["-T", "user@host1"])
+        self.assertTrue(cmd[-1].startswith("sudo -S -p '' sh -c"))
+        self.assertEqual(stdin, b"password\necho hi\n")
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    def test_run_script_on_host_multiplexed(self, mock_read_cmd, mock_run_cmd):
+        self.runner.multiplex = True
+        asyncio.run(self.runner.run_script_on_host("host1"))
+        # one extra call to open the master connection
         self.assertEqual(mock_run_cmd.call_count, 5)
+        self.assertIn(
+            f"ControlPath {self.runner.control_dir}/%C",
+            mock_read_cmd.call_args[0][0],
+        )
+        self.assertIn("ControlMaster yes", mock_run_cmd.call_args_list[0][0][0])
+        for call in mock_run_cmd.call_args_list[1:]:
+            self.assertIn(f"ControlPath {self.runner.control_dir}/%C", call[0][0])
+        control_dir = self.runner.control_dir
+        asyncio.run(self.runner.close_connections())
+        self.assertIn("-O exit", commands(mock_run_cmd)[-1])
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertEqual(self.runner.connected_hosts, [])
 
-    @patch("carrier.Carrier.run_script_on_host")
+    @patch("carrier.Carrier.execute_on_host")
+    @patch("carrier.Carrier.collect_from_host")
     @patch("tarfile.open")
     @patch("os.remove")
-    def test_run(self, mock_remove, mock_open, mock_run_script_on_host):
+    def test_run(
+        self, mock_remove, mock_open, mock_collect_from_host, mock_execute_on_host
+    ):
         self.runner.hosts = ["host1", "host2"]
         self.runner.run()
-        mock_run_script_on_host.assert_called()
-        mock_open.assert_called_once_with("output.tar.gz", "w:gz")
+        mock_execute_on_host.assert_called()
+        mock_collect_from_host.assert_called()
+        mock_open.assert_called_once_with("output.tar", "w")
         mock_remove.assert_called()
 
+    @patch("carrier.Carrier.execute_on_host")
+    @patch("carrier.Carrier.collect_from_host")
+    @patch("tarfile.open")
+    @patch("os.remove")
+    def test_run_skips_failed_hosts(
+        self, mock_remove, mock_open, mock_collect_from_host, mock_execute_on_host
+    ):
+        def collect_from_host(host, executed):
+            if host == "host2":
+                raise subprocess.CalledProcessError(1, "scp")
+
+        mock_collect_from_host.side_effect = collect_from_host
+        result = self.runner.run()
+        mock_remove.assert_called_once_with("host1.tar.gz")
+        mock_open.return_value.add.assert_called_once_with(
+            "host1.tar.gz", arcname="host1.tar.gz"
+        )
+        self.assertIn("All done!", result)
+
+    @patch("carrier.Carrier.execute_on_host")
+    @patch("carrier.Carrier.collect_from_host")
+    def test_run_writes_manifest(self, mock_collect_from_host, mock_execute_on_host):
+        def execute_on_host(host):
+            if host == "host2":
+                raise PhaseTimeout("queue", 0)
+
+        mock_execute_on_host.side_effect = execute_on_host
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.runner.output_archive = os.path.join(temp_dir, "output.tar.gz")
+            self.runner.log_file = os.path.join(temp_dir, "debug.log")
+            self.runner.stream = True
+            self.assertIn("All done!", self.runner.run())
+            with tarfile.open(self.runner.output_archive) as tar:
+                run = json.load(tar.extractfile(MANIFEST_NAME))
+        self.assertEqual(run["nodes"]["host1"], {"status": "done", "archive": "host1"})
+        self.assertEqual(run["nodes"]["host2"]["status"], "timed_out")
+        self.assertEqual(run["nodes"]["host2"]["phase"], "queue")
+
+    @patch("carrier.Carrier.execute_on_host")
+    @patch("carrier.Carrier.collect_from_host")
+    def test_resume_skips_collected_hosts(
+        self, mock_collect_from_host, mock_execute_on_host
+    ):
+        def execute_on_host(host):
+            if host == "host2":
+                raise PhaseTimeout("execute", 10)
+
+        def collect_from_host(host, executed):
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode="w:gz") as tar:
+                info = tarfile.TarInfo("carrier.log")
+                info.size = len(host)
+                tar.addfile(info, io.BytesIO(host.encode("utf-8")))
+            data.seek(0)
+            self.runner.stream_into_bundle(host, {})(data)
+
+        mock_execute_on_host.side_effect = execute_on_host
+        mock_collect_from_host.side_effect = collect_from_host
+        self.runner.stream = True
+        self.runner.run()
+        with open(MANIFEST_NAME) as f:
+            self.assertTrue(json.load(f)["complete"])
+
+        mock_execute_on_host.reset_mock()
+        mock_execute_on_host.side_effect = None
+        self.runner.manifest = RunManifest()
+        self.runner.resume = True
+        self.assertIn("All done!", self.runner.run())
+        mock_execute_on_host.assert_called_once_with("host2")
+        output = self.runner.output_archive
+        self.assertFalse(os.path.exists(output + ".previous"))
+        with tarfile.open(output) as tar:
+            run = json.load(tar.extractfile(MANIFEST_NAME))
+        self.assertTrue(run["nodes"]["host1"]["resumed"])
+        self.assertEqual(run["nodes"]["host2"]["status"], "done")
+        with tarfile.open(output) as tar:
+            self.assertEqual(tar.extractfile("host1/carrier.log").read(), b"host1")
+            self.assertEqual(tar.extractfile("host2/carrier.log").read(), b"host2")
+
+    @patch("carrier.Carrier.execute_on_host")
+    @patch("carrier.Carrier.collect_from_host")
+    def test_resume_after_no_host_was_collected(
+        self, mock_collect_from_host, mock_execute_on_host
+    ):
+        mock_execute_on_host.side_effect = subprocess.CalledProcessError(1, "ssh")
+        self.runner.stream = True
+        self.assertIn("no successful collections", self.runner.run())
+        self.assertFalse(os.path.exists(self.runner.output_archive))
+        with open(MANIFEST_NAME) as f:
+            self.assertIsNone(json.load(f)["bundle"])
+
+        mock_execute_on_host.reset_mock()
+        mock_execute_on_host.side_effect = None
+        self.runner.manifest = RunManifest()
+        self.runner.resume = True
+        self.assertIn("All done!", self.runner.run())
+        self.assertEqual(mock_execute_on_host.call_count, len(self.runner.hosts))
+
+    @patch("carrier.Carrier.run_stream_cmd")
+    def test_live_session_adds_the_files(self, mock_run_stream_cmd):
+        def session(cmd, host, consume, stdin=None, phase=None):
+            self.assertIn("sleep 2", cmd[-1])
+            consume(io.BytesIO(b"0 6 ./ttop.out\nfirst\n6 7 ./ttop.out\nsecond\n"))
+
+        mock_run_stream_cmd.side_effect = session
+        runner = Carrier(
+            self.script,
+            ["host1"],
+            "user",
+            None,
+            True,
+            "bash",
+            live=True,
+            live_interval=2,
+        )
+        self.assertTrue(runner.single_session)
+        self.assertIn("All done!", runner.run())
+        with open(os.path.join("live", "host1", "ttop.out")) as f:
+            self.assertEqual(f.read(), "first\nsecond\n")
+        with tarfile.open(runner.output_archive) as tar:
+            self.assertEqual(
+                tar.extractfile("host1/ttop.out").read(), b"first\nsecond\n"
+            )
+        self.assertEqual(runner.manifest.get("host1")["members"], 1)
+
+    @patch("carrier.Carrier.run_cmd")
+    @patch("carrier.Carrier.read_cmd", return_value="")
+    @patch("carrier_engine.Engine.lines")
+    def test_sync_start_waits_for_every_host(
+        self, mock_lines, mock_read_cmd, mock_run_cmd
+    ):
+        def lines(cmd, log, receive, timeout=None, phase=None):
+            self.assertIn("date +%s.%N", cmd[-1])
+            # host1 is a minute ahead
+            receive(f"{time.time() + 60:.9f}\n".encode("utf-8"))
+
+        mock_lines.side_effect = lines
+        runner = Carrier(
+            self.script, ["host1"], "user", None, True, "bash", sync_start=0
+        )
+
+        async def run():
+            runner.start_barrier = StartBarrier(["host1"], 0)
+            await runner.execute_on_host("host1")
+
+        asyncio.run(run())
+        fields = runner.manifest.get("host1")
+        self.assertAlmostEqual(fields["clock_offset"], 60, delta=1)
+        execute = [
+            cmd for cmd in commands(mock_run_cmd) if "bash test_script.sh" in cmd
+        ]
+        self.assertIn(f"-v start={fields['start']:.3f} ", execute[0])
+        self.assertEqual(runner.start_barrier.staging, set())
+
+    def test_sync_start_needs_separate_steps(self):
+        with self.assertRaises(ValueError):
+            Carrier(
+                self.script,
+                ["host1"],
+                "user",
+                None,
+                True,
+                "bash",
+                live=True,
+                sync_start=5,
+            )
+
+    def test_low_impact_lowers_priority_and_caps_copies(self):
+        runner = Carrier(
+            self.script, ["host1"], "user", None, True, "bash", low_impact=True
+        )
+        self.assertTrue(runner.ssh_cmd("host1", "ls")[-1].startswith("renice -n 19"))
+        self.assertIn("(ls); carrier_rc=$?", runner.ssh_cmd("host1", "ls")[-1])
+        # the default node bandwidth in Kbit/s, uploads are not capped
+        read = runner.scp_read_cmd("host1:a.tar.gz", "a.tar.gz")
+        self.assertEqual(read[read.index("-l") + 1], "100000")
+        self.assertNotIn("-l", runner.scp_write_cmd("a", "host1:a"))
+
+    def test_low_impact_records_usage_by_phase(self):
+        runner = Carrier(
+            self.script, ["host1"], "user", None, True, "bash", low_impact=True
+        )
+        runner.log_file = os.path.join(self.temp_dir.name, "debug.log")
+        # the ssh command line is run by a local shell here, just like sshd would on the host
+        remote = runner.ssh_cmd("host1", "echo collected")[-1]
+        asyncio.run(runner.run_cmd(["sh", "-c", remote], "host1", "archive"))
+        runner.close_log()
+        usage = runner.usage.of("host1")
+        self.assertIn("archive", usage)
+        self.assertEqual(usage["total"]["cpu"], usage["archive"]["cpu"])
+        with open(runner.log_file) as log:
+            self.assertIn("[host1] collected\n[host1] carrier-usage ", log.read())
+
+    def test_resume_needs_a_previous_run(self):
+        self.runner.resume = True
+        with self.assertRaises(ValueError):
+            self.runner.run()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,105 @@
+#    Copyright 2023 Dremio
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#       http://www.apache.org/licenses/LICENSE-2.0
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+import unittest
+from carrier_sched import Scheduler
+from carrier_trace import TIMINGS_FILE, TRACE_FILE, CountingReader, Trace, percentile
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.trace = Trace()
+        for i in range(1, 21):
+            self.trace.record(f"host{i}", "execute", 100.0, 100.0 + i, bytes=10)
+        self.trace.record("host1", "download", 101.0, 103.0, bytes=500)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile([7], 0.95), 7)
+
+    def test_summary(self):
+        summary = self.trace.summary()
+        execute = summary["phases"]["execute"]
+        self.assertEqual(execute["count"], 20)
+        self.assertEqual(execute["p50"], 10)
+        self.assertEqual(execute["p95"], 19)
+        self.assertEqual(execute["max"], 20)
+        self.assertEqual(execute["bytes"], 200)
+        self.assertEqual(summary["phases"]["download"]["bytes"], 500)
+        self.assertEqual(summary["nodes"]["host1"]["wall"], 3)
+        self.assertEqual(summary["nodes"]["host1"]["download"], 2)
+
+    def test_chrome_trace(self):
+        events = self.trace.chrome_trace()["traceEvents"]
+        names = [e for e in events if e["ph"] == "M"]
+        self.assertEqual(len(names), 20)
+        download = [e for e in events if e["name"] == "download"][0]
+        self.assertEqual(download["dur"], 2000000)
+        self.assertEqual(download["args"], {"bytes": 500})
+        self.assertEqual(download["tid"], names[0]["tid"])
+
+    def test_phase_marks_errors(self):
+        with self.assertRaises(ValueError):
+            with self.trace.phase("host1", "upload", bytes=3):
+                raise ValueError("scp failed")
+        event = self.trace.events[-1]
+        self.assertEqual(event["phase"], "upload")
+        self.assertEqual(event["args"], {"bytes": 3, "error": True})
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.trace.write(temp_dir)
+            with open(os.path.join(temp_dir, TIMINGS_FILE)) as f:
+                self.assertIn("execute", json.load(f)["phases"])
+            with open(os.path.join(temp_dir, TRACE_FILE)) as f:
+                self.assertIn("traceEvents", json.load(f))
+
+    def test_counting_reader(self):
+        reader = CountingReader(io.BytesIO(b"x" * 100))
+        reader.read(30)
+        reader.read()
+        self.assertEqual(reader.bytes, 100)
+
+    def test_scheduler_records_queue_wait(self):
+        trace = Trace()
+
+        async def step(node, *args):
+            return node
+
+        async def run():
+            scheduler = Scheduler(1, 1, trace)
+            await asyncio.gather(
+                *(scheduler.submit(host, step, step) for host in ["host1", "host2"])
+            )
+
+        asyncio.run(run())
+        phases = sorted((e["node"], e["phase"]) for e in trace.events)
+        self.assertEqual(
+            phases,
+            [
+                ("host1", "queue"),
+                ("host1", "transfer_queue"),
+                ("host2", "queue"),
+                ("host2", "transfer_queue"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()